@@ -30,7 +30,7 @@ class DropboxMixin(tornado.auth.OAuthMixin):
     _OAUTH_AUTHORIZE_URL = "https://www.dropbox.com/1/oauth/authorize"
 
     def dropbox_request(self, subdomain, path, callback, access_token,
-                        post_args=None, put_body=None, **args):
+                        post_args=None, put_body=None, headers=None, **args):
         """Fetches the given API operation.
 
         The request is defined by a combination of subdomain (either
@@ -41,7 +41,8 @@ class DropboxMixin(tornado.auth.OAuthMixin):
         For GET requests, arguments should be passed as keyword arguments
         to dropbox_request.  For POSTs, arguments should be passed
         as a dictionary in `post_args`.  For PUT, data should be passed
-        as `put_body`
+        as `put_body`.  Extra HTTP request headers (such as Range) can be
+        passed as a dictionary in `headers`.
 
         Example usage::
         
@@ -79,9 +80,10 @@ class DropboxMixin(tornado.auth.OAuthMixin):
         http = AsyncHTTPClient()
         if post_args is not None:
             http.fetch(url, method=method, body=urllib.urlencode(post_args),
-                       callback=callback)
+                       headers=headers, callback=callback)
         else:
-            http.fetch(url, method=method, body=put_body, callback=callback)
+            http.fetch(url, method=method, body=put_body, headers=headers,
+                       callback=callback)
 
     def _oauth_consumer_token(self):
         return dict(
@@ -21,6 +21,23 @@ Note that if you want to run multiple Tornado processes (in the usual nginx+Torn
 you need to use a Cache implementation that all processes can share. Currently no implementations
 meet this criteria, but the planned memcached and CouchDB implementations will.
 
+File data can be stored compressed by passing a codec from compression.py (GzipCodec or
+DeflateCodec) as the compression argument of DictCache or SqliteCache; DropboxAPIMixin.write_data
+will then serve the compressed bytes directly to clients that accept that encoding.
+
+DictCache can save snapshots of its contents to disk (at exit, and periodically with
+start_snapshots) and load them at startup, so that restarted processes start with a warm cache.
+Periodic snapshots are written a batch of entries at a time on the IOLoop, so that large caches
+don't hold up requests while they are saved.
+
+Entries stay fresh for the cache's timeout, unless a policy from ttl_policy.py is passed as the
+ttl_policy argument; AdaptiveTTLPolicy revalidates entries that rarely change less often.
+Files found missing are also cached, for the shorter negative_timeout, so that repeated lookups
+of files that don't exist yet don't each cost a request.
+
+SqliteCache can be bounded by database size and row age (the max_size and max_age arguments);
+start_sweeper then evicts the least recently read files in small batches on the IOLoop.
+
 Classes
 =======
 
@@ -76,10 +93,19 @@ limitations under the License.
 
 """
 
-import json
+import os
+import atexit
+import marshal
+import logging
 import datetime
+import tempfile
 from abc import ABCMeta, abstractmethod, abstractproperty
 
+from compression import get_codec
+from listing import PathTree
+
+logger = logging.getLogger(__name__)
+
 class Cache(object):
     """Cache abstract base class.
 
@@ -96,9 +122,30 @@ class Cache(object):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, folder_name, timeout):
+    def __init__(self, folder_name, timeout, compression=None, compression_threshold=1024, ttl_policy=None, negative_timeout=datetime.timedelta(seconds=10)):
         self._timeout = timeout
+        self._negative_timeout = negative_timeout
+        self._ttl_policy = ttl_policy
         self._folder_name = folder_name
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+        self._path_trees = dict()
+
+    def _encode_data(self, data):
+        """Return (encoding, stored data) for file data, compressing it if it is large enough.
+
+        The encoding is None if the data is stored as is.
+
+        """
+        if self._compression is None or not isinstance(data, str) or len(data) < self._compression_threshold:
+            return None, data
+        return self._compression.name, self._compression.compress(data)
+
+    def _decode_data(self, encoding, data):
+        """Return the original file data for stored data in the given encoding."""
+        if encoding is None:
+            return data
+        return get_codec(encoding).decompress(data)
 
     @property
     def timeout(self):
@@ -109,44 +156,111 @@ class Cache(object):
     def timeout(self, timeout):
         self._timeout = timeout
 
+    @property
+    def negative_timeout(self):
+        """How long a file found missing is assumed to stay missing, a timedelta."""
+        return self._negative_timeout
+
+    @negative_timeout.setter
+    def negative_timeout(self, negative_timeout):
+        self._negative_timeout = negative_timeout
+
+    @property
+    def ttl_policy(self):
+        """Policy deciding how long each entry stays fresh (see ttl_policy.py); None to use timeout for every entry."""
+        return self._ttl_policy
+
+    @ttl_policy.setter
+    def ttl_policy(self, ttl_policy):
+        self._ttl_policy = ttl_policy
+
+    def ttl(self, uid, file_name=None, folder_name=None):
+        """Return how long an entry stays fresh, a timedelta; file_name is None for the folder listing."""
+        if self._ttl_policy is None:
+            return self._timeout
+        return self._ttl_policy.ttl((uid, self._folder(folder_name), file_name))
+
+    def observe(self, uid, changed, file_name=None, folder_name=None):
+        """Tell the TTL policy whether a revalidation found an entry changed; file_name is None for the folder listing."""
+        if self._ttl_policy is not None:
+            self._ttl_policy.observe((uid, self._folder(folder_name), file_name), changed)
+
     @property
     def folder_name(self):
-        """The folder name the app is using; can be empty. Changing it will invalidate the whole cache."""
+        """The default folder name, used when a method is not given a folder_name; can be empty.
+
+        Entries are keyed by folder, so changing this leaves entries for other folders cached.
+
+        """
         return self._folder_name
 
     @folder_name.setter
     def folder_name(self, folder_name):
         self._folder_name = folder_name
-        self.clear_cache()
+
+    def _folder(self, folder_name):
+        """Return the folder name to key entries by; the default folder name if folder_name is None."""
+        if folder_name is None:
+            return self._folder_name
+        return folder_name
+
+    def _in_folder(self, entry_folder, folder_name):
+        """Return True if entry_folder is folder_name or one of its subfolders."""
+        return entry_folder == folder_name or not folder_name or entry_folder.startswith(folder_name + "/")
+
+    def get_path_tree(self, uid, folder_name=None):
+        """Return the listing.PathTree for a user's folder, creating it if needed.
+
+        Path trees index the listings of a folder's subfolders for recursive listing; they are
+        kept in memory in each process, rather than stored by the cache implementation.
+
+        """
+        key = (uid, self._folder(folder_name))
+        if key not in self._path_trees:
+            self._path_trees[key] = PathTree()
+        return self._path_trees[key]
+
+    def _drop_path_trees(self, uid=None, folder_name=None):
+        """Forget the path trees for a user and/or a folder (and its subfolders); all of them by default."""
+        to_delete = [key for key in self._path_trees.iterkeys()
+                if (uid is None or key[0] == uid) and (folder_name is None or self._in_folder(key[1], folder_name))]
+        for key in to_delete:
+            del self._path_trees[key]
     
     @abstractmethod
-    def get_user(self, uid):
-        """Return a user dict for the given uid.
+    def get_user(self, uid, folder_name=None):
+        """Return a user dict for the given uid and folder.
+
+        All methods take an optional folder_name, the Dropbox folder the entry belongs to; if it
+        is not given, the cache's folder_name is used. Entries for different folders are kept
+        separately, so several folders can be cached at once.
 
         The dict should have the following keys:
         uid - the user id
         folder_name - the Dropbox folder name this app is using; could be empty if using sandbox access
         folder_metadata_ts - the timestamp of the last retrieval of the metadata for the folder, as a datetime object
         folder_metadata - the metadata for this folder, as a JSON dict
+        folder_listing - the listing built from the metadata by listing.build_listing, or None if not stored yet
 
         This implementation returns a simple dict with a timestamp such that the metadata is always re-retrieved.
         
         """
-        return { "uid" : uid, "folder_name" : self._folder_name, "folder_metadata_ts" : datetime.datetime.min, "folder_metadata" : None }
+        return { "uid" : uid, "folder_name" : self._folder(folder_name), "folder_metadata_ts" : datetime.datetime.min, "folder_metadata" : dict(), "folder_listing" : None }
 
     @abstractmethod
-    def update_folder_metadata(self, uid, timestamp, metadata):
+    def update_folder_metadata(self, uid, timestamp, metadata, listing=None, folder_name=None):
         """Update the metadata and timestamp of the app folder.
         
         uid - the user id
         timestamp - the timestamp of the retrieval of this metadata, as a datetime object
-        metadata - the folder metadata, as a JSON string
+        metadata - the folder metadata, as a JSON dict; implementations must not modify it
+        listing - the listing built from the metadata by listing.build_listing, as a dict
 
         """
         return
 
     @abstractmethod
-    def update_folder_metadata_timestamp(self, uid, timestamp):
+    def update_folder_metadata_timestamp(self, uid, timestamp, folder_name=None):
         """Update the timestamp of the app folder; used if the metadata has not changed.
 
         uid - the user id
@@ -156,7 +270,7 @@ class Cache(object):
         return
 
     @abstractmethod
-    def get_file(self, uid, file_name):
+    def get_file(self, uid, file_name, folder_name=None):
         """Return a file dict for the given filename, or None if not cached yet.
 
         The dict should have the following keys:
@@ -166,39 +280,92 @@ class Cache(object):
         file_metadata_ts - the timestamp of the last retrieval for the file/metadata, as a datetime object
         file_data - the contents of the file
 
+        Implementations that store compressed data should only decompress file_data when it is
+        accessed, so that callers that only need the metadata don't pay for it.
+
         This implementation returns None, as it never caches any files.
 
         """
         return None
 
+    def get_file_metadata(self, uid, file_name, folder_name=None):
+        """Return a file dict without the file data for the given filename, or None if not cached yet.
+
+        The dict has the same keys as for get_file, except file_data, plus file_encoding (the
+        codec the data is stored with, or None) if the data may be stored compressed; use this
+        when only the metadata is needed, so that the file data is not loaded.
+
+        This implementation returns the dict from get_file; implementations that can load the
+        metadata alone should override it.
+
+        """
+        return self.get_file(uid, file_name, folder_name)
+
+    def get_stored_data(self, uid, file_name, folder_name=None):
+        """Return the file data as stored, or None if not cached yet.
+
+        Returns a tuple of (encoding, data), where encoding is the name of the compression codec
+        (which is also the HTTP Content-Encoding) the data is compressed with, or None if the
+        data is not compressed.
+
+        This implementation uses get_file, so implementations written before compression was
+        added keep working; implementations that store compressed data should override it.
+
+        """
+        file_dict = self.get_file(uid, file_name, folder_name)
+        if file_dict is None:
+            return None
+        if file_dict.get("file_encoding") is not None:
+            return file_dict["file_encoding"], file_dict["file_stored_data"]
+        return None, file_dict["file_data"]
+
+    def get_data_range(self, uid, file_name, start, stop, folder_name=None):
+        """Return part of the file data, or None if not cached yet.
+
+        start and stop are slice bounds into the file data, so start may be negative for a
+        suffix and stop may be None for the rest of the file. Returns a tuple of (data, first,
+        size), where first is the offset of the returned data and size is the size of the whole
+        file.
+
+        This implementation slices the stored data, decompressing it if needed; implementations
+        that can read part of the stored data directly should override it.
+
+        """
+        stored = self.get_stored_data(uid, file_name, folder_name)
+        if stored is None:
+            return None
+        data = self._decode_data(*stored)
+        first, last, _ = slice(start, stop).indices(len(data))
+        return data[first:last], first, len(data)
+
     @abstractmethod
-    def add_file(self, uid, file_name, timestamp, metadata, data):
+    def add_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
         """Add a file to the cache.
 
         uid - the user id
         file_name - the filename
         timestamp - when the file was retrieved, as a datetime object
-        metadata - the file metadata, as a JSON string
+        metadata - the file metadata, as a JSON dict; implementations must not modify it
         data - the file contents
 
         """
         return
 
     @abstractmethod
-    def update_file(self, uid, file_name, timestamp, metadata, data):
+    def update_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
         """Update a file in the cache.
 
         uid - the user id
         file_name - the filename
         timestamp - when the file was retrieved, as a datetime object
-        metadata - the file metadata, as a JSON string
+        metadata - the file metadata, as a JSON dict; implementations must not modify it
         data - the file contents
 
         """
         return
 
     @abstractmethod
-    def update_file_timestamp(self, uid, file_name, timestamp):
+    def update_file_timestamp(self, uid, file_name, timestamp, folder_name=None):
         """Update a file's timestamp in the cache; used if it hasn't changed.
 
         uid - the user id
@@ -209,7 +376,7 @@ class Cache(object):
         return
 
     @abstractmethod
-    def remove_file(self, uid, file_name):
+    def remove_file(self, uid, file_name, folder_name=None):
         """Remove a file from the cache.
 
         uid - the user id
@@ -218,16 +385,108 @@ class Cache(object):
         """
         return
 
+    def get_folder_timestamp(self, uid, folder_name=None):
+        """Return the folder_metadata_ts of a user's folder, or None if it is not cached.
+
+        Unlike get_user, this never creates an entry or loads the folder metadata.
+
+        This implementation uses get_user; implementations should override it.
+
+        """
+        return self.get_user(uid, folder_name)["folder_metadata_ts"]
+
+    def get_missing(self, uid, file_name, folder_name=None):
+        """Return when a file was last found missing, as a datetime object, or None if it is not recorded as missing.
+
+        Callers compare this against negative_timeout; expired entries may be returned.
+
+        This implementation returns None, so caches that don't implement the missing file
+        methods never cache missing files.
+
+        """
+        return None
+
+    def add_missing(self, uid, file_name, timestamp, folder_name=None):
+        """Record that a file does not exist.
+
+        uid - the user id
+        file_name - the filename
+        timestamp - when the file was found missing, as a datetime object
+
+        """
+        return
+
+    def remove_missing(self, uid, file_name, folder_name=None):
+        """Forget that a file was found missing; used when it is created.
+
+        uid - the user id
+        file_name - the filename
+
+        """
+        return
+
     @abstractmethod
     def clear_cache(self):
         """Clears all cache entries, both users/folders and items."""
         return
 
+    def clear_folder(self, folder_name):
+        """Clears all cache entries for a folder and its subfolders, for every user.
+
+        This implementation clears the whole cache, which is always safe; implementations
+        should override it to keep the entries of other folders.
+
+        """
+        self.clear_cache()
+
     @abstractmethod
     def remove_user(self, uid):
-        """Removes all references to a user from the cache, ie when they log out."""
+        """Removes all references to a user from the cache, in every folder, ie when they log out."""
         return
 
+_SNAPSHOT_HEADER = ("tornado_dropcache.DictCache", 2)
+# snapshots from these versions can be loaded; version 1 has no missing file records
+_SNAPSHOT_VERSIONS = (1, 2)
+# records written per IOLoop callback by save_snapshot_async
+_SNAPSHOT_BATCH_SIZE = 500
+# DictCache prunes expired missing file entries once there are at least this many
+_MISSING_PRUNE_SIZE = 1000
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _to_seconds(timestamp):
+    """Convert a naive datetime to seconds since the epoch for snapshots; datetime.min becomes None."""
+    if timestamp == datetime.datetime.min:
+        return None
+    delta = timestamp - _EPOCH
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def _from_seconds(seconds):
+    if seconds is None:
+        return datetime.datetime.min
+    return _EPOCH + datetime.timedelta(seconds=seconds)
+
+class FileDict(dict):
+    """A file dict, as returned by get_file, for data that may be stored compressed.
+
+    Compressed data is kept under 'file_stored_data' with its codec name under 'file_encoding',
+    and is decompressed each time 'file_data' is looked up; uncompressed data is kept under
+    'file_data' as usual.
+
+    """
+
+    def __missing__(self, key):
+        if key == "file_data" and "file_stored_data" in self:
+            return get_codec(self["file_encoding"]).decompress(self["file_stored_data"])
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key == "file_data" and dict.__contains__(self, "file_stored_data"))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
 class EmptyCache(Cache):
     """Cache implementation that caches nothing; used if no cache is specified."""
 
@@ -240,115 +499,392 @@ class EmptyCache(Cache):
         """
         super(EmptyCache, self).__init__(folder_name, datetime.timedelta(seconds=0))
 
-    def get_user(self, uid):
-        return super(EmptyCache, self).get_user(uid)
+    def get_user(self, uid, folder_name=None):
+        return super(EmptyCache, self).get_user(uid, folder_name)
+
+    def update_folder_metadata(self, uid, timestamp, metadata, listing=None, folder_name=None):
+        super(EmptyCache, self).update_folder_metadata(uid, timestamp, metadata, listing, folder_name)
+
+    def update_folder_metadata_timestamp(self, uid, timestamp, folder_name=None):
+        super(EmptyCache, self).update_folder_metadata_timestamp(uid, timestamp, folder_name)
 
-    def update_folder_metadata(self, uid, timestamp, metadata):
-        super(EmptyCache, self).update_folder_metadata(uid, timestamp, metadata)
+    def get_file(self, uid, file_name, folder_name=None):
+        return super(EmptyCache, self).get_file(uid, file_name, folder_name)
 
-    def update_folder_metadata_timestamp(self, uid, timestamp):
-        super(EmptyCache, self).update_folder_metadata_timestamp(uid, timestamp)
+    def get_file_metadata(self, uid, file_name, folder_name=None):
+        return super(EmptyCache, self).get_file_metadata(uid, file_name, folder_name)
 
-    def get_file(self, uid, file_name):
-        return super(EmptyCache, self).get_file(uid, file_name)
+    def get_stored_data(self, uid, file_name, folder_name=None):
+        return super(EmptyCache, self).get_stored_data(uid, file_name, folder_name)
 
-    def add_file(self, uid, file_name, timestamp, metadata, data):
-        super(EmptyCache, self).add_file(uid, file_name, timestamp, metadata, data)
+    def add_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        super(EmptyCache, self).add_file(uid, file_name, timestamp, metadata, data, folder_name)
 
-    def update_file(self, uid, file_name, timestamp, metadata, data):
-        super(EmptyCache, self).update_file(uid, file_name, timestamp, metadata, data)
+    def update_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        super(EmptyCache, self).update_file(uid, file_name, timestamp, metadata, data, folder_name)
 
-    def update_file_timestamp(self, uid, file_name, timestamp):
-        super(EmptyCache, self).update_file_timestamp(uid, file_name, timestamp)
+    def update_file_timestamp(self, uid, file_name, timestamp, folder_name=None):
+        super(EmptyCache, self).update_file_timestamp(uid, file_name, timestamp, folder_name)
 
-    def remove_file(self, uid, file_name):
-        super(EmptyCache, self).remove_file(uid, file_name)
+    def remove_file(self, uid, file_name, folder_name=None):
+        super(EmptyCache, self).remove_file(uid, file_name, folder_name)
+
+    def get_folder_timestamp(self, uid, folder_name=None):
+        return None
+
+    def get_missing(self, uid, file_name, folder_name=None):
+        return super(EmptyCache, self).get_missing(uid, file_name, folder_name)
+
+    def add_missing(self, uid, file_name, timestamp, folder_name=None):
+        super(EmptyCache, self).add_missing(uid, file_name, timestamp, folder_name)
+
+    def remove_missing(self, uid, file_name, folder_name=None):
+        super(EmptyCache, self).remove_missing(uid, file_name, folder_name)
 
     def clear_cache(self):
         super(EmptyCache, self).clear_cache()
 
+    def clear_folder(self, folder_name):
+        super(EmptyCache, self).clear_folder(folder_name)
+
     def remove_user(self, uid):
         super(EmptyCache, self).remove_user(uid)
 
 class DictCache(Cache):
     """A Cache implementation that stores data in an in memory dictionary."""
 
-    def __init__(self, folder_name, timeout=datetime.timedelta(seconds=60)):
+    def __init__(self, folder_name, timeout=datetime.timedelta(seconds=60), compression=None, compression_threshold=1024, snapshot_file_name=None, ttl_policy=None, negative_timeout=datetime.timedelta(seconds=10)):
         """Construct a DictCache with a folder name.
 
         The folder name is the path to this app's files, and could be the empty string
         if sandbox access is used.
 
+        compression - a codec from compression.py to store file data with; default None, no compression
+        compression_threshold - only compress file data at least this many bytes long; default 1024
+        snapshot_file_name - file to load a snapshot from now, and save one to at exit; default None, no snapshots
+        ttl_policy - a policy from ttl_policy.py deciding how long each entry stays fresh; default None, timeout for every entry
+        negative_timeout - how long a file found missing is assumed to stay missing; default 10 seconds
+
+        Entries loaded from a snapshot keep their timestamps, so they are revalidated as usual
+        once they time out, and files recorded as missing stay missing until negative_timeout
+        has passed. Snapshots are only saved at a normal interpreter exit; call start_snapshots
+        to also save them periodically, and save_snapshot from any signal handler that stops the
+        IOLoop.
+
         """
-        super(DictCache, self).__init__(folder_name, timeout)
+        super(DictCache, self).__init__(folder_name, timeout, compression, compression_threshold, ttl_policy, negative_timeout)
 
+        # keyed by (uid, folder name) and (uid, folder name, file name)
         self._user_dict = dict()
         self._data_dict = dict()
+        self._missing_dict = dict()
+        # expired missing entries are pruned when the dict grows to this size
+        self._missing_prune_size = _MISSING_PRUNE_SIZE
 
-    def _key(self, uid, file_name):
-        return "%s %s" % (uid, file_name)
+        self._snapshot_file_name = snapshot_file_name
+        self._snapshot_callback = None
+        self._snapshot_in_progress = False
+        if snapshot_file_name:
+            if os.path.exists(snapshot_file_name):
+                self.load_snapshot()
+            atexit.register(self.save_snapshot)
 
-    def get_user(self, uid):
-        if uid not in self._user_dict:
+    def _snapshot_records(self):
+        """Yield the snapshot records of all entries.
+
+        The keys are copied first and each entry is looked up as its record is made, so the
+        cache can change while the records are being written; entries removed meanwhile are
+        skipped.
+
+        """
+        for key in self._user_dict.keys():
+            user = self._user_dict.get(key)
+            if user is not None:
+                yield ("user", key[0], key[1], _to_seconds(user['folder_metadata_ts']),
+                        user['folder_metadata'], user['folder_listing'])
+        for key in self._data_dict.keys():
+            file_dict = self._data_dict.get(key)
+            if file_dict is not None:
+                encoding = file_dict['file_encoding']
+                stored = file_dict['file_data'] if encoding is None else file_dict['file_stored_data']
+                yield ("file", key[0], key[1], key[2], _to_seconds(file_dict['file_metadata_ts']),
+                        file_dict['file_metadata'], encoding, stored)
+        for key in self._missing_dict.keys():
+            timestamp = self._missing_dict.get(key)
+            if timestamp is not None:
+                yield ("missing", key[0], key[1], key[2], _to_seconds(timestamp))
+
+    def _open_snapshot(self, file_name):
+        """Return (file name, temporary file name, open temporary file) for a new snapshot, with the header written."""
+        file_name = file_name or self._snapshot_file_name
+        if not file_name:
+            raise ValueError("no snapshot file name given")
+        directory = os.path.dirname(os.path.abspath(file_name))
+        fd, temp_name = tempfile.mkstemp(prefix=".snapshot", dir=directory)
+        f = os.fdopen(fd, "wb")
+        marshal.dump(_SNAPSHOT_HEADER, f)
+        return file_name, temp_name, f
+
+    def save_snapshot(self, file_name=None):
+        """Write all entries to a snapshot file; by default the snapshot_file_name given at construction.
+
+        The snapshot is a stream of marshal records, written to a temporary file that then
+        replaces the old snapshot, so a crash while saving never leaves a partial snapshot.
+        This writes the whole snapshot at once; see save_snapshot_async to save from the IOLoop.
+
+        """
+        file_name, temp_name, f = self._open_snapshot(file_name)
+        try:
+            with f:
+                for record in self._snapshot_records():
+                    marshal.dump(record, f)
+            os.rename(temp_name, file_name)
+        except Exception:
+            os.remove(temp_name)
+            raise
+        logger.debug("saved snapshot of %d users and %d files", len(self._user_dict), len(self._data_dict))
+
+    def save_snapshot_async(self, file_name=None, callback=None, io_loop=None):
+        """Write all entries to a snapshot file a batch at a time on a Tornado IOLoop.
+
+        Like save_snapshot, but only a few hundred records are written per IOLoop callback, so
+        other requests are served while a large cache is saved. Entries changed while saving
+        may or may not be included.
+
+        callback - called once the snapshot has replaced the old one; default None
+        io_loop - the Tornado IOLoop to save on; default IOLoop.instance()
+
+        """
+        from tornado.ioloop import IOLoop
+
+        io_loop = io_loop or IOLoop.instance()
+        file_name, temp_name, f = self._open_snapshot(file_name)
+        records = self._snapshot_records()
+        self._snapshot_in_progress = True
+
+        def write_batch():
+            try:
+                for i in xrange(_SNAPSHOT_BATCH_SIZE):
+                    try:
+                        record = next(records)
+                    except StopIteration:
+                        f.close()
+                        os.rename(temp_name, file_name)
+                        break
+                    marshal.dump(record, f)
+                else:
+                    io_loop.add_callback(write_batch)
+                    return
+            except Exception:
+                self._snapshot_in_progress = False
+                f.close()
+                os.remove(temp_name)
+                raise
+            self._snapshot_in_progress = False
+            logger.debug("saved snapshot of %d users and %d files", len(self._user_dict), len(self._data_dict))
+            if callback is not None:
+                callback()
+
+        io_loop.add_callback(write_batch)
+
+    def _save_periodic_snapshot(self):
+        if self._snapshot_in_progress:
+            logger.warning("skipping snapshot, the last one is still being saved")
+            return
+        self.save_snapshot_async(io_loop=self._snapshot_callback.io_loop)
+
+    def load_snapshot(self, file_name=None):
+        """Add the entries from a snapshot file; by default the snapshot_file_name given at construction.
+
+        Records are read one at a time, so loading never holds more than the cache itself.
+        Snapshots that are unreadable or from another version are ignored.
+
+        """
+        file_name = file_name or self._snapshot_file_name
+        if not file_name:
+            raise ValueError("no snapshot file name given")
+        try:
+            with open(file_name, "rb") as f:
+                header = marshal.load(f)
+                if not isinstance(header, tuple) or len(header) != 2 or header[0] != _SNAPSHOT_HEADER[0] or header[1] not in _SNAPSHOT_VERSIONS:
+                    logger.warning("ignoring snapshot %s from another version", file_name)
+                    return
+                while True:
+                    try:
+                        record = marshal.load(f)
+                    except EOFError:
+                        break
+                    if record[0] == "user":
+                        uid, folder_name, ts, metadata, listing = record[1:]
+                        self._user_dict[(uid, folder_name)] = {
+                                'uid' : uid,
+                                'folder_name' : folder_name,
+                                'folder_metadata_ts' : _from_seconds(ts),
+                                'folder_metadata' : metadata,
+                                'folder_listing' : listing,
+                                }
+                    elif record[0] == "missing":
+                        uid, folder_name, file_name_key, ts = record[1:]
+                        self._missing_dict[(uid, folder_name, file_name_key)] = _from_seconds(ts)
+                    else:
+                        uid, folder_name, file_name_key, ts, metadata, encoding, stored = record[1:]
+                        file_dict = FileDict({
+                                'uid' : uid,
+                                'file_name' : file_name_key,
+                                'file_metadata' : metadata,
+                                'file_metadata_ts' : _from_seconds(ts),
+                                'file_encoding' : encoding,
+                                })
+                        file_dict['file_data' if encoding is None else 'file_stored_data'] = stored
+                        self._data_dict[(uid, folder_name, file_name_key)] = file_dict
+        except (IOError, ValueError, TypeError, EOFError):
+            logger.exception("could not load snapshot %s", file_name)
+            return
+        logger.debug("loaded snapshot of %d users and %d files", len(self._user_dict), len(self._data_dict))
+
+    def start_snapshots(self, interval=datetime.timedelta(minutes=5), io_loop=None):
+        """Save a snapshot periodically on a Tornado IOLoop with save_snapshot_async; default every 5 minutes.
+
+        A snapshot is skipped if the previous one is still being saved.
+
+        """
+        from tornado.ioloop import PeriodicCallback
+
+        if self._snapshot_callback is not None:
+            self._snapshot_callback.stop()
+        milliseconds = interval.days * 86400000 + interval.seconds * 1000 + interval.microseconds / 1000
+        self._snapshot_callback = PeriodicCallback(self._save_periodic_snapshot, milliseconds, io_loop=io_loop)
+        self._snapshot_callback.start()
+
+    def _key(self, uid, file_name, folder_name):
+        return (uid, self._folder(folder_name), file_name)
+
+    def get_user(self, uid, folder_name=None):
+        key = (uid, self._folder(folder_name))
+        if key not in self._user_dict:
             user_dict = {
                     'uid' : uid,
-                    'folder_name' : self.folder_name,
+                    'folder_name' : key[1],
                     'folder_metadata_ts' : datetime.datetime.min,
                     'folder_metadata' : dict(),
+                    'folder_listing' : None,
                     }
-            self._user_dict[uid] = user_dict
-        return self._user_dict[uid]
+            self._user_dict[key] = user_dict
+        return self._user_dict[key]
 
-    def update_folder_metadata(self, uid, timestamp, metadata):
-        if uid not in self._user_dict:
+    def update_folder_metadata(self, uid, timestamp, metadata, listing=None, folder_name=None):
+        key = (uid, self._folder(folder_name))
+        if key not in self._user_dict:
             return
-        self._user_dict[uid]['folder_metadata_ts'] = timestamp
-        self._user_dict[uid]['folder_metadata'] = json.loads(metadata)
+        self._user_dict[key]['folder_metadata_ts'] = timestamp
+        self._user_dict[key]['folder_metadata'] = metadata
+        self._user_dict[key]['folder_listing'] = listing
 
-    def update_folder_metadata_timestamp(self, uid, timestamp):
-        if uid not in self._user_dict:
+    def update_folder_metadata_timestamp(self, uid, timestamp, folder_name=None):
+        key = (uid, self._folder(folder_name))
+        if key not in self._user_dict:
             return
-        self._user_dict[uid]['folder_metadata_ts'] = timestamp
+        self._user_dict[key]['folder_metadata_ts'] = timestamp
+
+    def get_file(self, uid, file_name, folder_name=None):
+        return self._data_dict.get(self._key(uid, file_name, folder_name))
 
-    def get_file(self, uid, file_name):
-        if self._key(uid, file_name) not in self._data_dict:
+    def get_file_metadata(self, uid, file_name, folder_name=None):
+        # file dicts only decompress file data on access, so this is the same as get_file
+        return self.get_file(uid, file_name, folder_name)
+
+    def get_stored_data(self, uid, file_name, folder_name=None):
+        file_dict = self._data_dict.get(self._key(uid, file_name, folder_name))
+        if file_dict is None:
             return None
+        elif file_dict['file_encoding'] is None:
+            return None, file_dict['file_data']
+        else:
+            return file_dict['file_encoding'], file_dict['file_stored_data']
+
+    def _set_data(self, file_dict, data):
+        encoding, stored = self._encode_data(data)
+        file_dict['file_encoding'] = encoding
+        if encoding is None:
+            file_dict['file_data'] = stored
+            file_dict.pop('file_stored_data', None)
         else:
-            return self._data_dict[self._key(uid, file_name)]
+            file_dict['file_stored_data'] = stored
+            file_dict.pop('file_data', None)
 
-    def add_file(self, uid, file_name, timestamp, metadata, data):
-        file_dict = {
+    def add_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        file_dict = FileDict({
                 'uid' : uid,
                 'file_name' : file_name,
-                'file_metadata' : json.loads(metadata),
+                'file_metadata' : metadata,
                 'file_metadata_ts' : timestamp,
-                'file_data' : data,
-                }
-        self._data_dict[self._key(uid, file_name)] = file_dict
+                })
+        self._set_data(file_dict, data)
+        self._data_dict[self._key(uid, file_name, folder_name)] = file_dict
 
-    def update_file(self, uid, file_name, timestamp, metadata, data):
-        if self._key(uid, file_name) not in self._data_dict:
+    def update_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        key = self._key(uid, file_name, folder_name)
+        if key not in self._data_dict:
             return
-        self._data_dict[self._key(uid, file_name)]['file_metadata_ts'] = timestamp
-        self._data_dict[self._key(uid, file_name)]['file_metadata'] = json.loads(metadata)
-        self._data_dict[self._key(uid, file_name)]['file_data'] = data
+        self._data_dict[key]['file_metadata_ts'] = timestamp
+        self._data_dict[key]['file_metadata'] = metadata
+        self._set_data(self._data_dict[key], data)
 
-    def update_file_timestamp(self, uid, file_name, timestamp):
-        if self._key(uid, file_name) not in self._data_dict:
+    def update_file_timestamp(self, uid, file_name, timestamp, folder_name=None):
+        key = self._key(uid, file_name, folder_name)
+        if key not in self._data_dict:
             return
-        self._data_dict[self._key(uid, file_name)]['file_metadata_ts'] = timestamp
+        self._data_dict[key]['file_metadata_ts'] = timestamp
 
-    def remove_file(self, uid, file_name):
-        if self._key(uid, file_name) not in self._data_dict:
-            return
-        del self._data_dict[self._key(uid, file_name)]
+    def remove_file(self, uid, file_name, folder_name=None):
+        self._data_dict.pop(self._key(uid, file_name, folder_name), None)
+
+    def get_folder_timestamp(self, uid, folder_name=None):
+        user = self._user_dict.get((uid, self._folder(folder_name)))
+        if user is None:
+            return None
+        return user['folder_metadata_ts']
+
+    def get_missing(self, uid, file_name, folder_name=None):
+        key = self._key(uid, file_name, folder_name)
+        timestamp = self._missing_dict.get(key)
+        if timestamp is not None and datetime.datetime.now() - timestamp > self._negative_timeout:
+            del self._missing_dict[key]
+            return None
+        return timestamp
+
+    def add_missing(self, uid, file_name, timestamp, folder_name=None):
+        self._missing_dict[self._key(uid, file_name, folder_name)] = timestamp
+        if len(self._missing_dict) >= self._missing_prune_size:
+            self._prune_missing()
+
+    def _prune_missing(self):
+        """Remove expired missing file entries; the next prune waits until the dict has doubled, so the cost is amortized."""
+        cutoff = datetime.datetime.now() - self._negative_timeout
+        expired = [key for key, timestamp in self._missing_dict.iteritems() if timestamp < cutoff]
+        for key in expired:
+            del self._missing_dict[key]
+        self._missing_prune_size = max(2 * len(self._missing_dict), _MISSING_PRUNE_SIZE)
+
+    def remove_missing(self, uid, file_name, folder_name=None):
+        self._missing_dict.pop(self._key(uid, file_name, folder_name), None)
 
     def clear_cache(self):
         self._user_dict = dict()
         self._data_dict = dict()
+        self._missing_dict = dict()
+        self._drop_path_trees()
+
+    def clear_folder(self, folder_name):
+        for d in (self._user_dict, self._data_dict, self._missing_dict):
+            to_delete = [key for key in d.iterkeys() if self._in_folder(key[1], folder_name)]
+            for key in to_delete:
+                del d[key]
+        self._drop_path_trees(folder_name=folder_name)
 
     def remove_user(self, uid):
-        del self._user_dict[uid]
-        to_delete = [key for key in self._data_dict.iterkeys() if key.startswith("%s " % (uid))]
-        for key in to_delete:
-            del self._data_dict[key]
+        self._drop_path_trees(uid=uid)
+        for d in (self._user_dict, self._data_dict, self._missing_dict):
+            to_delete = [key for key in d.iterkeys() if key[0] == uid]
+            for key in to_delete:
+                del d[key]
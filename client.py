@@ -0,0 +1,257 @@
+"""
+=========
+client.py
+=========
+
+Handler-independent access to the cached Dropbox operations of DropboxAPIMixin, for background
+tasks and for code that is not running inside a request handler.
+
+Dependencies
+============
+
+Python (tested on 2.7.1), tornado, and async_dropbox (a copy is provided).
+
+Usage
+=====
+
+A DropboxClient owns a user's access token, the folder path and the cache, and offers the same
+operations as DropboxAPIMixin without the handler decorators. Each operation takes an optional
+callback, which receives a single result (for get_data, just the file data). Without a callback,
+each operation returns a tornado.concurrent.Future instead, so with Tornado 3.0 or later it can be
+yielded from a coroutine; earlier versions of Tornado have no Futures, so a callback is required.
+
+Several files can be retrieved concurrently with get_data_many, which costs less than gathering
+gen.Tasks for each file. warm_cache retrieves the listing and the most recently modified files
+into the cache ahead of the requests that will need them; DropboxLoginHandler uses it at login.
+
+::
+
+    client = DropboxClient.from_handler(self)
+
+    # any version of Tornado, inside a gen.engine function
+    files = yield tornado.gen.Task(client.get_files)
+    contents = yield tornado.gen.Task(client.get_data_many, files)
+
+    # Tornado 3.0 or later, inside a gen.coroutine function
+    files = yield client.get_files()
+    data, listing = yield [client.get_data("todo.txt"), client.get_files_recursive()]
+
+Classes
+=======
+
+DropboxClient
+    Cached Dropbox operations on a single folder for one user, independent of any handler.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+from tornado.stack_context import ExceptionStackContext
+from tornado.escape import utf8
+
+from mixin import DropboxOperations
+from cache import EmptyCache
+
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    # Tornado before 3.0
+    Future = None
+
+class DropboxClient(DropboxOperations):
+    """Cached Dropbox operations on a single folder for one user, independent of any handler."""
+
+    def __init__(self, consumer_key, consumer_secret, access_token, uid, folder_path="", api_type="sandbox", cache=None, tracer=None, write_behind=None, recorder=None):
+        """Construct a DropboxClient.
+
+        consumer_key - the app's Dropbox consumer key
+        consumer_secret - the app's Dropbox consumer secret
+        access_token - the user's access token, a dict with key and secret, as returned from the Dropbox auth process
+        uid - the user's Dropbox user id
+        folder_path - the path (relative to the api type) of the folder to operate on; default empty string
+        api_type - must be 'sandbox' or 'dropbox'; default 'sandbox'
+        cache - an object implementing methods from tornado_dropcache.Cache; default is an EmptyCache using folder_path
+        tracer - a tracing.Tracer to record a trace of each operation; default None, no tracing
+        write_behind - a write_behind.WriteBehindQueue to debounce uploads through; default None, uploads happen straight away
+        recorder - a replay.TraceRecorder to record the cache and Dropbox traffic into; default None, nothing is recorded
+
+        """
+        self.uid = uid
+        self.folder_path = folder_path
+        # json turns this into unicode strings, but we need bytes for oauth signatures.
+        self._access_token = dict((utf8(k), utf8(v)) for (k, v) in access_token.iteritems())
+        self.settings = {
+                "dropbox_consumer_key" : consumer_key,
+                "dropbox_consumer_secret" : consumer_secret,
+                "dropbox_api_type" : api_type,
+                "dropbox_cache" : cache if cache is not None else EmptyCache(folder_path),
+                "dropbox_tracer" : tracer,
+                "dropbox_write_behind" : write_behind,
+                "dropbox_recorder" : recorder,
+                }
+
+    @classmethod
+    def from_handler(cls, handler):
+        """Construct a DropboxClient for the current user and folder of a DropboxAPIMixin handler, using its settings."""
+        settings = handler.settings
+        # the configured cache itself, not _get_cache(), which wraps it for the recorder; the
+        # client wraps it again itself, and without a cache it makes its own EmptyCache
+        return cls(settings["dropbox_consumer_key"], settings["dropbox_consumer_secret"],
+                handler.current_user["access_token"], handler.current_user["uid"],
+                folder_path=handler._get_folder_path(), api_type=handler._get_api_type(),
+                cache=handler.settings.get("dropbox_cache"), tracer=handler._get_tracer(), write_behind=handler._get_write_behind(),
+                recorder=handler._get_recorder())
+
+    @property
+    def cache(self):
+        return self.settings["dropbox_cache"]
+
+    def _get_uid(self):
+        return self.uid
+
+    def _get_access_token(self):
+        return self._access_token
+
+    def _get_folder_path(self):
+        return self.folder_path
+
+    def _run(self, start, callback):
+        """Start an operation; start is called with the function that receives its result.
+
+        With a callback, errors propagate as they do for DropboxAPIMixin operations; otherwise a
+        Future is returned that receives the result or the error.
+
+        """
+        if callback is not None:
+            start(callback)
+            return None
+        if Future is None:
+            raise TypeError("a callback is required with versions of Tornado before 3.0")
+
+        future = Future()
+        def handle_exception(typ, value, tb):
+            if future.done():
+                # raised by code run from the Future's own callbacks
+                return False
+            future.set_exception(value)
+            return True
+        with ExceptionStackContext(handle_exception):
+            start(future.set_result)
+        return future
+
+    def get_files(self, sort="name", reverse=False, offset=0, limit=None, prefix=None, details=False, callback=None):
+        """Retrieve a sequence of filenames in the folder; see DropboxAPIMixin.get_files."""
+        return self._run(lambda done: self._get_files(done, sort=sort, reverse=reverse, offset=offset, limit=limit, prefix=prefix, details=details), callback)
+
+    def get_files_recursive(self, path="", details=False, callback=None):
+        """Retrieve a sequence of the paths of all files and folders in a subtree; see DropboxAPIMixin.get_files_recursive."""
+        return self._run(lambda done: self._get_files_recursive(done, path=path, details=details), callback)
+
+    def get_data(self, file_name, blank_on_404=False, callback=None):
+        """Retrieve the file data for a specified file; see DropboxAPIMixin.get_data.
+
+        The result is the file data alone.
+
+        """
+        return self._run(lambda done: self._get_data(file_name, lambda name, data: done(data), blank_on_404=blank_on_404), callback)
+
+    def get_data_range(self, file_name, start=0, stop=None, callback=None):
+        """Retrieve part of the file data for a specified file.
+
+        start and stop are slice bounds into the file data; start may be negative (with stop
+        None) for the last -start bytes. The result is a tuple of the data, the offset of its
+        first byte, and the size of the whole file. Files that are not cached have only the range
+        retrieved, and are then retrieved whole into the cache in the background.
+
+        """
+        return self._run(lambda done: self._get_data_range(file_name, start, stop, lambda data, first, size: done((data, first, size))), callback)
+
+    def get_data_many(self, file_names, blank_on_404=False, callback=None):
+        """Retrieve the file data for several files concurrently.
+
+        The result is a list of the file data, in the same order as file_names; a file named
+        more than once is only retrieved once. If any retrieval fails, the first error is raised
+        (or set on the Future) and the other results and errors are dropped.
+
+        """
+        file_names = list(file_names)
+
+        def start(done):
+            unique = list(set(file_names))
+            results = dict()
+            failed = [False]
+            if not unique:
+                done([])
+                return
+
+            def on_data(name, data):
+                if failed[0]:
+                    return
+                results[name] = data
+                if len(results) == len(unique):
+                    done([results[n] for n in file_names])
+
+            def handle_exception(typ, value, tb):
+                if failed[0]:
+                    return True
+                failed[0] = True
+                return False
+
+            for name in unique:
+                with ExceptionStackContext(handle_exception):
+                    self._get_data(name, on_data, blank_on_404=blank_on_404)
+
+        return self._run(start, callback)
+
+    def upload_data(self, file_name, data, callback=None):
+        """Upload new data to the specified file, creating it if it does not exist; see DropboxAPIMixin.upload_data."""
+        return self._run(lambda done: self._upload_data(file_name, data, done), callback)
+
+    def move_file(self, file_name, new_file_name, callback=None):
+        """Move a file within the folder; the result is None."""
+        return self._run(lambda done: self._move_file(file_name, new_file_name, lambda: done(None)), callback)
+
+    def delete_file(self, file_name, callback=None):
+        """Delete a file within the folder; the result is None."""
+        return self._run(lambda done: self._delete_file(file_name, lambda: done(None)), callback)
+
+    def warm_cache(self, files=0, callback=None):
+        """Retrieve the folder listing into the cache, then the most recently modified files.
+
+        files - the number of files to retrieve after the listing; default 0, just the listing
+
+        The result is the list of file names retrieved.
+
+        """
+        def start(done):
+            def on_files(entries):
+                names = [entry["name"] for entry in entries if not entry["is_dir"]][:files]
+                if not names:
+                    done(names)
+                    return
+                self.get_data_many(names, blank_on_404=True, callback=lambda data: done(names))
+
+            self.get_files(sort="modified", reverse=True, details=True, callback=on_files)
+
+        return self._run(start, callback)
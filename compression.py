@@ -0,0 +1,104 @@
+"""
+==============
+compression.py
+==============
+
+Codecs for compressing cached file data.
+
+Dependencies
+============
+
+Python (tested on 2.7.1).
+
+Usage
+=====
+
+Pass a codec as the compression argument of a Cache implementation that supports it (DictCache
+and SqliteCache); file data at least compression_threshold bytes long is then stored compressed.
+Each codec's name is the matching HTTP Content-Encoding, so the stored bytes can be served
+as-is to clients that accept that encoding; see DropboxAPIMixin.write_data.
+
+::
+
+    cache = DictCache("<folder path>", compression=GzipCodec())
+
+Classes
+=======
+
+GzipCodec
+    Compresses with gzip; served as Content-Encoding: gzip.
+
+DeflateCodec
+    Compresses with zlib; served as Content-Encoding: deflate.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import zlib
+
+class GzipCodec(object):
+    """Compresses with gzip; served as Content-Encoding: gzip."""
+
+    name = "gzip"
+
+    def __init__(self, level=6):
+        """Construct a GzipCodec; level is the zlib compression level, default 6."""
+        self.level = level
+
+    def compress(self, data):
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class DeflateCodec(object):
+    """Compresses with zlib; served as Content-Encoding: deflate."""
+
+    name = "deflate"
+
+    def __init__(self, level=6):
+        """Construct a DeflateCodec; level is the zlib compression level, default 6."""
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+_codecs = {
+        GzipCodec.name : GzipCodec(),
+        DeflateCodec.name : DeflateCodec(),
+        }
+
+def register_codec(codec):
+    """Register a codec so that data stored with its name can be decompressed."""
+    _codecs[codec.name] = codec
+
+def get_codec(name):
+    """Return the registered codec for the given encoding name."""
+    return _codecs[name]
@@ -0,0 +1,283 @@
+"""
+==========
+listing.py
+==========
+
+Precomputed folder listings, so that get_files can sort, page and filter large folders without
+reprocessing the whole folder metadata on every call.
+
+Dependencies
+============
+
+Python (tested on 2.7.1).
+
+Usage
+=====
+
+A listing is built once from the folder metadata whenever new metadata is stored in the cache,
+and is kept in the cache alongside it. It is a plain dict (so that cache implementations can
+serialize it like the metadata) with the following keys:
+
+version - LISTING_VERSION, so that listings stored by older versions can be rebuilt
+entries - a list of entry dicts sorted by name ignoring case, each with the keys name (relative to the folder), size (in bytes), modified (the Dropbox date string), rev and is_dir
+names - the lowercased entry names, in the same order, for bisecting
+by_size - indexes into entries, sorted by size
+by_modified - indexes into entries, sorted by modification time
+
+Dropbox paths are case-insensitive, so names are sorted and prefixes matched ignoring case;
+this is not necessarily the order Dropbox returns the folder contents in.
+
+Functions
+=========
+
+build_listing
+    Build a listing from folder metadata.
+
+query_listing
+    Return a sorted, filtered page of entries from a listing.
+
+Classes
+=======
+
+PathTree
+    In-memory tree of the listings of a folder and its subfolders, for recursive listing.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import bisect
+import datetime
+import itertools
+import email.utils
+
+SORT_KEYS = ("name", "size", "modified")
+
+# increment whenever the structure of a listing changes
+LISTING_VERSION = 2
+
+def _modified_ts(modified):
+    parsed = email.utils.parsedate_tz(modified) if modified else None
+    if not parsed:
+        return 0
+    return email.utils.mktime_tz(parsed)
+
+def build_listing(folder_path, metadata):
+    """Build a listing from folder metadata.
+
+    folder_path - the folder path, which is stripped from the front of each entry's path
+    metadata - the folder metadata, as a JSON dict
+
+    """
+    entries = []
+    for content in metadata.get("contents", ()):
+        entries.append({
+                "name" : content["path"].replace(folder_path, "", 1).lstrip("/"),
+                "size" : content.get("bytes", 0),
+                "modified" : content.get("modified"),
+                "rev" : content.get("rev"),
+                "is_dir" : content.get("is_dir", False),
+                })
+    entries.sort(key=lambda e: (e["name"].lower(), e["name"]))
+
+    indexes = range(len(entries))
+    modified = [_modified_ts(e["modified"]) for e in entries]
+    return {
+            "version" : LISTING_VERSION,
+            "entries" : entries,
+            "names" : [e["name"].lower() for e in entries],
+            "by_size" : sorted(indexes, key=lambda i: entries[i]["size"]),
+            "by_modified" : sorted(indexes, key=lambda i: modified[i]),
+            }
+
+def _prefix_range(names, prefix):
+    """Return the (start, end) indexes of the names starting with prefix, ignoring case."""
+    prefix = prefix.lower()
+    start = bisect.bisect_left(names, prefix)
+    end = bisect.bisect_left(names, prefix[:-1] + unichr(ord(prefix[-1]) + 1), start)
+    return start, end
+
+def query_listing(listing, sort="name", reverse=False, offset=0, limit=None, prefix=None):
+    """Return a sorted, filtered page of entries from a listing.
+
+    Sorting by name only touches the entries in the page; sorting by size or modified with a
+    prefix has to filter the whole index for that key.
+
+    listing - a listing from build_listing
+    sort - one of 'name', 'size' or 'modified'; default 'name'
+    reverse - sort in descending order; default False
+    offset - number of matching entries to skip; default 0
+    limit - maximum number of entries to return; default None, no limit
+    prefix - only return entries whose name starts with this, ignoring case; default None, all entries
+
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError("unknown sort key %r" % (sort,))
+
+    entries = listing["entries"]
+    start, end = 0, len(entries)
+    if prefix:
+        start, end = _prefix_range(listing["names"], prefix)
+
+    if sort == "name":
+        order = None
+    else:
+        order = listing["by_%s" % sort]
+        if prefix:
+            order = [i for i in order if start <= i < end]
+        start, end = 0, len(order)
+
+    count = end - start
+    first = min(offset, count)
+    last = count if limit is None else min(offset + limit, count)
+    if reverse:
+        positions = xrange(end - 1 - first, end - 1 - last, -1)
+    else:
+        positions = xrange(start + first, start + last)
+
+    if order is None:
+        return [entries[p] for p in positions]
+    return [entries[order[p]] for p in positions]
+
+class _TreeNode(object):
+    __slots__ = ("children", "listing", "timestamp", "generation", "invalidated")
+
+    def __init__(self):
+        self.children = dict()
+        self.listing = None
+        self.timestamp = datetime.datetime.min
+        # generation of the last update, and of the last invalidation of this whole subtree
+        self.generation = 0
+        self.invalidated = 0
+
+class PathTree(object):
+    """In-memory tree of the listings of a folder and its subfolders, for recursive listing.
+
+    Paths are relative to the app folder, with '' for the folder itself. Looking up a path and
+    invalidating a path (or a whole subtree) cost O(depth); updating a folder's listing keeps the
+    nodes, and so the cached listings, of its subfolders that still exist.
+
+    A subtree invalidation is recorded only on the subtree's root with a generation number, and
+    is applied to the nodes below it as the tree is walked from the top; see is_fresh.
+
+    """
+
+    def __init__(self):
+        self.root = _TreeNode()
+        self._generations = itertools.count(1)
+
+    def _split(self, path):
+        return [part for part in path.split("/") if part]
+
+    def find(self, path, create=False):
+        """Return the node for path, or None if it is not in the tree (unless create is True)."""
+        node = self.root
+        for part in self._split(path):
+            child = node.children.get(part)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[part] = _TreeNode()
+            node = child
+        return node
+
+    def update(self, path, listing, timestamp):
+        """Set the listing of the folder at path, as retrieved at timestamp, and return its node."""
+        node = self.find(path, create=True)
+        node.listing = listing
+        node.timestamp = timestamp
+        node.generation = next(self._generations)
+
+        folders = set(entry["name"] for entry in listing["entries"] if entry["is_dir"])
+        for name in node.children.keys():
+            if name not in folders:
+                del node.children[name]
+        for name in folders:
+            if name not in node.children:
+                node.children[name] = _TreeNode()
+        return node
+
+    def remove(self, path):
+        """Drop the folder at path and everything below it from the tree."""
+        parts = self._split(path)
+        if not parts:
+            return
+        parent = self.find("/".join(parts[:-1]))
+        if parent is not None:
+            parent.children.pop(parts[-1], None)
+
+    def invalidate(self, path, subtree=False):
+        """Mark the folder at path as needing revalidation; with subtree, every folder below it too."""
+        node = self.find(path)
+        if node is None:
+            return
+        node.timestamp = datetime.datetime.min
+        if subtree:
+            node.invalidated = next(self._generations)
+
+    def ancestor_invalidation(self, path):
+        """Return the highest subtree invalidation generation of the folders above path, for is_fresh."""
+        invalidated = 0
+        node = self.root
+        for part in self._split(path):
+            invalidated = max(invalidated, node.invalidated)
+            node = node.children.get(part)
+            if node is None:
+                break
+        return invalidated
+
+    def is_fresh(self, node, invalidated, now, timeout):
+        """Return True if node can be used without revalidation.
+
+        invalidated - the highest subtree invalidation generation of the node's ancestors
+        now - the current time, as a datetime
+        timeout - how long a listing stays fresh, as a timedelta
+
+        """
+        return (node.listing is not None and node.generation > max(invalidated, node.invalidated)
+                and now - node.timestamp <= timeout)
+
+    def entries(self, path=""):
+        """Yield the entries of the subtree at path, a folder at a time and depth first, with a 'path' key relative to the app folder.
+
+        Folders that have not been listed yet are skipped.
+
+        """
+        node = self.find(path)
+        if node is None:
+            return
+        stack = [("/".join(self._split(path)), node)]
+        while stack:
+            prefix, node = stack.pop()
+            if node.listing is None:
+                continue
+            # entries are emitted when a folder is first listed, so push subfolders in reverse order
+            subfolders = []
+            for entry in node.listing["entries"]:
+                entry = dict(entry)
+                entry["path"] = "%s/%s" % (prefix, entry["name"]) if prefix else entry["name"]
+                yield entry
+                if entry["is_dir"] and entry["name"] in node.children:
+                    subfolders.append((entry["path"], node.children[entry["name"]]))
+            stack.extend(reversed(subfolders))
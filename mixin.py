@@ -20,10 +20,26 @@ DropboxUserHandler
 DropboxLoginHandler
     Handler to handle Dropbox login; redirects to / on success.
 
+DropboxOperations
+    The cached Dropbox operations behind DropboxAPIMixin and client.DropboxClient.
+
 DropboxAPIMixin
     High level Dropbox API access for a single folder, built on top of
     async_dropbox.DropboxMixin, Cache, and DropboxUserMixin.
 
+DropboxClient (client.py)
+    The same operations without a handler, returning Futures on Tornado 3.0 and later.
+
+WriteBehindQueue (write_behind.py)
+    Debounced uploads for upload_data, coalescing rapid saves of the same file.
+
+TraceRecorder (replay.py)
+    Compact binary traces of the cache and Dropbox traffic, replayed offline to tune a cache.
+
+DropboxHTTPCacheMixin
+    ETag/Last-Modified headers and 304 responses for files and the folder listing,
+    answered from cached Dropbox metadata; built on top of DropboxAPIMixin.
+
 See the documentation for each class for more details and specifics on which
 application settings and cookies are used.
 
@@ -43,7 +59,7 @@ Example Usage
 
     class LoginHandler(DropboxLoginHandler):
         def set_application_cookies(self):
-            self.set_secure_cookie("dropbox_folder_path", "<folder path>")
+            self.set_folder_path("<folder path>")
 
     class ViewHandler(DropboxUserHandler, DropboxAPIMixin):
         @tornado.web.authenticated
@@ -70,6 +86,7 @@ Example Usage
         "debug": True,
         "dropbox_cache": cache,
         "dropbox_api_type": "dropbox",
+        "dropbox_warm_cache": 5,
     }
 
     application = tornado.web.Application([
@@ -110,18 +127,103 @@ limitations under the License.
 
 """
 
+import time
+import bisect
+import posixpath
+import email.utils
 import logging
 import json
 import datetime
+import functools
+import collections
+from abc import ABCMeta, abstractmethod
 
 import tornado.gen
+import tornado.stack_context
+import tornado.web
 
 from async_dropbox import DropboxMixin
+from cache import EmptyCache
+from tracing import NULL_TRACE
+from listing import build_listing, query_listing, LISTING_VERSION
+from write_behind import WriteConflictError
 from tornado.escape import utf8
 from urllib import quote
 
 logger = logging.getLogger(__name__)
 
+# files being retrieved in the background after a partial read, as (uid, folder name, file name)
+_background_fills = set()
+
+def _operation(method):
+    """Decorator for the operations of DropboxOperations that start a trace.
+
+    If the operation raises, synchronously or from a later callback, the trace it started is
+    finished with the error before the exception propagates.
+
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._get_tracer() is None:
+            return method(self, *args, **kwargs)
+
+        started = []
+        def handle_exception(typ, value, tb):
+            for trace in started:
+                trace.fail(value)
+            return False
+
+        # _start_trace adds the trace here, before the operation's first yield
+        outer = getattr(self, "_started_traces", None)
+        self._started_traces = started
+        try:
+            with tornado.stack_context.ExceptionStackContext(handle_exception):
+                return method(self, *args, **kwargs)
+        finally:
+            self._started_traces = outer
+    return wrapper
+
+def _parse_range(header):
+    """Return (start, stop) slice bounds for a single 'bytes=' Range header, or None if it can't be served as one range."""
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    first, last = [part.strip() for part in spec.split("-", 1)]
+    try:
+        if not first:
+            # a suffix of zero bytes can't be satisfied; serve the whole file instead
+            if int(last) > 0:
+                return -int(last), None
+        elif not last:
+            return int(first), None
+        elif int(last) >= int(first):
+            return int(first), int(last) + 1
+    except ValueError:
+        pass
+    return None
+
+def _range_header(start, stop):
+    """Return the Range header for slice bounds accepted by _parse_range."""
+    if start < 0:
+        return "bytes=%d" % start
+    elif stop is None:
+        return "bytes=%d-" % start
+    return "bytes=%d-%d" % (start, stop - 1)
+
+def _parse_content_range(header):
+    """Return (first, size) from a Content-Range header, with first None for 'bytes */size'; None if it can't be parsed."""
+    if not header or not header.startswith("bytes "):
+        return None
+    byte_range, _, size = header[len("bytes "):].partition("/")
+    try:
+        if byte_range == "*":
+            return None, int(size)
+        return int(byte_range.split("-", 1)[0]), int(size)
+    except ValueError:
+        return None
+
 class DropboxUserHandler(tornado.web.RequestHandler):
     """Handler to provide nicer user access.
 
@@ -147,6 +249,13 @@ class DropboxLoginHandler(tornado.web.RequestHandler, DropboxMixin):
     Sets the Dropbox user JSON string into a secure cookie called 'user';
     thus works nicely with DropboxUserMixin.
 
+    After a successful login, warm_cache is called with the user and the dropbox_folder_path
+    cookie set by set_application_cookies, without waiting for it before redirecting.
+
+    Uses keys from the settings dict as follows:
+    dropbox_warm_cache - number of the most recently modified files to retrieve into the cache after the folder listing at login; default None, nothing is retrieved
+    The dropbox_api_type, dropbox_cache, dropbox_tracer, dropbox_write_behind and dropbox_recorder keys are used as by DropboxAPIMixin.
+
     """
 
     @tornado.web.asynchronous
@@ -160,6 +269,7 @@ class DropboxLoginHandler(tornado.web.RequestHandler, DropboxMixin):
             logger.debug("got user, setting cookie and redirecting to /")
             self.set_secure_cookie("user", json.dumps(user))
             self.set_application_cookies()
+            self._start_warm_cache(user, self._new_folder_path())
             self.redirect('/')
         else:
             logger.debug("calling authorize_redirect")
@@ -168,31 +278,87 @@ class DropboxLoginHandler(tornado.web.RequestHandler, DropboxMixin):
     def set_application_cookies(self):
         """Override this to set any application level cookies that are required after login.
         
-        Setting your default dropbox_folder_path here is recommended.
+        Setting your default dropbox_folder_path here (with set_folder_path, or set_secure_cookie)
+        is recommended.
 
         """
         pass
 
-class DropboxAPIMixin(DropboxMixin):
-    """High level Dropbox API access for a single folder, built on top of async_dropbox.DropboxMixin and Cache.
+    def set_folder_path(self, folder_path):
+        """Set the dropbox_folder_path cookie used by DropboxAPIMixin, which is also the folder the cache is warmed with.
 
-    Provides listing, file retrieval, upload, move, and remove operations. All operations will
-    update the cache automatically if the dropbox_folder_path cookie is detected to have changed.
+        folder_path - the path (relative to dropbox api type) of the folder that this app is managing
 
-    Uses keys from the settings dict as follows:
-    dropbox_api_type - must be 'sandbox' or 'dropbox'; default 'sandbox'
-    dropbox_cache - an object implementing methods from tornado_dropcache.Cache; default is an EmptyCache using dropbox_folder_path
+        """
+        self.set_secure_cookie("dropbox_folder_path", folder_path)
 
-    Uses secure cookies as follows:
-    dropbox_folder_path - the path (relative to dropbox api type) of the folder that this app is managing; default is empty string
+    def _new_folder_path(self):
+        """Return the dropbox_folder_path cookie set in this response, or empty string."""
+        # get_secure_cookie only reads the request's cookies, so decode the one being set
+        cookies = getattr(self, "_new_cookie", None)
+        if cookies is None or "dropbox_folder_path" not in cookies:
+            return ""
+        return self.get_secure_cookie("dropbox_folder_path", value=cookies["dropbox_folder_path"].value) or ""
+
+    def _start_warm_cache(self, user, folder_path):
+        def on_error(typ, value, tb):
+            logger.warning("warming the cache at login failed: %s", value)
+            return True
+
+        # run independently of this request, which finishes with the redirect
+        with tornado.stack_context.NullContext():
+            with tornado.stack_context.ExceptionStackContext(on_error):
+                self.warm_cache(user, folder_path)
+
+    def warm_cache(self, user, folder_path):
+        """Start retrieving the folder into the cache after login, as set by dropbox_warm_cache.
+
+        Override this to warm the cache differently; it must not wait for the retrieval.
+
+        user - the user dict stored in the 'user' cookie
+        folder_path - the dropbox_folder_path cookie set by set_application_cookies, or empty string
+
+        """
+        files = self.settings.get("dropbox_warm_cache")
+        if files is None or "dropbox_cache" not in self.settings:
+            return
+
+        # imported here since client imports this module
+        from client import DropboxClient
+        client = DropboxClient(self.settings["dropbox_consumer_key"], self.settings["dropbox_consumer_secret"],
+                user["access_token"], user["uid"], folder_path=folder_path,
+                api_type=self.settings.get("dropbox_api_type", "sandbox"), cache=self.settings["dropbox_cache"],
+                tracer=self.settings.get("dropbox_tracer"), write_behind=self.settings.get("dropbox_write_behind"),
+                recorder=self.settings.get("dropbox_recorder"))
+        logger.debug("warming the cache with the listing and %d files of '%s'", files, folder_path)
+        client.warm_cache(files, callback=lambda names: logger.debug("warmed the cache with %s", names))
+
+class DropboxOperations(DropboxMixin):
+    """Cached Dropbox operations on a single folder, shared by DropboxAPIMixin and client.DropboxClient.
+
+    Each operation is implemented here as a _<operation> method taking a callback, without the
+    handler decorators. Subclasses provide the user id, access token and folder path with
+    _get_uid, _get_access_token and _get_folder_path, and the dropbox_* settings described in
+    DropboxAPIMixin as a settings dict.
 
     """
 
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def _get_uid(self):
+        """Helper function to get the Dropbox user id that cache entries are keyed by."""
+        raise NotImplementedError()
+
+    @abstractmethod
     def _get_access_token(self):
         """Helper function to get the Dropbox access token for API calls."""
+        raise NotImplementedError()
 
-        # json turns this into unicode strings, but we need bytes for oauth signatures.
-        return dict((utf8(k), utf8(v)) for (k, v) in self.current_user["access_token"].iteritems())
+    @abstractmethod
+    def _get_folder_path(self):
+        """Helper function to get the path of the folder this app is managing."""
+        raise NotImplementedError()
 
     def _get_setting(self, key, default_func):
         if key in self.settings:
@@ -203,42 +369,141 @@ class DropboxAPIMixin(DropboxMixin):
     def _get_api_type(self):
         return self._get_setting("dropbox_api_type", lambda: "sandbox")
 
-    def _get_folder_path(self):
-        if not self.get_secure_cookie("dropbox_folder_path"):
-            return ""
-        else:
-            return self.get_secure_cookie("dropbox_folder_path")
-
     def _get_cache(self):
-        return self._get_setting("dropbox_cache", lambda: EmptyCache(self._get_folder_path()))
+        cache = self._get_setting("dropbox_cache", lambda: EmptyCache(self._get_folder_path()))
+        recorder = self._get_recorder()
+        if recorder is not None:
+            return recorder.wrap_cache(cache)
+        return cache
+
+    def _get_recorder(self):
+        return self._get_setting("dropbox_recorder", lambda: None)
+
+    def _record_operation(self, name, uid, path=""):
+        """Record an operation on a path relative to the folder, if a recorder is configured."""
+        recorder = self._get_recorder()
+        if recorder is None:
+            return
+        try:
+            recorder.record_operation(name, uid, self._subfolder_path(self._get_folder_path(), path))
+        except Exception:
+            logger.exception("could not record operation %s", name)
+
+    def _get_tracer(self):
+        return self._get_setting("dropbox_tracer", lambda: None)
+
+    def _get_write_behind(self):
+        return self._get_setting("dropbox_write_behind", lambda: None)
+
+    def _detached(self):
+        """Return an object to run operations on that outlive the current request; this one by default."""
+        return self
+
+    def _pending_write(self, uid, folder, file_name):
+        """Return the data saved for a file and not uploaded yet by write-behind, or None."""
+        queue = self._get_write_behind()
+        if queue is None:
+            return None
+        return queue.pending_data((uid, folder, file_name))
+
+    def _start_trace(self, name, **tags):
+        """Start a trace for an operation; returns a no-op trace if no tracer is configured."""
+        self._record_operation(name, tags["uid"], tags.get("file_name", tags.get("path", "")))
+        tracer = self._get_tracer()
+        if tracer is None:
+            return NULL_TRACE
+        trace = tracer.start_trace(name, **tags)
+        started = getattr(self, "_started_traces", None)
+        if started is not None:
+            started.append(trace)
+        return trace
+
+    def _traced_request(self, trace, subdomain, path, callback, **kwargs):
+        """Make a dropbox_request, recording build/sign, wait and transfer spans into trace."""
+        recorder = self._get_recorder()
+        if recorder is not None:
+            uid = self._get_uid()
+            callback = self._recording_callback(recorder, uid, path, kwargs, callback)
+
+        if trace is NULL_TRACE:
+            self.dropbox_request(subdomain, path, callback, **kwargs)
+            return
+
+        request_span = trace.start_span("dropbox.%s" % path.split("/", 3)[2])
+        sent = []
+
+        def on_response(response):
+            now = time.time()
+            # only curl_httpclient reports when the body started arriving
+            transfer = 0.0
+            if "starttransfer" in response.time_info and "total" in response.time_info:
+                transfer = max(response.time_info["total"] - response.time_info["starttransfer"], 0.0)
+            trace.add_span("http.wait", sent[0], now - transfer)
+            if transfer:
+                trace.add_span("http.transfer", now - transfer, now)
+            trace.end_span(request_span)
+            callback(response)
+
+        self._dropbox_trace = trace
+        try:
+            with trace.span("request.build"):
+                self.dropbox_request(subdomain, path, on_response, **kwargs)
+        finally:
+            self._dropbox_trace = NULL_TRACE
+        sent.append(time.time())
+
+    def _recording_callback(self, recorder, uid, path, kwargs, callback):
+        def on_response(response):
+            try:
+                recorder.record_request(uid, path, kwargs, response)
+            except Exception:
+                logger.exception("could not record request to %s", path)
+            callback(response)
+        return on_response
 
-    @tornado.web.authenticated
-    @tornado.web.asynchronous
+    def _oauth_request_parameters(self, url, access_token, parameters={}, method="GET"):
+        with getattr(self, "_dropbox_trace", NULL_TRACE).span("request.sign"):
+            return super(DropboxOperations, self)._oauth_request_parameters(url, access_token, parameters, method)
+
+    @_operation
     @tornado.gen.engine
-    def get_files(self, callback):
-        """Retrieve a sequence of filenames in the folder under consideration.
-        
-        Filenames are returned with the folder path stripped off.
+    def _get_files(self, callback, sort="name", reverse=False, offset=0, limit=None, prefix=None, details=False):
+        """Implementation of get_files; see DropboxAPIMixin.get_files."""
 
-        callback - callback that will receive the filename sequence
-        
-        """
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("get_files", uid=uid)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
 
-        cache = self._get_cache()
-        uid = self.current_user["uid"]
-        user = cache.get_user(uid)
+        listing, timestamp = yield tornado.gen.Task(self._refresh_folder, trace, cache, uid, folder)
+        cache.get_path_tree(uid, folder_name=folder).update("", listing, timestamp)
+
+        callback(self._query_listing(listing, sort=sort, reverse=reverse, offset=offset, limit=limit, prefix=prefix, details=details))
+
+    @tornado.gen.engine
+    def _refresh_folder(self, trace, cache, uid, folder_path, callback, force=False, missing_ok=False):
+        """Get the listing for a folder from the cache, revalidating it with Dropbox if it has timed out.
+
+        folder_path - the Dropbox path of the folder; also the folder name it is cached under
+        callback - callback that will receive a tuple of the listing and when it was retrieved
+        force - revalidate even if the cached metadata has not timed out
+        missing_ok - if the folder no longer exists, call back with (None, None) instead of raising a 404
+
+        """
+        user = cache.get_user(uid, folder_name=folder_path)
 
-        if datetime.datetime.now() - user["folder_metadata_ts"] > cache.timeout:
+        if force or datetime.datetime.now() - user["folder_metadata_ts"] > cache.ttl(uid, folder_name=folder_path):
             logger.debug("making dropbox list request")
             response = None
             if "hash" in user["folder_metadata"]:
-                response = yield tornado.gen.Task(self.dropbox_request,
-                        "api", "/1/metadata/%s/%s" % (self._get_api_type(), quote(self._get_folder_path())),
+                response = yield tornado.gen.Task(self._traced_request, trace,
+                        "api", "/1/metadata/%s/%s" % (self._get_api_type(), quote(folder_path)),
                         access_token=self._get_access_token(),
                         list="true", hash=user["folder_metadata"]["hash"])
             else:
-                response = yield tornado.gen.Task(self.dropbox_request,
-                        "api", "/1/metadata/%s/%s" % (self._get_api_type(), quote(self._get_folder_path())),
+                response = yield tornado.gen.Task(self._traced_request, trace,
+                        "api", "/1/metadata/%s/%s" % (self._get_api_type(), quote(folder_path)),
                         access_token=self._get_access_token(),
                         list="true")
 
@@ -247,52 +512,158 @@ class DropboxAPIMixin(DropboxMixin):
             except tornado.httpclient.HTTPError as e:
                 if e.code == 304:
                     logger.debug("using cached value after 304 response")
-                    cache.update_folder_metadata_timestamp(uid, datetime.datetime.now())
+                    cache.observe(uid, False, folder_name=folder_path)
+                    now = datetime.datetime.now()
+                    cache.update_folder_metadata_timestamp(uid, now, folder_name=folder_path)
 
-                    user = cache.get_user(uid)
-
-                    callback(self._files_from_metadata(user["folder_metadata"]))
+                    callback((self._listing_from_user(user, folder_path), now))
+                    return
+                elif e.code == 404 and missing_ok:
+                    callback((None, None))
                     return
                 else:
                     raise
 
-            metadata = json.load(response.buffer)
+            with trace.span("json.decode"):
+                metadata = json.load(response.buffer)
 
-            cache.update_folder_metadata(uid, datetime.datetime.now(), json.dumps(metadata))
+            with trace.span("listing.build"):
+                listing = build_listing(folder_path, metadata)
 
-            callback(self._files_from_metadata(metadata))
-        else:
-            logger.debug("using cached value")
-            callback(self._files_from_metadata(user["folder_metadata"]))
+            if "hash" in user["folder_metadata"]:
+                cache.observe(uid, metadata.get("hash") != user["folder_metadata"]["hash"], folder_name=folder_path)
 
-    def _files_from_metadata(self, metadata):
-        logger.debug('metadata contents %s', metadata["contents"])
-        return [content["path"].replace(self._get_folder_path(), "", 1).lstrip("/") for content in metadata["contents"]]
+            now = datetime.datetime.now()
+            cache.update_folder_metadata(uid, now, metadata, listing, folder_name=folder_path)
 
-    @tornado.web.authenticated
-    @tornado.web.asynchronous
+            callback((listing, now))
+        else:
+            logger.debug("using cached value")
+            callback((self._listing_from_user(user, folder_path), user["folder_metadata_ts"]))
+
+    def _listing_from_user(self, user, folder_path):
+        """Return the cached listing for a user dict, building it from the metadata if it was not stored (or stored by an older version)."""
+        listing = user["folder_listing"]
+        if listing is None or listing.get("version") != LISTING_VERSION:
+            listing = build_listing(folder_path, user["folder_metadata"])
+        return listing
+
+    def _query_listing(self, listing, details=False, **query):
+        entries = query_listing(listing, **query)
+        if details:
+            return entries
+        return [entry["name"] for entry in entries]
+
+    def _subfolder_path(self, folder, path):
+        """Return the Dropbox path of a path relative to the app folder."""
+        path = path.strip("/")
+        if not path:
+            return folder
+        elif not folder:
+            return path
+        return "%s/%s" % (folder.rstrip("/"), path)
+
+    @_operation
     @tornado.gen.engine
-    def get_data(self, file_name, callback, blank_on_404=False):
-        """Retrieve the file data for a specified file.
-
-        file_name - the file to retrieve
-        callback - callback that will receive the file name and data
-        blank_on_404 - return a blank file on a 404 error; use when planning to upload a new file in the next step
-
-        """
-        cache = self._get_cache()
-        uid = self.current_user["uid"]
-
-        f = cache.get_file(uid, file_name)
+    def _get_files_recursive(self, callback, path="", details=False):
+        """Implementation of get_files_recursive; see DropboxAPIMixin.get_files_recursive."""
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("get_files_recursive", uid=uid, path=path)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+        tree = cache.get_path_tree(uid, folder_name=folder)
+
+        yield tornado.gen.Task(self._refresh_tree, trace, cache, tree, uid, folder, path.strip("/"), datetime.datetime.now())
+
+        entries = list(tree.entries(path))
+        if details:
+            callback(entries)
+        else:
+            callback([entry["path"] for entry in entries])
+
+    def _refresh_tree(self, trace, cache, tree, uid, folder, path, now, callback):
+        """Revalidate the folders of the subtree at path as needed, at most dropbox_tree_concurrency at a time."""
+        limit = self._get_setting("dropbox_tree_concurrency", lambda: 4)
+        top = path
+        # folders still to check, with the highest subtree invalidation above each
+        pending = collections.deque([(path, tree.ancestor_invalidation(path))])
+        running = [0]
+        done = [False]
+
+        def add_children(path, node, invalidated):
+            invalidated = max(invalidated, node.invalidated)
+            for name in node.children:
+                pending.append(("%s/%s" % (path, name) if path else name, invalidated))
+
+        def refreshed(path, invalidated, branch, result):
+            running[0] -= 1
+            branch.finish()
+            listing, timestamp = result
+            if listing is None:
+                # deleted since its parent was listed; the parent's listing is out of date too
+                logger.debug("subfolder %s no longer exists", path)
+                tree.remove(path)
+                self._invalidate_parent(cache, uid, folder, path)
+            else:
+                add_children(path, tree.update(path, listing, timestamp), invalidated)
+            start()
+
+        def start():
+            while pending and running[0] < limit:
+                path, invalidated = pending.popleft()
+                node = tree.find(path, create=True)
+                if tree.is_fresh(node, invalidated, now, cache.ttl(uid, folder_name=self._subfolder_path(folder, path))):
+                    add_children(path, node, invalidated)
+                    continue
+                stale = node.generation <= max(invalidated, node.invalidated)
+                running[0] += 1
+                # the refreshes overlap, so each records its spans into its own branch of the trace
+                branch = trace.branch("refresh_folder")
+                self._refresh_folder(branch, cache, uid, self._subfolder_path(folder, path),
+                        functools.partial(refreshed, path, invalidated, branch), force=stale, missing_ok=path != top)
+            if not pending and not running[0] and not done[0]:
+                done[0] = True
+                callback()
+
+        start()
+
+    @_operation
+    @tornado.gen.engine
+    def _get_data(self, file_name, callback, blank_on_404=False):
+        """Implementation of get_data; see DropboxAPIMixin.get_data."""
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("get_data", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+
+        pending = self._pending_write(uid, folder, file_name)
+        if pending is not None:
+            logger.debug("returning data waiting to be uploaded")
+            callback(file_name, pending)
+            return
+
+        f = cache.get_file(uid, file_name, folder_name=folder)
         if not f:
+            missing = cache.get_missing(uid, file_name, folder_name=folder)
+            if missing is not None and self._still_missing(cache, uid, folder, file_name, missing):
+                logger.debug("file was recently found missing")
+                if blank_on_404:
+                    callback(file_name, "")
+                    return
+                raise tornado.httpclient.HTTPError(404)
+
             logger.debug("retrieving file for first time")
-            response = yield tornado.gen.Task(self.dropbox_request,
+            response = yield tornado.gen.Task(self._traced_request, trace,
                     "api-content", "/1/files/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
                     access_token=self._get_access_token())
 
             try:
                 response.rethrow()
             except tornado.httpclient.HTTPError as e:
+                if e.code == 404:
+                    cache.add_missing(uid, file_name, datetime.datetime.now(), folder_name=folder)
                 if e.code == 404 and blank_on_404:
                     logger.debug("returning empty file from 404, expect to create it soon")
                     callback(file_name, "")
@@ -301,66 +672,216 @@ class DropboxAPIMixin(DropboxMixin):
                     raise
 
             # grab metadata from header, insert new row into cache
-            metadata = json.loads(response.headers["x-dropbox-metadata"])
+            with trace.span("json.decode"):
+                metadata = json.loads(response.headers["x-dropbox-metadata"])
 
-            cache.add_file(uid, file_name, datetime.datetime.now(), json.dumps(metadata), response.body)
+            if missing is not None:
+                cache.remove_missing(uid, file_name, folder_name=folder)
+            cache.add_file(uid, file_name, datetime.datetime.now(), metadata, response.body, folder_name=folder)
 
             callback(file_name, response.body)
         else:
-            if datetime.datetime.now() - f["file_metadata_ts"] > cache.timeout:
+            if datetime.datetime.now() - f["file_metadata_ts"] > cache.ttl(uid, file_name, folder_name=folder):
                 logger.debug("requesting new metadata")
-                response = yield tornado.gen.Task(self.dropbox_request,
+                response = yield tornado.gen.Task(self._traced_request, trace,
                         "api", "/1/metadata/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
                         access_token=self._get_access_token(),
                         list="false")
 
-                response.rethrow()
+                try:
+                    response.rethrow()
+                except tornado.httpclient.HTTPError as e:
+                    if e.code != 404:
+                        raise
+                    logger.debug("file has been deleted")
+                    cache.remove_file(uid, file_name, folder_name=folder)
+                    cache.add_missing(uid, file_name, datetime.datetime.now(), folder_name=folder)
+                    if blank_on_404:
+                        callback(file_name, "")
+                        return
+                    raise
 
                 # grab metadata from response, compare rev to cache metadata rev
                 # do GET if rev does not match, callback to _on_updated_data
                 # otherwise update metadata timestamp in cache and render from cached value
-                metadata = json.load(response.buffer)
+                with trace.span("json.decode"):
+                    metadata = json.load(response.buffer)
 
                 local_rev = f["file_metadata"]["rev"]
                 remote_rev = metadata["rev"]
+                cache.observe(uid, local_rev != remote_rev, file_name, folder_name=folder)
 
                 if local_rev == remote_rev:
                     logger.debug("new metadata has same rev, updating timestamp and rendering local data")
-                    cache.update_file_timestamp(uid, file_name, datetime.datetime.now())
+                    cache.update_file_timestamp(uid, file_name, datetime.datetime.now(), folder_name=folder)
                     callback(file_name, f["file_data"])
                 else:
                     logger.debug("retrieving updated copy of file")
-                    response = yield tornado.gen.Task(self.dropbox_request,
+                    response = yield tornado.gen.Task(self._traced_request, trace,
                             "api-content", "/1/files/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
                             access_token=self._get_access_token())
 
                     response.rethrow()
 
                     # grab metadata from header, update cache
-                    metadata = json.loads(response.headers["x-dropbox-metadata"])
+                    with trace.span("json.decode"):
+                        metadata = json.loads(response.headers["x-dropbox-metadata"])
 
-                    cache.update_file(uid, file_name, datetime.datetime.now(), json.dumps(metadata), response.body)
+                    cache.update_file(uid, file_name, datetime.datetime.now(), metadata, response.body, folder_name=folder)
 
                     callback(file_name, response.body)
             else:
                 logger.debug("under timeout, using old data")
                 callback(file_name, f["file_data"])
 
-    @tornado.web.authenticated
-    @tornado.web.asynchronous
+    @_operation
     @tornado.gen.engine
-    def upload_data(self, file_name, data, callback):
-        """Upload new data to the specified file, creating it if it does not exist.
+    def _get_data_range(self, file_name, start, stop, callback):
+        """Implementation of partial reads; see DropboxAPIMixin.write_data and client.DropboxClient.get_data_range.
 
-        file_name - the filename to upload to
-        data - the new file data
-        callback - callback that will receive the filename
+        start and stop are slice bounds as for Cache.get_data_range; callback receives the data,
+        the offset of its first byte, and the size of the whole file. Fresh cached files are
+        sliced in the cache, and stale ones are revalidated as in get_data. Files that are not
+        cached have only the range retrieved, and are then retrieved whole in the background.
 
         """
-        cache = self._get_cache()
-        uid = self.current_user["uid"]
+        if (start < 0 and stop is not None) or (stop is not None and stop <= start):
+            raise ValueError("unsupported range %r:%r" % (start, stop))
+
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("get_data_range", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+
+        pending = self._pending_write(uid, folder, file_name)
+        if pending is not None:
+            first, last, _ = slice(start, stop).indices(len(pending))
+            callback(pending[first:last], first, len(pending))
+            return
+
+        f = cache.get_file_metadata(uid, file_name, folder_name=folder)
+        if f and datetime.datetime.now() - f["file_metadata_ts"] <= cache.ttl(uid, file_name, folder_name=folder):
+            part = cache.get_data_range(uid, file_name, start, stop, folder_name=folder)
+            if part is not None:
+                callback(*part)
+                return
+
+        if f:
+            res = yield tornado.gen.Task(self._get_data, file_name)
+            data = res[0][1]
+            first, last, _ = slice(start, stop).indices(len(data))
+            callback(data[first:last], first, len(data))
+            return
+
+        missing = cache.get_missing(uid, file_name, folder_name=folder)
+        if missing is not None and self._still_missing(cache, uid, folder, file_name, missing):
+            logger.debug("file was recently found missing")
+            raise tornado.httpclient.HTTPError(404)
+
+        logger.debug("retrieving range of uncached file")
+        response = yield tornado.gen.Task(self._traced_request, trace,
+                "api-content", "/1/files/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
+                access_token=self._get_access_token(),
+                headers={ "Range" : _range_header(start, stop) })
+
+        try:
+            response.rethrow()
+        except tornado.httpclient.HTTPError as e:
+            if e.code == 404:
+                cache.add_missing(uid, file_name, datetime.datetime.now(), folder_name=folder)
+            elif e.code == 416:
+                content_range = _parse_content_range(response.headers.get("Content-Range"))
+                if content_range is not None:
+                    callback("", content_range[1], content_range[1])
+                    return
+            raise
+
+        if response.code == 206:
+            content_range = _parse_content_range(response.headers.get("Content-Range"))
+            if content_range is None or content_range[0] is None:
+                raise tornado.httpclient.HTTPError(502, "bad Content-Range from Dropbox")
+            self._fill_in_background(file_name)
+            callback(response.body, content_range[0], content_range[1])
+            return
+
+        # the whole file was returned, so cache it as get_data does
+        with trace.span("json.decode"):
+            metadata = json.loads(response.headers["x-dropbox-metadata"])
 
-        f = cache.get_file(uid, file_name)
+        if missing is not None:
+            cache.remove_missing(uid, file_name, folder_name=folder)
+        cache.add_file(uid, file_name, datetime.datetime.now(), metadata, response.body, folder_name=folder)
+
+        first, last, _ = slice(start, stop).indices(len(response.body))
+        callback(response.body[first:last], first, len(response.body))
+
+    def _fill_in_background(self, file_name):
+        """Retrieve a whole file into the cache, independently of the current request; does nothing if already in progress."""
+        key = (self._get_uid(), self._get_folder_path(), file_name)
+        if key in _background_fills:
+            return
+        _background_fills.add(key)
+
+        def on_data(name, data):
+            _background_fills.discard(key)
+
+        def on_error(typ, value, tb):
+            _background_fills.discard(key)
+            logger.warning("background retrieval of %s failed: %s", file_name, value)
+            return True
+
+        logger.debug("retrieving %s in the background", file_name)
+        with tornado.stack_context.NullContext():
+            with tornado.stack_context.ExceptionStackContext(on_error):
+                self._detached()._get_data(file_name, on_data)
+
+    def _still_missing(self, cache, uid, folder, file_name, missing):
+        """Return True if a file found missing at the given time can still be assumed missing.
+
+        It can't once negative_timeout has passed, or if a listing of its folder retrieved since
+        then contains it.
+
+        """
+        if datetime.datetime.now() - missing > cache.negative_timeout:
+            return False
+
+        parent, name = posixpath.split(file_name.strip("/"))
+        # only load the listing if it was retrieved after the file was found missing
+        listed = cache.get_folder_timestamp(uid, folder_name=self._subfolder_path(folder, parent))
+        if listed is not None and listed > missing:
+            user = cache.get_user(uid, folder_name=self._subfolder_path(folder, parent))
+            names = self._listing_from_user(user, self._subfolder_path(folder, parent))["names"]
+            # Dropbox names are case-insensitive, and so are listing names
+            i = bisect.bisect_left(names, name.lower())
+            if i < len(names) and names[i] == name.lower():
+                logger.debug("file found missing has since been listed")
+                cache.remove_missing(uid, file_name, folder_name=folder)
+                return False
+        return True
+
+    @_operation
+    @tornado.gen.engine
+    def _upload_data(self, file_name, data, callback):
+        """Implementation of upload_data; see DropboxAPIMixin.upload_data."""
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        queue = self._get_write_behind()
+        trace = self._start_trace("upload_data" if queue is None else "write_behind_save", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+
+        if queue is not None:
+            logger.debug("queueing upload of %s", file_name)
+            # the cache keeps the uploaded data; reads get the new data from the queue until it is uploaded
+            f = cache.get_file_metadata(uid, file_name, folder_name=folder)
+            parent_rev = f["file_metadata"]["rev"] if f else None
+            # the upload happens after this request has finished, so it can't run on the handler
+            queue.save((uid, folder, file_name), data, functools.partial(self._detached()._write_behind_upload, file_name), parent_rev)
+            callback(file_name)
+            return
+
+        f = cache.get_file(uid, file_name, folder_name=folder)
 
         logger.debug("uploading new %s file: '%s'", file_name, data)
         if f:
@@ -369,12 +890,12 @@ class DropboxAPIMixin(DropboxMixin):
 
         response = None
         if f:
-            response = yield tornado.gen.Task(self.dropbox_request,
+            response = yield tornado.gen.Task(self._traced_request, trace,
                     "api-content", "/1/files_put/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
                     access_token=self._get_access_token(),
                     put_body=data, parent_rev=f["file_metadata"]["rev"])
         else:
-            response = yield tornado.gen.Task(self.dropbox_request,
+            response = yield tornado.gen.Task(self._traced_request, trace,
                     "api-content", "/1/files_put/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
                     access_token=self._get_access_token(),
                     put_body=data)
@@ -382,39 +903,93 @@ class DropboxAPIMixin(DropboxMixin):
         response.rethrow()
 
         if not f:
-            response = yield tornado.gen.Task(self.dropbox_request,
+            response = yield tornado.gen.Task(self._traced_request, trace,
                     "api-content", "/1/files/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
                     access_token=self._get_access_token())
 
             response.rethrow()
 
             # grab metadata from header, insert new row into cache
-            metadata = json.loads(response.headers["x-dropbox-metadata"])
+            with trace.span("json.decode"):
+                metadata = json.loads(response.headers["x-dropbox-metadata"])
 
-            cache.add_file(uid, file_name, datetime.datetime.now(), json.dumps(metadata), response.body)
-            cache.update_folder_metadata_timestamp(uid, datetime.datetime.min)
+            cache.add_file(uid, file_name, datetime.datetime.now(), metadata, response.body, folder_name=folder)
         else:
-            cache.update_file_timestamp(uid, file_name, datetime.datetime.min)
+            cache.update_file_timestamp(uid, file_name, datetime.datetime.min, folder_name=folder)
+        cache.remove_missing(uid, file_name, folder_name=folder)
+        # the listing has the file's size and rev, so it is out of date either way
+        self._invalidate_parent(cache, uid, folder, file_name)
 
         callback(file_name)
 
-    @tornado.web.authenticated
-    @tornado.web.asynchronous
+    @_operation
     @tornado.gen.engine
-    def move_file(self, file_name, new_file_name, callback):
-        """Move a file within the folder.
+    def _write_behind_upload(self, file_name, data, parent_rev, callback):
+        """Upload data saved by write-behind; callback receives the new rev.
 
-        file_name - file to move
-        new_file_name - new filename
-        callback - will be called when complete
+        The cache is updated from the metadata returned by files_put, unless newer data has been
+        saved since or the file has been deleted during the upload. Raises WriteConflictError if
+        Dropbox saved the data under another name.
 
         """
-        cache = self._get_cache()
-        uid = self.current_user["uid"]
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("write_behind_upload", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+
+        logger.debug("uploading %s from write-behind, parent rev %s", file_name, parent_rev)
+        args = dict(put_body=data)
+        if parent_rev is not None:
+            args["parent_rev"] = parent_rev
+        response = yield tornado.gen.Task(self._traced_request, trace,
+                "api-content", "/1/files_put/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
+                access_token=self._get_access_token(),
+                **args)
+
+        response.rethrow()
+
+        with trace.span("json.decode"):
+            metadata = json.load(response.buffer)
+
+        self._invalidate_parent(cache, uid, folder, file_name)
+
+        if metadata["path"].strip("/").lower() != self._subfolder_path(folder, file_name).strip("/").lower():
+            # the file was changed elsewhere, so Dropbox kept both copies; the next read gets theirs
+            cache.remove_file(uid, file_name, folder_name=folder)
+            raise WriteConflictError(metadata["path"])
+
+        # once the file is deleted or saved again, this data is gone or about to be replaced
+        pending = self._pending_write(uid, folder, file_name)
+        if pending is data:
+            cache.remove_missing(uid, file_name, folder_name=folder)
+            if cache.get_file_metadata(uid, file_name, folder_name=folder):
+                cache.update_file(uid, file_name, datetime.datetime.now(), metadata, data, folder_name=folder)
+            else:
+                cache.add_file(uid, file_name, datetime.datetime.now(), metadata, data, folder_name=folder)
+
+        callback(metadata["rev"])
+
+    @_operation
+    @tornado.gen.engine
+    def _move_file(self, file_name, new_file_name, callback):
+        """Implementation of move_file; see DropboxAPIMixin.move_file."""
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("move_file", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
 
         logger.debug("moving %s to %s", file_name, new_file_name)
 
-        response = yield tornado.gen.Task(self.dropbox_request,
+        queue = self._get_write_behind()
+        if queue is not None:
+            # upload the latest data before moving it; anything saved to the destination is overwritten
+            yield tornado.gen.Task(queue.flush, keys=[(uid, folder, file_name)])
+            queue.discard((uid, folder, new_file_name))
+            yield tornado.gen.Task(queue.wait, (uid, folder, new_file_name))
+
+        response = yield tornado.gen.Task(self._traced_request, trace,
                 "api", "/1/fileops/move",
                 access_token=self._get_access_token(),
                 post_args={ "root" : self._get_api_type(), "from_path" : "%s/%s" % (self._get_folder_path(), file_name), "to_path" : "%s/%s" % (self._get_folder_path(), new_file_name) })
@@ -422,14 +997,301 @@ class DropboxAPIMixin(DropboxMixin):
         response.rethrow()
 
         # remove the old one, and just get the new one next time we request it
-        cache.remove_file(uid, file_name)
-        cache.update_folder_metadata_timestamp(uid, datetime.datetime.min)
+        cache.remove_file(uid, file_name, folder_name=folder)
+        cache.add_missing(uid, file_name, datetime.datetime.now(), folder_name=folder)
+        cache.remove_missing(uid, new_file_name, folder_name=folder)
+        self._invalidate_parent(cache, uid, folder, file_name)
+        self._invalidate_parent(cache, uid, folder, new_file_name)
 
         callback()
 
+    @_operation
+    @tornado.gen.engine
+    def _delete_file(self, file_name, callback):
+        """Implementation of delete_file; see DropboxAPIMixin.delete_file."""
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("delete_file", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+
+        logger.debug("deleting %s", file_name)
+
+        queue = self._get_write_behind()
+        if queue is not None:
+            # an upload already in flight would re-create the file if it completed after the delete
+            queue.discard((uid, folder, file_name))
+            yield tornado.gen.Task(queue.wait, (uid, folder, file_name))
+
+        response = yield tornado.gen.Task(self._traced_request, trace,
+                "api", "/1/fileops/delete",
+                access_token=self._get_access_token(),
+                post_args={ "root" : self._get_api_type(), "path" : "%s/%s" % (self._get_folder_path(), file_name) })
+
+        response.rethrow()
+
+        # remove the file, and just get a new folder list next time it's requested
+        cache.remove_file(uid, file_name, folder_name=folder)
+        cache.add_missing(uid, file_name, datetime.datetime.now(), folder_name=folder)
+        self._invalidate_parent(cache, uid, folder, file_name)
+
+        callback()
+
+    def _invalidate_parent(self, cache, uid, folder, file_name):
+        """Make the next listing of the folder containing file_name revalidate with Dropbox."""
+        parent = posixpath.dirname(file_name.strip("/"))
+        cache.update_folder_metadata_timestamp(uid, datetime.datetime.min, folder_name=self._subfolder_path(folder, parent))
+        cache.get_path_tree(uid, folder_name=folder).invalidate(parent)
+
+    def invalidate_folder(self, path="", subtree=False):
+        """Make the next listing of a subfolder revalidate with Dropbox.
+
+        path - the subfolder, relative to the folder; default '', the folder itself
+        subtree - also revalidate every subfolder below it in the next get_files_recursive; default False
+
+        """
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        cache = self._get_cache()
+
+        cache.update_folder_metadata_timestamp(uid, datetime.datetime.min, folder_name=self._subfolder_path(folder, path))
+        cache.get_path_tree(uid, folder_name=folder).invalidate(path, subtree=subtree)
+
+class DropboxAPIMixin(DropboxOperations):
+    """High level Dropbox API access for a single folder, built on top of async_dropbox.DropboxMixin and Cache.
+
+    Provides listing (of the folder, or recursively of a subtree), file retrieval, upload, move, and
+    remove operations. All operations will update the cache automatically if the
+    dropbox_folder_path cookie is detected to have changed.
+
+    Uses keys from the settings dict as follows:
+    dropbox_api_type - must be 'sandbox' or 'dropbox'; default 'sandbox'
+    dropbox_cache - an object implementing methods from tornado_dropcache.Cache; default is an EmptyCache using dropbox_folder_path
+    dropbox_tracer - a tracing.Tracer to record a trace of each operation; default is no tracing
+    dropbox_write_behind - a write_behind.WriteBehindQueue to debounce uploads through; default None, upload_data uploads straight away
+    dropbox_recorder - a replay.TraceRecorder to record the cache and Dropbox traffic into; default None, nothing is recorded
+    dropbox_tree_concurrency - the most subfolders get_files_recursive revalidates at once; default 4
+
+    Uses secure cookies as follows:
+    dropbox_folder_path - the path (relative to dropbox api type) of the folder that this app is managing; default is empty string
+
+    """
+
+    def _get_uid(self):
+        return self.current_user["uid"]
+
+    def _get_access_token(self):
+        """Helper function to get the Dropbox access token for API calls."""
+
+        # json turns this into unicode strings, but we need bytes for oauth signatures.
+        return dict((utf8(k), utf8(v)) for (k, v) in self.current_user["access_token"].iteritems())
+
+    def _get_folder_path(self):
+        if not self.get_secure_cookie("dropbox_folder_path"):
+            return ""
+        else:
+            return self.get_secure_cookie("dropbox_folder_path")
+
+    def _detached(self):
+        # imported here since client imports this module
+        from client import DropboxClient
+        return DropboxClient.from_handler(self)
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def get_files(self, callback, sort="name", reverse=False, offset=0, limit=None, prefix=None, details=False):
+        """Retrieve a sequence of filenames in the folder under consideration.
+        
+        Filenames are returned with the folder path stripped off. The listing is precomputed
+        when the folder metadata is stored, so sorting and paging only cost the size of the page.
+
+        callback - callback that will receive the filename sequence
+        sort - sort by 'name', 'size' or 'modified'; default 'name'
+        reverse - sort in descending order; default False
+        offset - number of files to skip; default 0
+        limit - maximum number of files to return; default None, no limit
+        prefix - only return files whose name starts with this, ignoring case; default None, all files
+        details - return entry dicts (see listing.py) rather than filenames; default False
+
+        Sorting by name ignores case (falling back to case for names that differ only in case),
+        which need not be the order Dropbox lists the folder contents in.
+        
+        """
+        self._get_files(callback, sort=sort, reverse=reverse, offset=offset, limit=limit, prefix=prefix, details=details)
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def get_files_recursive(self, callback, path="", details=False):
+        """Retrieve a sequence of the paths of all files and folders in a subtree of the folder.
+
+        Paths are relative to the folder under consideration. Each subfolder's listing is cached
+        like the folder's own (under its own folder name), and indexed in the cache's in-memory
+        path tree, so only subfolders that have timed out or been invalidated are revalidated,
+        concurrently (at most dropbox_tree_concurrency at a time), and those that are unchanged
+        cost a 304 response. A subfolder deleted since its parent was listed is left out, and its
+        parent is revalidated next time.
+
+        callback - callback that will receive the path sequence
+        path - the subfolder to list, relative to the folder; default '', the whole folder
+        details - return entry dicts (see listing.py, with an added 'path' key) rather than paths; default False
+
+        """
+        self._get_files_recursive(callback, path=path, details=details)
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def get_data(self, file_name, callback, blank_on_404=False):
+        """Retrieve the file data for a specified file.
+
+        file_name - the file to retrieve
+        callback - callback that will receive the file name and data
+        blank_on_404 - return a blank file on a 404 error; use when planning to upload a new file in the next step
+
+        Files found missing are remembered for the cache's negative_timeout, so repeated lookups
+        of a missing file are answered (with a blank file or a 404 HTTPError) without a request.
+
+        """
+        self._get_data(file_name, callback, blank_on_404=blank_on_404)
+
+    def _accepts_encoding(self, encoding):
+        """Return True if the request's Accept-Encoding header allows the given content coding."""
+        for accepted in self.request.headers.get("Accept-Encoding", "").split(","):
+            params = [p.strip() for p in accepted.split(";")]
+            if params[0].lower() != encoding:
+                continue
+            for param in params[1:]:
+                if param.replace(" ", "").startswith("q="):
+                    try:
+                        return float(param.split("=", 1)[1]) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def _if_range_matches(self, cache, uid, file_name, folder):
+        """Return True if the request has no If-Range header, or one matching the cached file's rev."""
+        if_range = self.request.headers.get("If-Range")
+        if not if_range:
+            return True
+        f = cache.get_file_metadata(uid, file_name, folder_name=folder)
+        # ranges are sliced from the uncompressed data, so only the identity ETag matches
+        return f is not None and if_range == '"%s"' % f["file_metadata"]["rev"]
+
+    def _response_encoding(self, file_dict):
+        """Return the content coding write_data sends a cached file with, or None if it is sent as is.
+
+        file_dict - the file dict from the cache's get_file_metadata
+
+        """
+        encoding = file_dict["file_encoding"] if "file_encoding" in file_dict.keys() else None
+        if encoding is None or not self._accepts_encoding(encoding):
+            return None
+        if _parse_range(self.request.headers.get("Range")) is not None:
+            if_range = self.request.headers.get("If-Range")
+            if not if_range or if_range == '"%s"' % file_dict["file_metadata"]["rev"]:
+                return None
+        return encoding
+
     @tornado.web.authenticated
     @tornado.web.asynchronous
     @tornado.gen.engine
+    def write_data(self, file_name, callback):
+        """Write the file data for a specified file to the response.
+
+        If the cache stores the file compressed and the client accepts that encoding, the
+        compressed bytes are written as they are with a matching Content-Encoding header,
+        rather than decompressing them (and possibly compressing them again for the client).
+
+        A request with a single byte range in its Range header (and an If-Range header, if any,
+        matching the file's ETag as set by DropboxHTTPCacheMixin) gets a 206 response with just
+        that range, sliced from the cache; if the file is not cached yet, only the range is
+        retrieved before responding, and the whole file is cached in the background.
+
+        Data saved by write-behind and not uploaded yet is written whole, since it has no rev for
+        a range to be validated against.
+
+        file_name - the file to write
+        callback - callback that will receive the file name
+
+        """
+        cache = self._get_cache()
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+
+        self.set_header("Accept-Ranges", "bytes")
+        pending = self._pending_write(uid, folder, file_name)
+        if pending is not None:
+            self._record_operation("write_data", uid, file_name)
+            self.write(pending)
+            callback(file_name)
+            return
+
+        byte_range = _parse_range(self.request.headers.get("Range"))
+        if byte_range is not None and self._if_range_matches(cache, uid, file_name, folder):
+            res = yield tornado.gen.Task(self._get_data_range, file_name, byte_range[0], byte_range[1])
+            data, first, size = res[0]
+            if data:
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (first, first + len(data) - 1, size))
+                self.write(data)
+            else:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % size)
+            callback(file_name)
+            return
+
+        data = None
+        f = cache.get_file(uid, file_name, folder_name=folder)
+        if not f or datetime.datetime.now() - f["file_metadata_ts"] > cache.ttl(uid, file_name, folder_name=folder):
+            res = yield tornado.gen.Task(self.get_data, file_name)
+            data = res[0][1]
+        else:
+            self._record_operation("write_data", uid, file_name)
+
+        stored = cache.get_stored_data(uid, file_name, folder_name=folder)
+        self.set_header("Vary", "Accept-Encoding")
+        if stored is not None and stored[0] is not None and self._accepts_encoding(stored[0]):
+            logger.debug("writing %s data as stored", stored[0])
+            self.set_header("Content-Encoding", stored[0])
+            self.write(stored[1])
+        elif data is not None:
+            self.write(data)
+        else:
+            self.write(f["file_data"])
+
+        callback(file_name)
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def upload_data(self, file_name, data, callback):
+        """Upload new data to the specified file, creating it if it does not exist.
+
+        With dropbox_write_behind set, callback is called straight away and the upload happens
+        later, on a client.DropboxClient for the same user and folder; reads return the new data
+        until then, and the cache is only updated once it is uploaded. See
+        write_behind.WriteBehindQueue.
+
+        file_name - the filename to upload to
+        data - the new file data
+        callback - callback that will receive the filename
+
+        """
+        self._upload_data(file_name, data, callback)
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def move_file(self, file_name, new_file_name, callback):
+        """Move a file within the folder.
+
+        file_name - file to move
+        new_file_name - new filename
+        callback - will be called when complete
+
+        """
+        self._move_file(file_name, new_file_name, callback)
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
     def delete_file(self, file_name, callback):
         """Delete a file within the folder.
 
@@ -437,20 +1299,189 @@ class DropboxAPIMixin(DropboxMixin):
         callback - will be called when complete
 
         """
-        cache = self._get_cache()
-        uid = self.current_user["uid"]
+        self._delete_file(file_name, callback)
+
+class DropboxHTTPCacheMixin(DropboxAPIMixin):
+    """Client side HTTP caching on top of DropboxAPIMixin.
+
+    Sets ETag and Last-Modified headers from the cached Dropbox rev (for files) or hash (for
+    the folder) and modified fields, and checks If-None-Match/If-Modified-Since against them
+    using only the cached metadata, so that unchanged files never have their data loaded.
+
+    Files that write_data will send compressed get the ETag of the rev with the content coding
+    appended (as in "<rev>-gzip"), since the bytes differ from the uncompressed response, and a
+    Vary: Accept-Encoding header; If-None-Match accepts either form.
+
+    Example usage::
+
+        class ViewHandler(DropboxUserHandler, DropboxHTTPCacheMixin):
+            @tornado.web.authenticated
+            @tornado.web.asynchronous
+            @tornado.gen.engine
+            def get(self, file_name):
+                not_modified = yield tornado.gen.Task(self.file_not_modified, file_name)
+                if not_modified:
+                    self.set_status(304)
+                    self.finish()
+                    return
 
-        logger.debug("deleting %s", file_name)
+                res = yield tornado.gen.Task(self.get_data, file_name)
+                self.set_file_cache_headers(file_name)
+                self.render("view.html", title=file_name, contents=res[0][1])
 
-        response = yield tornado.gen.Task(self.dropbox_request,
-                "api", "/1/fileops/delete",
-                access_token=self._get_access_token(),
-                post_args={ "root" : self._get_api_type(), "path" : "%s/%s" % (self._get_folder_path(), file_name) })
+    """
 
-        response.rethrow()
+    def _set_cache_headers(self, etag, modified, encoding=None):
+        """Set the ETag and (if known) Last-Modified headers; modified is a Dropbox date string.
 
-        # remove the file, and just get a new folder list next time it's requested
-        cache.remove_file(uid, file_name)
-        cache.update_folder_metadata_timestamp(uid, datetime.datetime.min)
+        encoding - the content coding of the response, appended to the ETag; default None, the data as is
 
-        callback()
+        """
+        if encoding is not None:
+            self.set_header("Etag", '"%s-%s"' % (etag, encoding))
+        else:
+            self.set_header("Etag", '"%s"' % etag)
+        if modified:
+            parsed = email.utils.parsedate_tz(modified)
+            if parsed:
+                self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(email.utils.mktime_tz(parsed)))
+
+    def _request_not_modified(self, etag, modified):
+        """Return True if the request's conditional headers match the given etag and modified date."""
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when If-None-Match is present
+            for tag in if_none_match.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                # a copy in any content coding is the same file
+                if tag == "*" or tag == '"%s"' % etag or tag.startswith('"%s-' % etag):
+                    return True
+            return False
+
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since is not None and modified:
+            since = email.utils.parsedate_tz(if_modified_since)
+            parsed = email.utils.parsedate_tz(modified)
+            if since and parsed:
+                return email.utils.mktime_tz(parsed) <= email.utils.mktime_tz(since)
+        return False
+
+    def set_file_cache_headers(self, file_name):
+        """Set ETag and Last-Modified headers for a file from its cached metadata, if it is cached.
+
+        Returns the cached metadata, or None if the file is not cached, or has data saved by
+        write-behind that is not uploaded yet.
+
+        """
+        if self._pending_write(self.current_user["uid"], self._get_folder_path(), file_name) is not None:
+            return None
+        f = self._get_cache().get_file_metadata(self.current_user["uid"], file_name, folder_name=self._get_folder_path())
+        if not f:
+            return None
+        self.set_header("Vary", "Accept-Encoding")
+        self._set_cache_headers(f["file_metadata"]["rev"], f["file_metadata"].get("modified"), self._response_encoding(f))
+        return f["file_metadata"]
+
+    def set_folder_cache_headers(self):
+        """Set ETag and Last-Modified headers for the folder listing from its cached metadata, if any.
+
+        Returns the cached metadata, or None if the folder has not been listed yet.
+
+        """
+        user = self._get_cache().get_user(self.current_user["uid"], folder_name=self._get_folder_path())
+        if "hash" not in user["folder_metadata"]:
+            return None
+        self._set_cache_headers(user["folder_metadata"]["hash"], user["folder_metadata"].get("modified"))
+        return user["folder_metadata"]
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    def file_not_modified(self, file_name, callback):
+        """Check whether the client's copy of a file is current, without loading the file data.
+
+        Sets ETag and Last-Modified headers if the file is cached. If the cached metadata has
+        timed out it is revalidated with a metadata request first; if the rev has changed, the
+        stale file is dropped from the cache so that a following get_data fetches it directly,
+        and if the file has been deleted it is also remembered as missing.
+
+        file_name - the file to check
+        callback - callback that will receive True if a 304 response can be sent
+
+        """
+        self._file_not_modified(file_name, callback)
+
+    @_operation
+    @tornado.gen.engine
+    def _file_not_modified(self, file_name, callback):
+        """Implementation of file_not_modified."""
+        uid = self._get_uid()
+        folder = self._get_folder_path()
+        trace = self._start_trace("file_not_modified", uid=uid, file_name=file_name)
+        callback = trace.wrap_callback(callback)
+        cache = trace.wrap_cache(self._get_cache())
+
+        f = cache.get_file_metadata(uid, file_name, folder_name=folder)
+        if not f or self._pending_write(uid, folder, file_name) is not None:
+            callback(False)
+            return
+
+        if datetime.datetime.now() - f["file_metadata_ts"] > cache.ttl(uid, file_name, folder_name=folder):
+            logger.debug("revalidating metadata for conditional request")
+            response = yield tornado.gen.Task(self._traced_request, trace,
+                    "api", "/1/metadata/%s/%s/%s" % (self._get_api_type(), quote(self._get_folder_path()), quote(file_name)),
+                    access_token=self._get_access_token(),
+                    list="false")
+
+            if response.code == 404:
+                logger.debug("file has been deleted")
+                cache.remove_file(uid, file_name, folder_name=folder)
+                cache.add_missing(uid, file_name, datetime.datetime.now(), folder_name=folder)
+                callback(False)
+                return
+            if response.error:
+                callback(False)
+                return
+
+            with trace.span("json.decode"):
+                metadata = json.load(response.buffer)
+            cache.observe(uid, metadata["rev"] != f["file_metadata"]["rev"], file_name, folder_name=folder)
+            if metadata["rev"] != f["file_metadata"]["rev"]:
+                logger.debug("rev changed, dropping cached file")
+                cache.remove_file(uid, file_name, folder_name=folder)
+                callback(False)
+                return
+
+            cache.update_file_timestamp(uid, file_name, datetime.datetime.now(), folder_name=folder)
+
+        self.set_header("Vary", "Accept-Encoding")
+        self._set_cache_headers(f["file_metadata"]["rev"], f["file_metadata"].get("modified"), self._response_encoding(f))
+        callback(self._request_not_modified(f["file_metadata"]["rev"], f["file_metadata"].get("modified")))
+
+    @tornado.web.authenticated
+    @tornado.web.asynchronous
+    @tornado.gen.engine
+    def folder_not_modified(self, callback):
+        """Check whether the client's copy of the folder listing is current.
+
+        Sets ETag and Last-Modified headers from the folder hash; if the cached folder metadata
+        has timed out it is revalidated through get_files first.
+
+        callback - callback that will receive True if a 304 response can be sent
+
+        """
+        cache = self._get_cache()
+        uid = self.current_user["uid"]
+        folder = self._get_folder_path()
+
+        user = cache.get_user(uid, folder_name=folder)
+        if datetime.datetime.now() - user["folder_metadata_ts"] > cache.ttl(uid, folder_name=folder):
+            yield tornado.gen.Task(self.get_files)
+
+        metadata = self.set_folder_cache_headers()
+        if metadata is None:
+            callback(False)
+            return
+
+        callback(self._request_not_modified(metadata["hash"], metadata.get("modified")))
@@ -0,0 +1,585 @@
+"""
+=========
+replay.py
+=========
+
+Recording of the cache and Dropbox traffic of DropboxAPIMixin into compact binary traces, and
+offline replay of those traces against any Cache implementation and TTL policy, to size and tune
+a cache without experimenting in production.
+
+Dependencies
+============
+
+Python (tested on 2.7.1).
+
+Usage
+=====
+
+Put a TraceRecorder into the application settings as dropbox_recorder (or pass it to a
+client.DropboxClient). Every operation, every Cache call and every Dropbox request is then
+appended to the trace file as a fixed size record; user ids and paths are only stored as hashes
+(salted, if a salt is given), so traces can be shared without exposing file names.
+
+::
+
+    recorder = TraceRecorder("/var/log/myapp/cache.trace", salt="<SECRET>")
+
+    settings = {
+        ...
+        "dropbox_recorder": recorder,
+    }
+
+A trace is replayed with replay, or from the command line; the result has the hit ratio, the
+number of simulated Dropbox API calls, and a timeline of those and the cache's memory use::
+
+    result = replay(read_trace("cache.trace"), DictCache("", ttl_policy=AdaptiveTTLPolicy()))
+    print result.format()
+
+    python replay.py cache.trace --cache sqlite --timeout 300 --adaptive
+
+Replay runs at full speed on the trace's clock: each recorded operation is simulated the way
+DropboxAPIMixin would run it against the given cache, and whether a file or folder has changed
+on Dropbox at that time is taken from the revs and contents seen in the trace. Only cache
+entries are simulated, so sizes are real but file data is filler. SqliteCache's max_age is
+measured against the real clock rather than the trace's, so only max_size bounds replay
+sensibly; the sweeper is replaced by calls to sweep at each timeline point.
+
+Trace format
+============
+
+A header of struct "<4sBd" (the magic DCTR, the format version and the start time in seconds
+since the epoch), then records of struct "<IBBHIQII":
+
+time - milliseconds since the start time, or since the last epoch record
+kind - 0 for an operation, 1 for a Cache call, 2 for a Dropbox request, 3 for an epoch record
+code - index of the operation, Cache method or request in OPERATIONS, CACHE_METHODS or REQUESTS; 255 if not listed
+status - for Cache calls 1 if a value was returned, otherwise 0; for requests the HTTP status code
+uid - 32 bit hash of the user id
+path - 64 bit hash of the file or folder path
+size - size in bytes of the file data or response involved, as stored by the cache for Cache calls
+version - 32 bit hash of the file's rev, or of the folder listing; 0 if not known
+
+Since time only counts about 49 days of milliseconds, a recorder running for longer writes an
+epoch record first, whose path is the milliseconds since the start time that the time of the
+following records counts from; its other fields are 0. Version 1 traces have no epoch records.
+
+Classes
+=======
+
+TraceRecorder
+    Writes a binary trace of operations, Cache calls and Dropbox requests.
+
+TraceEvent
+    A single record read back from a trace.
+
+ReplayResult
+    Hit ratio, simulated API calls and timeline of a replay.
+
+Functions
+=========
+
+read_trace
+    Yield the TraceEvents of a trace file.
+
+replay
+    Replay a trace against a cache.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+import json
+import zlib
+import bisect
+import struct
+import hashlib
+import logging
+import datetime
+import collections
+from urllib import unquote
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("<4sBd")
+RECORD = struct.Struct("<IBBHIQII")
+MAGIC = "DCTR"
+FORMAT_VERSION = 2
+# versions read_trace can read
+_FORMAT_VERSIONS = (1, 2)
+
+OPERATION, CACHE_CALL, REQUEST, EPOCH = range(4)
+
+OPERATIONS = ("get_files", "get_files_recursive", "get_data", "get_data_range", "write_data",
+        "upload_data", "write_behind_save", "write_behind_upload", "move_file", "delete_file", "file_not_modified")
+CACHE_METHODS = ("get_user", "update_folder_metadata", "update_folder_metadata_timestamp",
+        "get_file", "get_file_metadata", "get_stored_data", "get_data_range", "add_file", "update_file",
+        "update_file_timestamp", "remove_file", "get_missing", "add_missing", "remove_missing",
+        "clear_cache", "clear_folder", "remove_user", "get_folder_timestamp")
+REQUESTS = ("metadata", "files", "files_put", "fileops/move", "fileops/delete")
+
+_NAMES = (OPERATIONS, CACHE_METHODS, REQUESTS, ())
+_CODES = [dict((name, i) for (i, name) in enumerate(names)) for names in _NAMES]
+
+# Cache methods whose first arguments after the uid are a file name; the rest act on a folder
+_FILE_METHODS = frozenset(("get_file", "get_file_metadata", "get_stored_data", "get_data_range", "add_file",
+        "update_file", "update_file_timestamp", "remove_file", "get_missing", "add_missing", "remove_missing"))
+
+def _join(*parts):
+    """Normalise a Dropbox path, so that the same file always hashes the same."""
+    return "/".join(p for part in parts if part for p in part.split("/") if p).lower()
+
+def _version(value):
+    if value is None:
+        return 0
+    return zlib.crc32(value if isinstance(value, str) else value.encode("utf-8")) & 0xffffffff
+
+class TraceRecorder(object):
+    """Writes a binary trace of operations, Cache calls and Dropbox requests.
+
+    Recording never fails an operation: records that can't be written are dropped and counted
+    in errors, and only the first is logged.
+
+    """
+
+    def __init__(self, trace_file, salt=""):
+        """Construct a TraceRecorder.
+
+        trace_file - the file name to write the trace to, or a file object opened for binary writing
+        salt - string mixed into the uid and path hashes; default empty string
+
+        """
+        if isinstance(trace_file, basestring):
+            trace_file = open(trace_file, "wb")
+        self._file = trace_file
+        self._salt = salt
+        self._hashes = dict()
+        # milliseconds since start that record times count from
+        self._epoch = 0
+        # (cache, RecordingCache) for the cache wrapped last, so that it is wrapped only once
+        self._wrapped = (None, None)
+        self.errors = 0
+        self.start = time.time()
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.start))
+
+    def _hash(self, value):
+        value = value.encode("utf-8") if isinstance(value, unicode) else str(value)
+        if value not in self._hashes:
+            if len(self._hashes) > 100000:
+                self._hashes.clear()
+            self._hashes[value] = hashlib.md5(self._salt + value).digest()
+        return self._hashes[value]
+
+    def _write(self, kind, name, status, uid, path, size, version):
+        try:
+            elapsed = max(int((time.time() - self.start) * 1000), 0)
+            if not 0 <= elapsed - self._epoch <= 0xffffffff:
+                self._file.write(RECORD.pack(0, EPOCH, 0, 0, 0, elapsed, 0, 0))
+                self._epoch = elapsed
+            # the uid and path hashes are the first 4 and 8 bytes of their digests
+            self._file.write(RECORD.pack(elapsed - self._epoch, kind, _CODES[kind].get(name, 255),
+                    status, struct.unpack("<I", self._hash(uid)[:4])[0], struct.unpack("<Q", self._hash(path)[:8])[0],
+                    size & 0xffffffff, version))
+        except (struct.error, IOError, ValueError):
+            self.errors += 1
+            if self.errors == 1:
+                logger.exception("could not write to the trace; dropping records")
+
+    def record_operation(self, name, uid, path):
+        """Record the start of an operation on a file or folder path."""
+        self._write(OPERATION, name, 0, uid, _join(path), 0, 0)
+
+    def record_request(self, uid, path, kwargs, response):
+        """Record a Dropbox request made with dropbox_request, and its response."""
+        parts = path.split("/", 4)
+        name = parts[2]
+        if name == "fileops":
+            name = "fileops/%s" % parts[3]
+            post_args = kwargs.get("post_args") or {}
+            path = _join(post_args.get("from_path") or post_args.get("path"))
+        else:
+            path = _join(unquote(parts[4]) if len(parts) > 4 else "")
+
+        body = response.body if response.buffer is not None else None
+        version = 0
+        if response.code in (200, 206):
+            if "x-dropbox-metadata" in response.headers:
+                version = _version(json.loads(response.headers["x-dropbox-metadata"]).get("rev"))
+            elif name in ("files_put", "metadata") and kwargs.get("list") != "true":
+                version = _version(json.loads(body).get("rev"))
+            elif body:
+                version = _version(body)
+        self._write(REQUEST, name, response.code, uid, path, len(body or ""), version)
+
+    def wrap_cache(self, cache):
+        """Return a proxy for cache that records each call of the methods in CACHE_METHODS."""
+        wrapped, recording = self._wrapped
+        if wrapped is not cache:
+            recording = RecordingCache(cache, self)
+            self._wrapped = (cache, recording)
+        return recording
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class RecordingCache(object):
+    """Proxy for a Cache that records calls into a TraceRecorder."""
+
+    def __init__(self, cache, recorder):
+        self._cache = cache
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if name not in _CODES[CACHE_CALL]:
+            return attr
+
+        cache = self._cache
+        recorder = self._recorder
+        def recorded(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            try:
+                if name == "clear_cache":
+                    uid, folder, args = "", "", ()
+                elif name == "clear_folder":
+                    uid, folder, args = "", args[0], ()
+                else:
+                    uid, folder, args = args[0], kwargs.get("folder_name"), args[1:]
+                if folder is None:
+                    folder = cache.folder_name
+                path = _join(folder, args[0]) if name in _FILE_METHODS else _join(folder)
+                size, version = 0, 0
+                if name in ("add_file", "update_file"):
+                    size, version = len(args[3]), _version(args[2].get("rev"))
+                elif name in ("get_file", "get_file_metadata") and result:
+                    version = _version(result["file_metadata"].get("rev"))
+                    if name == "get_file":
+                        # the stored size, without decompressing the data
+                        stored = result.get("file_stored_data")
+                        size = len(stored if stored is not None else result["file_data"])
+                elif name == "get_stored_data" and result:
+                    size = len(result[1])
+                elif name == "get_data_range" and result:
+                    size = len(result[0])
+                recorder._write(CACHE_CALL, name, int(bool(result)), uid, path, size, version)
+            except Exception:
+                logger.exception("could not record cache call %s", name)
+            return result
+        return recorded
+
+TraceEvent = collections.namedtuple("TraceEvent", ("time", "kind", "name", "status", "uid", "path", "size", "version"))
+
+def read_trace(trace_file):
+    """Yield the TraceEvents of a trace file; trace_file is a file name or a file object opened for binary reading.
+
+    Times are in seconds since the epoch, and names are from OPERATIONS, CACHE_METHODS or
+    REQUESTS (None if not listed).
+
+    """
+    if isinstance(trace_file, basestring):
+        trace_file = open(trace_file, "rb")
+    magic, version, start = HEADER.unpack(trace_file.read(HEADER.size))
+    if magic != MAGIC or version not in _FORMAT_VERSIONS:
+        raise ValueError("not a version %s trace file" % " or ".join(str(v) for v in _FORMAT_VERSIONS))
+
+    epoch = 0
+    while True:
+        chunk = trace_file.read(RECORD.size * 4096)
+        for offset in xrange(0, len(chunk) - RECORD.size + 1, RECORD.size):
+            t, kind, code, status, uid, path, size, version = RECORD.unpack_from(chunk, offset)
+            if kind == EPOCH:
+                epoch = path
+                continue
+            names = _NAMES[kind]
+            yield TraceEvent(start + (epoch + t) / 1000.0, kind, names[code] if code < len(names) else None, status, uid, path, size, version)
+        if len(chunk) < RECORD.size * 4096:
+            return
+
+class ReplayResult(object):
+    """Hit ratio, simulated API calls and timeline of a replay.
+
+    reads - number of file and folder reads replayed
+    hits - reads answered from the cache without a request, including files known to be missing
+    revalidations - reads of stale entries that Dropbox reported unchanged
+    misses - reads that retrieved the file or listing
+    api_calls - number of simulated Dropbox requests, including writes
+    timeline - list of (time, hit ratio so far, api calls so far, memory in bytes) tuples
+
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.timeline = []
+
+    @property
+    def hit_ratio(self):
+        if not self.reads:
+            return 0.0
+        return float(self.hits) / self.reads
+
+    def format(self):
+        """Return a multi-line summary, with the timeline."""
+        lines = ["reads %d, hits %d (%.1f%%), revalidations %d, misses %d, api calls %d" %
+                (self.reads, self.hits, self.hit_ratio * 100, self.revalidations, self.misses, self.api_calls)]
+        for t, hit_ratio, api_calls, memory in self.timeline:
+            lines.append("%s  hit ratio %5.1f%%  api calls %8d  memory %10d" %
+                    (datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S"), hit_ratio * 100, api_calls, memory))
+        return "\n".join(lines)
+
+class _Simulator(object):
+    """Replays operations against a cache, keyed by the hashes from the trace."""
+
+    # an operation's own requests follow it in the trace, so look this far ahead for the version it saw
+    LOOKAHEAD = 5.0
+    DELETED = None
+
+    def __init__(self, events, cache):
+        self.cache = cache
+        self.result = ReplayResult()
+        self.sizes = dict()
+        self.operations = []
+        versions = collections.defaultdict(list)
+        for event in events:
+            if event.kind == OPERATION:
+                self.operations.append(event)
+            elif event.kind == REQUEST and event.status == 404:
+                versions[event.path].append((event.time, self.DELETED, 0))
+            elif event.version and (event.kind == REQUEST or event.name in ("add_file", "update_file")):
+                versions[event.path].append((event.time, event.version, event.size))
+        self.versions = dict((path, (map(lambda v: v[0], vs), vs)) for (path, vs) in versions.iteritems())
+
+    def _upstream(self, path, t):
+        """Return the (version, size) of a path on Dropbox at time t, as far as the trace shows."""
+        if path not in self.versions:
+            return 0, 0
+        times, entries = self.versions[path]
+        i = bisect.bisect_right(times, t + self.LOOKAHEAD)
+        _, version, size = entries[max(i - 1, 0)]
+        return version, size
+
+    def _keys(self, event):
+        return "%08x" % event.uid, "%016x" % event.path
+
+    def _store(self, uid, name, now, version, size, update):
+        metadata = { "rev" : "%08x" % version }
+        data = " " * size
+        if update:
+            self.cache.update_file(uid, name, now, metadata, data, folder_name="")
+        else:
+            self.cache.add_file(uid, name, now, metadata, data, folder_name="")
+        self.sizes[(uid, name)] = size
+
+    def _forget(self, uid, name):
+        self.cache.remove_file(uid, name, folder_name="")
+        self.sizes.pop((uid, name), None)
+
+    def read_file(self, event, now):
+        cache, result = self.cache, self.result
+        uid, name = self._keys(event)
+        version, size = self._upstream(event.path, event.time)
+        result.reads += 1
+
+        f = cache.get_file_metadata(uid, name, folder_name="")
+        if f is None:
+            missing = cache.get_missing(uid, name, folder_name="")
+            if missing is not None and now - missing <= cache.negative_timeout:
+                result.hits += 1
+                return
+            result.misses += 1
+            result.api_calls += 1
+            if version is self.DELETED:
+                cache.add_missing(uid, name, now, folder_name="")
+            else:
+                if missing is not None:
+                    cache.remove_missing(uid, name, folder_name="")
+                self._store(uid, name, now, version, size, False)
+        elif now - f["file_metadata_ts"] <= cache.ttl(uid, name, folder_name=""):
+            result.hits += 1
+        else:
+            result.api_calls += 1
+            if version is self.DELETED:
+                result.misses += 1
+                self._forget(uid, name)
+                cache.add_missing(uid, name, now, folder_name="")
+            elif f["file_metadata"]["rev"] == "%08x" % version:
+                result.revalidations += 1
+                cache.observe(uid, False, name, folder_name="")
+                cache.update_file_timestamp(uid, name, now, folder_name="")
+            else:
+                result.misses += 1
+                result.api_calls += 1
+                cache.observe(uid, True, name, folder_name="")
+                self._store(uid, name, now, version, size, True)
+
+    def check_file(self, event, now):
+        """Simulate file_not_modified, which only revalidates files that are cached, without retrieving them."""
+        cache, result = self.cache, self.result
+        uid, name = self._keys(event)
+        f = cache.get_file_metadata(uid, name, folder_name="")
+        if f is None:
+            return
+        version, size = self._upstream(event.path, event.time)
+        result.reads += 1
+
+        if now - f["file_metadata_ts"] <= cache.ttl(uid, name, folder_name=""):
+            result.hits += 1
+            return
+        result.api_calls += 1
+        if version is self.DELETED:
+            result.misses += 1
+            self._forget(uid, name)
+            cache.add_missing(uid, name, now, folder_name="")
+        elif f["file_metadata"]["rev"] == "%08x" % version:
+            result.revalidations += 1
+            cache.observe(uid, False, name, folder_name="")
+            cache.update_file_timestamp(uid, name, now, folder_name="")
+        else:
+            result.misses += 1
+            cache.observe(uid, True, name, folder_name="")
+            self._forget(uid, name)
+
+    def read_folder(self, event, now):
+        cache, result = self.cache, self.result
+        uid, name = self._keys(event)
+        version, size = self._upstream(event.path, event.time)
+        result.reads += 1
+
+        user = cache.get_user(uid, folder_name=name)
+        if now - user["folder_metadata_ts"] <= cache.ttl(uid, folder_name=name):
+            result.hits += 1
+            return
+        result.api_calls += 1
+        if user["folder_metadata_ts"] != datetime.datetime.min and user["folder_metadata"].get("hash") == "%08x" % version:
+            result.revalidations += 1
+            cache.observe(uid, False, folder_name=name)
+            cache.update_folder_metadata_timestamp(uid, now, folder_name=name)
+        else:
+            result.misses += 1
+            if user["folder_metadata_ts"] != datetime.datetime.min:
+                cache.observe(uid, True, folder_name=name)
+            cache.update_folder_metadata(uid, now, { "hash" : "%08x" % version, "contents" : [] }, folder_name=name)
+
+    def write_file(self, event, now):
+        cache, result = self.cache, self.result
+        uid, name = self._keys(event)
+        version, size = self._upstream(event.path, event.time)
+        cached = cache.get_file_metadata(uid, name, folder_name="") is not None
+
+        result.api_calls += 1
+        if event.name == "upload_data" and not cached:
+            # upload_data retrieves files that were not cached after uploading them
+            result.api_calls += 1
+        cache.remove_missing(uid, name, folder_name="")
+        self._store(uid, name, now, version, size, cached)
+
+    def remove_file(self, event, now):
+        uid, name = self._keys(event)
+        self.result.api_calls += 1
+        self._forget(uid, name)
+        self.cache.add_missing(uid, name, now, folder_name="")
+
+    def memory(self):
+        if hasattr(self.cache, "database_size"):
+            return self.cache.database_size()
+        return sum(self.sizes.itervalues())
+
+def replay(events, cache, interval=datetime.timedelta(minutes=5)):
+    """Replay a trace against a cache, and return a ReplayResult.
+
+    events - the TraceEvents of the trace, as from read_trace
+    cache - the Cache implementation to replay against, with the TTL policy to evaluate; it should be empty
+    interval - trace time between timeline points, a timedelta; default 5 minutes
+
+    """
+    simulator = _Simulator(events, cache)
+    result = simulator.result
+    step = interval.days * 86400 + interval.seconds + interval.microseconds / 1e6
+    # write_behind_save only queues the data; the cache is written by write_behind_upload
+    handlers = {
+            "get_files" : simulator.read_folder,
+            "get_files_recursive" : simulator.read_folder,
+            "get_data" : simulator.read_file,
+            "get_data_range" : simulator.read_file,
+            "write_data" : simulator.read_file,
+            "upload_data" : simulator.write_file,
+            "write_behind_upload" : simulator.write_file,
+            "move_file" : simulator.remove_file,
+            "delete_file" : simulator.remove_file,
+            "file_not_modified" : simulator.check_file,
+            }
+
+    next_point = None
+    for event in simulator.operations:
+        if next_point is None:
+            next_point = event.time + step
+        while event.time >= next_point:
+            if hasattr(cache, "sweep"):
+                cache.sweep()
+            result.timeline.append((next_point, result.hit_ratio, result.api_calls, simulator.memory()))
+            next_point += step
+        handler = handlers.get(event.name)
+        if handler is not None:
+            handler(event, datetime.datetime.fromtimestamp(event.time))
+
+    if simulator.operations:
+        result.timeline.append((simulator.operations[-1].time, result.hit_ratio, result.api_calls, simulator.memory()))
+    return result
+
+def main(argv=None):
+    import argparse
+    from cache import DictCache, EmptyCache
+    from ttl_policy import AdaptiveTTLPolicy
+
+    parser = argparse.ArgumentParser(description="Replay a cache trace recorded by TraceRecorder.")
+    parser.add_argument("trace", help="trace file to replay")
+    parser.add_argument("--cache", choices=("dict", "sqlite", "empty"), default="dict", help="cache implementation; default dict")
+    parser.add_argument("--timeout", type=float, default=60, help="cache timeout in seconds; default 60")
+    parser.add_argument("--negative-timeout", type=float, default=10, help="negative cache timeout in seconds; default 10")
+    parser.add_argument("--adaptive", action="store_true", help="use an AdaptiveTTLPolicy")
+    parser.add_argument("--max-size", type=int, help="SqliteCache max_size in bytes")
+    parser.add_argument("--interval", type=float, default=300, help="seconds of trace time between timeline points; default 300")
+    args = parser.parse_args(argv)
+
+    timeout = datetime.timedelta(seconds=args.timeout)
+    negative_timeout = datetime.timedelta(seconds=args.negative_timeout)
+    ttl_policy = AdaptiveTTLPolicy() if args.adaptive else None
+    if args.cache == "sqlite":
+        from sqlite_cache import SqliteCache
+        cache = SqliteCache("", timeout=timeout, cache_file_name=":memory:", max_size=args.max_size, ttl_policy=ttl_policy, negative_timeout=negative_timeout)
+    elif args.cache == "empty":
+        cache = EmptyCache("")
+    else:
+        cache = DictCache("", timeout=timeout, ttl_policy=ttl_policy, negative_timeout=negative_timeout)
+
+    print replay(read_trace(args.trace), cache, interval=datetime.timedelta(seconds=args.interval)).format()
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,23 @@ Classes
 SqliteCache (sqlite_cache.py)
     A Cache implementation that uses the sqlite3 package and bindings.
 
+Usage
+=====
+
+By default the database only shrinks when files or users are removed. Pass max_size and/or
+max_age to bound it, and call start_sweeper to evict rows in small batches on the Tornado IOLoop;
+files that have gone longest without being read are evicted first, and the freed pages are
+handed back to the filesystem a few at a time with incremental vacuum.
+
+Folder listings are only read and decoded when they are used, and then kept in memory for the
+most recently used folders until the folder is listed again, so listing a folder whose listing
+is still fresh does not decode it again.
+
+::
+
+    cache = SqliteCache("<folder path>", max_size=256 * 1024 * 1024, max_age=datetime.timedelta(days=7))
+    cache.start_sweeper()
+
 Contributing
 ============
 
@@ -43,22 +60,115 @@ limitations under the License.
 
 import sqlite3
 import json
+import random
+import marshal
+import logging
 import datetime
+import collections
+
+from cache import Cache, FileDict
+
+logger = logging.getLogger(__name__)
+
+# marks metadata stored with marshal; rows written by older versions hold JSON text
+_MARSHAL_PREFIX = "\x00"
+
+class LazyMetadata(collections.Mapping):
+    """Read-only dict view of stored metadata, which is only decoded when it is first accessed."""
+
+    __slots__ = ("_raw", "_value")
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._value = None
+
+    def _decoded(self):
+        if self._value is None:
+            if self._raw.startswith(_MARSHAL_PREFIX):
+                self._value = marshal.loads(self._raw[len(_MARSHAL_PREFIX):])
+            else:
+                self._value = json.loads(self._raw)
+            self._raw = None
+        return self._value
+
+    def __getitem__(self, key):
+        return self._decoded()[key]
+
+    def __contains__(self, key):
+        return key in self._decoded()
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __repr__(self):
+        return "LazyMetadata(%r)" % (self._decoded(),)
 
-from cache import Cache
+# decoded folder listings kept by each SqliteCache, most recently used last
+_LISTING_MEMO_SIZE = 32
+
+class _LazyListing(collections.Mapping):
+    """Read-only dict view of a stored folder listing, which is only loaded and decoded when it is first accessed.
+
+    If the listing has been removed or replaced by then, the view is empty.
+
+    """
+
+    __slots__ = ("_load", "_value")
+
+    def __init__(self, load):
+        self._load = load
+        self._value = None
+
+    def _loaded(self):
+        if self._value is None:
+            self._value = self._load()
+            self._load = None
+        return self._value
+
+    def __getitem__(self, key):
+        return self._loaded()[key]
+
+    def __contains__(self, key):
+        return key in self._loaded()
+
+    def __iter__(self):
+        return iter(self._loaded())
+
+    def __len__(self):
+        return len(self._loaded())
+
+def _pack_metadata(metadata):
+    """Return the compact stored form of a metadata dict."""
+    if metadata is None:
+        return None
+    return sqlite3.Binary(_MARSHAL_PREFIX + marshal.dumps(metadata))
 
 class SqliteCache(Cache):
     """A Cache implementation that uses the sqlite3 package and bindings."""
 
-    def __init__(self, folder_name, timeout=datetime.timedelta(seconds=60), cache_file_name='cache.db'):
+    def __init__(self, folder_name, timeout=datetime.timedelta(seconds=60), cache_file_name='cache.db', compression=None, compression_threshold=1024, max_size=None, max_age=None, sweep_batch_size=100, ttl_policy=None, negative_timeout=datetime.timedelta(seconds=10)):
         """Construct an SqliteCache.
 
         folder_name - the Dropbox folder name this app is using; can be empty for sandbox access
         timeout - timeout of cache items; default 30 seconds
         cache_file_name - filename of the sqlite database; default 'cache.db'
+        compression - a codec from compression.py to store file data with; default None, no compression
+        compression_threshold - only compress file data at least this many bytes long; default 1024
+        max_size - size in bytes the sweeper keeps the database under; default None, unbounded
+        max_age - the sweeper removes rows not read or refreshed for this long, a timedelta; default None, no limit
+        sweep_batch_size - maximum rows removed per table by each sweep; default 100
+        ttl_policy - a policy from ttl_policy.py deciding how long each entry stays fresh; default None, timeout for every entry
+        negative_timeout - how long a file found missing is assumed to stay missing; default 10 seconds
+
+        Databases created by older versions don't use incremental vacuum, so the sweeper can't
+        give their free pages back to the filesystem; call vacuum once, during maintenance, to
+        convert them.
 
         """
-        super(SqliteCache, self).__init__(folder_name, timeout)
+        super(SqliteCache, self).__init__(folder_name, timeout, compression, compression_threshold, ttl_policy, negative_timeout)
 
         sqlite3.register_converter("json", self._convert_json)
 
@@ -66,59 +176,340 @@ class SqliteCache(Cache):
         self._conn.row_factory = sqlite3.Row
         self._conn.text_factory = unicode
 
-        self._conn.execute("CREATE TABLE IF NOT EXISTS user_cache (uid text, folder_name text, folder_metadata_ts timestamp, folder_metadata json)")
-        self._conn.execute("CREATE TABLE IF NOT EXISTS user_data_cache (uid text, file_name text, file_metadata json, file_metadata_ts timestamp, file_data text)")
+        self.max_size = max_size
+        self.max_age = max_age
+        self.sweep_batch_size = sweep_batch_size
+        # reads are recorded here (only while the sweeper can use them) and written to accessed_ts
+        # by the sweeper, so reads stay read-only
+        self._accessed = dict()
+        self._users_accessed = dict()
+        self._sweep_callback = None
+        # (uid, folder name, listing_version) -> decoded listing
+        self._listings = collections.OrderedDict()
+
+        # only takes effect on a new database, before any table is created
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_cache (uid text, folder_name text, folder_metadata_ts timestamp, folder_metadata json, folder_listing json, listing_version integer, accessed_ts timestamp)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_data_cache (uid text, folder_name text, file_name text, file_metadata json, file_metadata_ts timestamp, file_data text, file_encoding text, accessed_ts timestamp)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_missing_cache (uid text, folder_name text, file_name text, missing_ts timestamp)")
+        self._add_column("user_data_cache", "file_encoding", "text")
+        self._add_column("user_cache", "folder_listing", "json")
+        self._add_column("user_cache", "listing_version", "integer")
+        if self._add_column("user_data_cache", "folder_name", "text"):
+            # files cached by older versions belong to the folder the cache was using
+            with self._conn:
+                self._conn.execute("UPDATE user_data_cache SET folder_name = ?", (folder_name,))
+        if self._add_column("user_data_cache", "accessed_ts", "timestamp"):
+            with self._conn:
+                self._conn.execute("UPDATE user_data_cache SET accessed_ts = file_metadata_ts")
+        if self._add_column("user_cache", "accessed_ts", "timestamp"):
+            # folder_metadata_ts is datetime.min for invalidated folders, so start the clock now
+            with self._conn:
+                self._conn.execute("UPDATE user_cache SET accessed_ts = ?", (datetime.datetime.now(),))
 
-    def _convert_json(self, j):
-        return json.loads(j)
+        key_index = self._conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'user_data_cache_key'").fetchone()
+        if key_index is None or not key_index[0].upper().startswith("CREATE UNIQUE"):
+            # older versions could cache a file twice when two requests retrieved it at once;
+            # keep the latest copy, and make add_file replace it from now on
+            with self._conn:
+                self._conn.execute("DROP INDEX IF EXISTS user_data_cache_key")
+                self._conn.execute("DELETE FROM user_data_cache WHERE rowid NOT IN (SELECT max(rowid) FROM user_data_cache GROUP BY uid, folder_name, file_name)")
+                self._conn.execute("CREATE UNIQUE INDEX user_data_cache_key ON user_data_cache (uid, folder_name, file_name)")
 
-    def get_user(self, uid):
-        r = self._conn.execute("SELECT * FROM user_cache WHERE uid=?", (uid,)).fetchone()
+        with self._conn:
+            self._conn.execute("CREATE INDEX IF NOT EXISTS user_cache_key ON user_cache (uid, folder_name)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS user_data_cache_accessed ON user_data_cache (accessed_ts)")
+            self._conn.execute("DROP INDEX IF EXISTS user_cache_ts")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS user_cache_accessed ON user_cache (accessed_ts)")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_missing_cache_key ON user_missing_cache (uid, folder_name, file_name)")
+
+        if (max_size or max_age) and self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.warning("%s does not use incremental vacuum, so swept space is not freed; call vacuum to convert it", cache_file_name)
+
+    def vacuum(self):
+        """Rebuild the database, converting it to incremental vacuum if it was created without it.
+
+        This rewrites the whole database and blocks every process using it until done, so only
+        call it during maintenance, not from a running server.
+
+        """
+        self._flush_accessed()
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("VACUUM")
+
+    def _add_column(self, table, column, column_type):
+        """Add a column to a table created by an older version, if it is missing; returns True if added."""
+        columns = [r["name"] for r in self._conn.execute("PRAGMA table_info(%s)" % table)]
+        if column in columns:
+            return False
+        with self._conn:
+            self._conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
+        return True
+
+    def database_size(self):
+        """Return the size of the database in bytes, not counting free pages."""
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def _tracks_access(self):
+        """Return True if reads need recording, because the sweeper evicts by them."""
+        return self.max_size is not None or self.max_age is not None or self._sweep_callback is not None
+
+    def _touch(self, uid, file_name, folder_name):
+        if self._tracks_access():
+            self._accessed[(uid, self._folder(folder_name), file_name)] = datetime.datetime.now()
+
+    def _touch_user(self, uid, folder_name):
+        if self._tracks_access():
+            self._users_accessed[(uid, folder_name)] = datetime.datetime.now()
+
+    def _flush_accessed(self):
+        if not self._accessed and not self._users_accessed:
+            return
+        accessed, self._accessed = self._accessed, dict()
+        users_accessed, self._users_accessed = self._users_accessed, dict()
+        with self._conn:
+            self._conn.executemany("UPDATE user_data_cache SET accessed_ts = ? WHERE uid=? AND folder_name=? AND file_name=?",
+                    [(ts, uid, folder_name, file_name) for (uid, folder_name, file_name), ts in accessed.iteritems()])
+            self._conn.executemany("UPDATE user_cache SET accessed_ts = ? WHERE uid=? AND folder_name=?",
+                    [(ts, uid, folder_name) for (uid, folder_name), ts in users_accessed.iteritems()])
+
+    def _delete_batch(self, sql, args):
+        with self._conn:
+            return self._conn.execute(sql, args + (self.sweep_batch_size,)).rowcount
+
+    def sweep(self):
+        """Evict one batch of expired rows, and one batch of least recently read files while over max_size.
+
+        Expired missing file entries are always removed, whether or not max_age is set.
+
+        Each step is a short transaction, so other processes sharing the database are never
+        locked out for long; free pages are then returned to the filesystem with incremental
+        vacuum. Returns the number of rows removed.
+
+        """
+        self._flush_accessed()
+        removed = 0
+
+        removed += self._delete_batch("DELETE FROM user_missing_cache WHERE rowid IN (SELECT rowid FROM user_missing_cache WHERE missing_ts < ? LIMIT ?)", (datetime.datetime.now() - self.negative_timeout,))
+
+        if self.max_age is not None:
+            cutoff = datetime.datetime.now() - self.max_age
+            removed += self._delete_batch("DELETE FROM user_data_cache WHERE rowid IN (SELECT rowid FROM user_data_cache WHERE accessed_ts < ? ORDER BY accessed_ts LIMIT ?)", (cutoff,))
+            # folders not listed or refreshed for max_age; invalidated folders keep their accessed_ts
+            rows = self._conn.execute("SELECT rowid, uid, folder_name FROM user_cache WHERE accessed_ts < ? ORDER BY accessed_ts LIMIT ?", (cutoff, self.sweep_batch_size)).fetchall()
+            if rows:
+                with self._conn:
+                    self._conn.executemany("DELETE FROM user_cache WHERE rowid = ?", [(r["rowid"],) for r in rows])
+                for r in rows:
+                    self._drop_path_trees(uid=r["uid"], folder_name=r["folder_name"])
+                removed += len(rows)
+
+        if self.max_size is not None and self.database_size() > self.max_size:
+            removed += self._delete_batch("DELETE FROM user_data_cache WHERE rowid IN (SELECT rowid FROM user_data_cache ORDER BY accessed_ts LIMIT ?)", ())
+
+        if self._conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            # incremental_vacuum returns a row per freed page, and only does the work as they are read
+            self._conn.execute("PRAGMA incremental_vacuum(%d)" % (self.sweep_batch_size * 4,)).fetchall()
+        if removed:
+            logger.debug("swept %d rows, database is now %d bytes", removed, self.database_size())
+        return removed
+
+    def start_sweeper(self, interval=datetime.timedelta(seconds=30), io_loop=None):
+        """Run sweep periodically on a Tornado IOLoop; default every 30 seconds."""
+        from tornado.ioloop import PeriodicCallback
+
+        if self._sweep_callback is not None:
+            self._sweep_callback.stop()
+        milliseconds = interval.days * 86400000 + interval.seconds * 1000 + interval.microseconds / 1000
+        self._sweep_callback = PeriodicCallback(self.sweep, milliseconds, io_loop=io_loop)
+        self._sweep_callback.start()
+
+    def stop_sweeper(self):
+        """Stop the sweeper started by start_sweeper."""
+        if self._sweep_callback is not None:
+            self._sweep_callback.stop()
+            self._sweep_callback = None
+
+    def _stored_data(self, data):
+        """Return (encoding, value to store) for file data; compressed data is stored as a blob."""
+        encoding, stored = self._encode_data(data)
+        if encoding is not None:
+            stored = sqlite3.Binary(stored)
+        return encoding, stored
+
+    def _convert_json(self, j):
+        return LazyMetadata(j)
+
+    def _user_dict(self, r):
+        """Return a user dict for a user_cache row, with the folder listing loaded only when it is used."""
+        user = {
+                "uid" : r["uid"],
+                "folder_name" : r["folder_name"],
+                "folder_metadata_ts" : r["folder_metadata_ts"],
+                "folder_metadata" : r["folder_metadata"],
+                "folder_listing" : None,
+                }
+        if not r["no_listing"]:
+            user["folder_listing"] = self._listing(r["uid"], r["folder_name"], r["listing_version"])
+        return user
+
+    def _listing(self, uid, folder_name, version):
+        """Return the stored listing of a folder, decoded once per listing_version and kept in memory."""
+        key = (uid, folder_name, version)
+        listing = self._listings.pop(key, None)
+        if listing is not None:
+            self._listings[key] = listing
+            return listing
+
+        def load():
+            r = self._conn.execute("SELECT folder_listing, listing_version FROM user_cache WHERE uid=? AND folder_name=?", (uid, folder_name)).fetchone()
+            if r is None or r["folder_listing"] is None or r["listing_version"] != version:
+                # removed or replaced since get_user; a listing without a version is rebuilt from
+                # the folder metadata returned with it, as one stored by an older version is
+                return dict()
+            listing = dict(r["folder_listing"])
+            # listings stored by older versions have no listing_version to tell them apart
+            if version is not None:
+                self._remember_listing(key, listing)
+            return listing
+        return _LazyListing(load)
+
+    def _remember_listing(self, key, listing):
+        self._listings[key] = listing
+        if len(self._listings) > _LISTING_MEMO_SIZE:
+            self._listings.popitem(last=False)
+
+    def get_user(self, uid, folder_name=None):
+        folder_name = self._folder(folder_name)
+        query = "SELECT uid, folder_name, folder_metadata_ts, folder_metadata, folder_listing IS NULL AS no_listing, listing_version FROM user_cache WHERE uid=? AND folder_name=?"
+        r = self._conn.execute(query, (uid, folder_name)).fetchone()
         if r:
-            # TODO redo prints using logging
-            print "returning existing user"
-            return r
+            logger.debug("returning existing user")
+            self._touch_user(uid, folder_name)
+            return self._user_dict(r)
         else:
-            print "making new user"
+            logger.debug("making new user")
             with self._conn:
-                self._conn.execute("INSERT INTO user_cache VALUES (?, ?, ?, '{}')", (uid, self.folder_name, datetime.datetime.min))
-            r = self._conn.execute("SELECT * FROM user_cache WHERE uid=?", (uid,)).fetchone()
-            return r
+                self._conn.execute("INSERT INTO user_cache (uid, folder_name, folder_metadata_ts, folder_metadata, accessed_ts) VALUES (?, ?, ?, '{}', ?)", (uid, folder_name, datetime.datetime.min, datetime.datetime.now()))
+            r = self._conn.execute(query, (uid, folder_name)).fetchone()
+            return self._user_dict(r)
 
-    def update_folder_metadata(self, uid, timestamp, metadata):
+    def update_folder_metadata(self, uid, timestamp, metadata, listing=None, folder_name=None):
+        # a random version, so that processes sharing the database never reuse one for another listing
+        version = random.getrandbits(62)
         with self._conn:
-            self._conn.execute("UPDATE user_cache SET folder_metadata_ts = ?, folder_metadata = ? WHERE uid=?", (timestamp, metadata, uid))
+            updated = self._conn.execute("UPDATE user_cache SET folder_metadata_ts = ?, folder_metadata = ?, folder_listing = ?, listing_version = ?, accessed_ts = ? WHERE uid=? AND folder_name=?", (timestamp, _pack_metadata(metadata), _pack_metadata(listing), version, datetime.datetime.now(), uid, self._folder(folder_name))).rowcount
+        if updated and listing is not None:
+            self._remember_listing((uid, self._folder(folder_name), version), listing)
 
-    def update_folder_metadata_timestamp(self, uid, timestamp):
+    def update_folder_metadata_timestamp(self, uid, timestamp, folder_name=None):
         with self._conn:
-            self._conn.execute("UPDATE user_cache SET folder_metadata_ts = ? WHERE uid=?", (timestamp, uid))
+            self._conn.execute("UPDATE user_cache SET folder_metadata_ts = ? WHERE uid=? AND folder_name=?", (timestamp, uid, self._folder(folder_name)))
+
+    def get_file(self, uid, file_name, folder_name=None):
+        r = self._conn.execute("SELECT * FROM user_data_cache WHERE uid=? AND folder_name=? AND file_name=?", (uid, self._folder(folder_name), file_name)).fetchone()
+        if r is not None:
+            self._touch(uid, file_name, folder_name)
+        if r is None or r["file_encoding"] is None:
+            return r
+
+        file_dict = FileDict(zip(r.keys(), r))
+        file_dict["file_stored_data"] = str(file_dict.pop("file_data"))
+        return file_dict
 
-    def get_file(self, uid, file_name):
-        r = self._conn.execute("SELECT * FROM user_data_cache WHERE uid=? AND file_name=?", (uid, file_name)).fetchone()
+    def get_file_metadata(self, uid, file_name, folder_name=None):
+        r = self._conn.execute("SELECT uid, folder_name, file_name, file_metadata, file_metadata_ts, file_encoding FROM user_data_cache WHERE uid=? AND folder_name=? AND file_name=?", (uid, self._folder(folder_name), file_name)).fetchone()
         return r
 
-    def add_file(self, uid, file_name, timestamp, metadata, data):
+    def get_stored_data(self, uid, file_name, folder_name=None):
+        r = self._conn.execute("SELECT file_encoding, file_data FROM user_data_cache WHERE uid=? AND folder_name=? AND file_name=?", (uid, self._folder(folder_name), file_name)).fetchone()
+        if r is None:
+            return None
+        self._touch(uid, file_name, folder_name)
+        if r["file_encoding"] is None:
+            return None, r["file_data"]
+        else:
+            return r["file_encoding"], str(r["file_data"])
+
+    def get_data_range(self, uid, file_name, start, stop, folder_name=None):
+        key = (uid, self._folder(folder_name), file_name)
+        r = self._conn.execute("SELECT file_encoding, length(CAST(file_data AS BLOB)) AS size FROM user_data_cache WHERE uid=? AND folder_name=? AND file_name=?", key).fetchone()
+        if r is None or r["file_encoding"] is not None:
+            return super(SqliteCache, self).get_data_range(uid, file_name, start, stop, folder_name)
+
+        # read only the requested bytes of uncompressed data
+        self._touch(uid, file_name, folder_name)
+        first, last, _ = slice(start, stop).indices(r["size"])
+        if last <= first:
+            return "", first, r["size"]
+        part = self._conn.execute("SELECT substr(CAST(file_data AS BLOB), ?, ?) FROM user_data_cache WHERE uid=? AND folder_name=? AND file_name=?", (first + 1, last - first) + key).fetchone()
+        return str(part[0]), first, r["size"]
+
+    def add_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        encoding, stored = self._stored_data(data)
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO user_data_cache (uid, folder_name, file_name, file_metadata, file_metadata_ts, file_data, file_encoding, accessed_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (uid, self._folder(folder_name), file_name, _pack_metadata(metadata), timestamp, stored, encoding, timestamp))
+
+    def update_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        encoding, stored = self._stored_data(data)
+        with self._conn:
+            self._conn.execute("UPDATE user_data_cache SET file_metadata = ?, file_metadata_ts = ?, file_data = ?, file_encoding = ?, accessed_ts = ? WHERE uid=? AND folder_name=? AND file_name=?", (_pack_metadata(metadata), timestamp, stored, encoding, timestamp, uid, self._folder(folder_name), file_name))
+
+    def update_file_timestamp(self, uid, file_name, timestamp, folder_name=None):
         with self._conn:
-            self._conn.execute("INSERT INTO user_data_cache VALUES (?, ?, ?, ?, ?)", (uid, file_name, metadata, timestamp, data))
+            self._conn.execute("UPDATE user_data_cache SET file_metadata_ts = ?, accessed_ts = max(accessed_ts, ?) WHERE uid=? AND folder_name=? AND file_name=?", (timestamp, timestamp, uid, self._folder(folder_name), file_name))
 
-    def update_file(self, uid, file_name, timestamp, metadata, data):
+    def remove_file(self, uid, file_name, folder_name=None):
         with self._conn:
-            self._conn.execute("UPDATE user_data_cache SET file_metadata = ?, file_metadata_ts = ?, file_data = ? WHERE uid=? AND file_name=?", (metadata, timestamp, data, uid, file_name))
+            self._conn.execute("DELETE FROM user_data_cache WHERE uid=? AND folder_name=? AND file_name=?", (uid, self._folder(folder_name), file_name))
+
+    def get_folder_timestamp(self, uid, folder_name=None):
+        r = self._conn.execute("SELECT folder_metadata_ts FROM user_cache WHERE uid=? AND folder_name=?", (uid, self._folder(folder_name))).fetchone()
+        if r is None:
+            return None
+        return r["folder_metadata_ts"]
 
-    def update_file_timestamp(self, uid, file_name, timestamp):
+    def get_missing(self, uid, file_name, folder_name=None):
+        r = self._conn.execute("SELECT missing_ts FROM user_missing_cache WHERE uid=? AND folder_name=? AND file_name=?", (uid, self._folder(folder_name), file_name)).fetchone()
+        if r is None:
+            return None
+        return r["missing_ts"]
+
+    def add_missing(self, uid, file_name, timestamp, folder_name=None):
         with self._conn:
-            self._conn.execute("UPDATE user_data_cache SET file_metadata_ts = ? WHERE uid=? AND file_name=?", (timestamp, uid, file_name))
+            self._conn.execute("INSERT OR REPLACE INTO user_missing_cache (uid, folder_name, file_name, missing_ts) VALUES (?, ?, ?, ?)", (uid, self._folder(folder_name), file_name, timestamp))
 
-    def remove_file(self, uid, file_name):
+    def remove_missing(self, uid, file_name, folder_name=None):
         with self._conn:
-            self._conn.execute("DELETE FROM user_data_cache WHERE uid=? AND file_name=?", (uid, file_name))
+            self._conn.execute("DELETE FROM user_missing_cache WHERE uid=? AND folder_name=? AND file_name=?", (uid, self._folder(folder_name), file_name))
 
     def clear_cache(self):
+        self._drop_path_trees()
+        self._listings.clear()
         with self._conn:
             self._conn.execute("DELETE FROM user_data_cache")
             self._conn.execute("DELETE FROM user_cache")
+            self._conn.execute("DELETE FROM user_missing_cache")
+
+    def clear_folder(self, folder_name):
+        self._drop_path_trees(folder_name=folder_name)
+        if not folder_name:
+            self.clear_cache()
+            return
+
+        # the folder itself, and its subfolders
+        prefix = folder_name + "/"
+        with self._conn:
+            self._conn.execute("DELETE FROM user_data_cache WHERE folder_name=? OR substr(folder_name, 1, ?)=?", (folder_name, len(prefix), prefix))
+            self._conn.execute("DELETE FROM user_cache WHERE folder_name=? OR substr(folder_name, 1, ?)=?", (folder_name, len(prefix), prefix))
+            self._conn.execute("DELETE FROM user_missing_cache WHERE folder_name=? OR substr(folder_name, 1, ?)=?", (folder_name, len(prefix), prefix))
 
     def remove_user(self, uid):
+        self._drop_path_trees(uid=uid)
         with self._conn:
             self._conn.execute("DELETE FROM user_cache WHERE uid=?", (uid,))
             self._conn.execute("DELETE FROM user_data_cache WHERE uid=?", (uid,))
+            self._conn.execute("DELETE FROM user_missing_cache WHERE uid=?", (uid,))
@@ -0,0 +1,149 @@
+"""An in-memory stand-in for the Dropbox API, and a DropboxClient that talks to it."""
+
+import io
+import json
+import urllib
+
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncTestCase
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders
+from tornado.httpserver import HTTPRequest as ServerRequest
+from tornado.web import Application
+
+from client import DropboxClient
+from mixin import _parse_range
+
+MODIFIED = "Sat, 21 Aug 2010 22:31:20 +0000"
+
+class FakeDropbox(object):
+    """Files and folders of one sandbox, served through a dropbox_request-compatible method.
+
+    files maps paths (without a leading slash) to (rev, data), and folders exist while they have
+    files; calls records every request as (api, path, args). Setting fail makes every request
+    raise that exception instead, and setting hold keeps the response callbacks in that list
+    instead of running them. File requests with a Range header get a 206 or 416 response.
+
+    """
+
+    def __init__(self):
+        self.files = dict()
+        self.calls = []
+        self.folder_hash = "h0"
+        self.fail = None
+        self.hold = None
+
+    def put(self, path, data):
+        old = self.files.get(path, ("r0", ""))[0]
+        rev = "r%d" % (int(old[1:]) + 1)
+        self.files[path] = (rev, data)
+        self.folder_hash += "x"
+        return self._metadata(path)
+
+    def _metadata(self, path):
+        rev, data = self.files[path]
+        return dict(path="/" + path, rev=rev, bytes=len(data), modified=MODIFIED, is_dir=False)
+
+    def request(self, subdomain, path, callback, access_token=None, post_args=None, put_body=None, headers=None, **args):
+        parts = path.split("/", 4)
+        api = parts[2]
+        name = urllib.unquote(parts[4] if len(parts) > 4 else "").strip("/")
+        self.calls.append((api, name, args))
+        if self.fail is not None:
+            raise self.fail
+
+        request = HTTPRequest("https://%s.dropbox.com%s" % (subdomain, path))
+        def respond(code, body="", response_headers=None):
+            response = HTTPResponse(request, code, headers=HTTPHeaders(response_headers or {}), buffer=io.BytesIO(body))
+            if self.hold is not None:
+                self.hold.append(lambda: callback(response))
+            else:
+                IOLoop.instance().add_callback(lambda: callback(response))
+
+        if api == "metadata" and args.get("list") == "true":
+            prefix = name + "/" if name else ""
+            below = [p for p in sorted(self.files) if p.startswith(prefix)]
+            if name and not below:
+                # folders only exist while they have files
+                return respond(404)
+            if args.get("hash") == self.folder_hash:
+                return respond(304)
+            contents = [self._metadata(p) for p in below if "/" not in p[len(prefix):]]
+            folders = sorted(set(prefix + p[len(prefix):].split("/")[0] for p in below if "/" in p[len(prefix):]))
+            contents.extend(dict(path="/" + f, bytes=0, modified=MODIFIED, rev="d", is_dir=True) for f in folders)
+            return respond(200, json.dumps(dict(hash=self.folder_hash, path="/" + name, contents=contents, is_dir=True)))
+        if api == "metadata":
+            if name not in self.files:
+                return respond(404)
+            return respond(200, json.dumps(self._metadata(name)))
+        if api == "files":
+            if name not in self.files:
+                return respond(404)
+            data = self.files[name][1]
+            byte_range = _parse_range((headers or {}).get("Range"))
+            if byte_range is not None:
+                first, last, _ = slice(*byte_range).indices(len(data))
+                if first >= last:
+                    return respond(416, "", {"Content-Range": "bytes */%d" % len(data)})
+                return respond(206, data[first:last], {"Content-Range": "bytes %d-%d/%d" % (first, last - 1, len(data))})
+            return respond(200, data, {"x-dropbox-metadata": json.dumps(self._metadata(name))})
+        if api == "files_put":
+            return respond(200, json.dumps(self.put(name, put_body)))
+        if api == "fileops":
+            source = urllib.unquote(post_args.get("path", post_args.get("from_path", ""))).strip("/")
+            if source not in self.files:
+                return respond(404)
+            if path.endswith("/move"):
+                self.files[post_args["to_path"].strip("/")] = self.files.pop(source)
+            elif path.endswith("/delete"):
+                del self.files[source]
+            self.folder_hash += "x"
+            return respond(200, "{}")
+        return respond(404)
+
+class FakeClient(DropboxClient):
+    """A DropboxClient whose requests go to a FakeDropbox."""
+
+    def __init__(self, dropbox, **kwargs):
+        DropboxClient.__init__(self, "key", "secret", dict(key="a", secret="b"), "u1", **kwargs)
+        self.dropbox = dropbox
+
+    def dropbox_request(self, subdomain, path, callback, **kwargs):
+        self.dropbox.request(subdomain, path, callback, **kwargs)
+
+class _Stream(object):
+    def set_close_callback(self, callback):
+        return
+
+    def closed(self):
+        return False
+
+class _Connection(object):
+    xheaders = False
+    no_keep_alive = False
+    stream = _Stream()
+
+    def set_close_callback(self, callback):
+        return
+
+    def write(self, chunk, callback=None):
+        return
+
+    def finish(self):
+        return
+
+def make_handler(cls, dropbox, headers=None, uid="u1", folder="", **settings):
+    """Construct a handler of class cls for a GET request, logged in as uid, with requests going to dropbox."""
+    application = Application([], cookie_secret="secret", dropbox_consumer_key="key", dropbox_consumer_secret="secret", **settings)
+    request = ServerRequest("GET", "/", headers=HTTPHeaders(headers or {}), connection=_Connection(), remote_ip="127.0.0.1")
+    handler = cls(application, request)
+    handler._current_user = dict(uid=uid, access_token=dict(key="a", secret="b"))
+    handler.get_secure_cookie = lambda name: folder if name == "dropbox_folder_path" else None
+    handler.dropbox_request = dropbox.request
+    return handler
+
+class DropboxTestCase(AsyncTestCase):
+    """Runs on IOLoop.instance(), which the write-behind queue and background fills default to."""
+
+    def get_new_ioloop(self):
+        return IOLoop.instance()
@@ -0,0 +1,180 @@
+import os
+import shutil
+import marshal
+import datetime
+import tempfile
+import unittest
+
+import cache as cache_module
+from cache import Cache, DictCache, FileDict
+from compression import GzipCodec
+from tests.fake_dropbox import DropboxTestCase
+
+NOW = datetime.datetime(2012, 6, 1, 12, 0, 0)
+
+class LegacyCache(Cache):
+    """A third-party implementation that predates the optional methods, storing files in a dict."""
+
+    def __init__(self):
+        super(LegacyCache, self).__init__("", datetime.timedelta(seconds=60))
+        self.files = dict()
+
+    def get_user(self, uid, folder_name=None):
+        return super(LegacyCache, self).get_user(uid, folder_name)
+
+    def update_folder_metadata(self, uid, timestamp, metadata, listing=None, folder_name=None):
+        return
+
+    def update_folder_metadata_timestamp(self, uid, timestamp, folder_name=None):
+        return
+
+    def get_file(self, uid, file_name, folder_name=None):
+        return self.files.get(file_name)
+
+    def add_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        self.files[file_name] = dict(uid=uid, file_name=file_name, file_metadata_ts=timestamp, file_metadata=metadata, file_data=data)
+
+    def update_file(self, uid, file_name, timestamp, metadata, data, folder_name=None):
+        self.add_file(uid, file_name, timestamp, metadata, data, folder_name)
+
+    def update_file_timestamp(self, uid, file_name, timestamp, folder_name=None):
+        self.files[file_name]["file_metadata_ts"] = timestamp
+
+    def remove_file(self, uid, file_name, folder_name=None):
+        self.files.pop(file_name, None)
+
+    def clear_cache(self):
+        self.files.clear()
+
+    def remove_user(self, uid):
+        self.files.clear()
+
+class LegacyCacheTest(unittest.TestCase):
+    def test_optional_methods_have_defaults(self):
+        cache = LegacyCache()
+        cache.add_missing("u1", "a.txt", NOW)
+        self.assertEqual(cache.get_missing("u1", "a.txt"), None)
+        self.assertEqual(cache.get_folder_timestamp("u1"), datetime.datetime.min)
+
+    def test_stored_data_defaults_to_get_file(self):
+        cache = LegacyCache()
+        self.assertEqual(cache.get_stored_data("u1", "a.txt"), None)
+        cache.add_file("u1", "a.txt", NOW, dict(rev="r1"), "hello")
+        self.assertEqual(cache.get_stored_data("u1", "a.txt"), (None, "hello"))
+        self.assertEqual(cache.get_data_range("u1", "a.txt", 1, 3), ("el", 1, 5))
+
+    def test_clear_folder_defaults_to_clear_cache(self):
+        cache = LegacyCache()
+        cache.add_file("u1", "a.txt", NOW, dict(rev="r1"), "hello")
+        cache.clear_folder("other")
+        self.assertEqual(cache.get_file("u1", "a.txt"), None)
+
+class FileDictTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache("", compression=GzipCodec(), compression_threshold=4)
+        self.cache.add_file("u1", "a.txt", NOW, dict(rev="r1"), "hello world")
+        self.file_dict = self.cache.get_file("u1", "a.txt")
+
+    def test_compressed_data_is_visible(self):
+        self.assertTrue(isinstance(self.file_dict, FileDict))
+        self.assertFalse(dict.__contains__(self.file_dict, "file_data"))
+        self.assertTrue("file_data" in self.file_dict)
+        self.assertEqual(self.file_dict.get("file_data"), "hello world")
+        self.assertEqual(self.file_dict["file_data"], "hello world")
+
+    def test_missing_keys(self):
+        self.assertFalse("nope" in self.file_dict)
+        self.assertEqual(self.file_dict.get("nope", 1), 1)
+        self.assertRaises(KeyError, lambda: self.file_dict["nope"])
+
+    def test_stored_data(self):
+        encoding, stored = self.cache.get_stored_data("u1", "a.txt")
+        self.assertEqual(encoding, "gzip")
+        self.assertEqual(GzipCodec().decompress(stored), "hello world")
+
+class MissingTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache("", negative_timeout=datetime.timedelta(seconds=10))
+        self.now = datetime.datetime.now()
+
+    def test_expired_entry_is_removed_on_lookup(self):
+        self.cache.add_missing("u1", "a.txt", self.now - datetime.timedelta(seconds=20))
+        self.assertEqual(self.cache.get_missing("u1", "a.txt"), None)
+        self.assertEqual(self.cache._missing_dict, dict())
+        self.cache.add_missing("u1", "a.txt", self.now)
+        self.assertEqual(self.cache.get_missing("u1", "a.txt"), self.now)
+
+    def test_expired_entries_are_pruned(self):
+        old = self.now - datetime.timedelta(seconds=20)
+        for i in xrange(cache_module._MISSING_PRUNE_SIZE * 3):
+            self.cache.add_missing("u1", "old%d" % i, old)
+        self.assertTrue(len(self.cache._missing_dict) < cache_module._MISSING_PRUNE_SIZE)
+        self.cache.add_missing("u1", "new", self.now)
+        self.assertEqual(self.cache.get_missing("u1", "new"), self.now)
+
+    def test_folder_timestamp_is_read_only(self):
+        self.assertEqual(self.cache.get_folder_timestamp("u1"), None)
+        self.assertEqual(self.cache._user_dict, dict())
+        self.cache.get_user("u1")
+        self.assertEqual(self.cache.get_folder_timestamp("u1"), datetime.datetime.min)
+
+class SnapshotTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "snapshot")
+        self.cache = DictCache("", compression=GzipCodec(), compression_threshold=4)
+        self.cache.get_user("u1")
+        self.cache.update_folder_metadata("u1", NOW, dict(hash="h1"), dict(entries=[]))
+        self.cache.add_file("u1", "a.txt", NOW, dict(rev="r1"), "hello world")
+        self.cache.add_file("u1", "b.txt", NOW, dict(rev="r1"), "b")
+        self.cache.add_missing("u1", "gone.txt", NOW)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        DropboxTestCase.tearDown(self)
+
+    def load(self):
+        loaded = DictCache("")
+        loaded.load_snapshot(self.file_name)
+        return loaded
+
+    def check(self, loaded):
+        self.assertEqual(loaded.get_user("u1")["folder_metadata"], dict(hash="h1"))
+        self.assertEqual(loaded.get_file("u1", "a.txt")["file_data"], "hello world")
+        self.assertEqual(loaded.get_stored_data("u1", "a.txt")[0], "gzip")
+        self.assertEqual(loaded.get_file("u1", "b.txt")["file_metadata_ts"], NOW)
+        self.assertEqual(loaded._missing_dict[("u1", "", "gone.txt")], NOW)
+
+    def test_save_and_load(self):
+        self.cache.save_snapshot(self.file_name)
+        self.check(self.load())
+
+    def test_save_async_in_batches(self):
+        original = cache_module._SNAPSHOT_BATCH_SIZE
+        cache_module._SNAPSHOT_BATCH_SIZE = 1
+        try:
+            self.cache.save_snapshot_async(self.file_name, callback=self.stop)
+            # changes made while saving don't break the save
+            self.cache.remove_file("u1", "b.txt")
+            self.cache.add_file("u1", "c.txt", NOW, dict(rev="r1"), "c")
+            self.cache.add_file("u1", "b.txt", NOW, dict(rev="r1"), "b")
+            self.assertTrue(self.cache._snapshot_in_progress)
+            self.wait()
+        finally:
+            cache_module._SNAPSHOT_BATCH_SIZE = original
+        self.assertFalse(self.cache._snapshot_in_progress)
+        self.check(self.load())
+        self.assertEqual(os.listdir(self.directory), ["snapshot"])
+
+    def test_load_version_1(self):
+        with open(self.file_name, "wb") as f:
+            marshal.dump(("tornado_dropcache.DictCache", 1), f)
+            marshal.dump(("file", "u1", "", "a.txt", 0, dict(rev="r1"), None, "old"), f)
+        self.assertEqual(self.load().get_file("u1", "a.txt")["file_data"], "old")
+
+    def test_other_versions_are_ignored(self):
+        with open(self.file_name, "wb") as f:
+            marshal.dump(("tornado_dropcache.DictCache", 99), f)
+            marshal.dump(("file", "u1", "", "a.txt", 0, dict(rev="r1"), None, "new"), f)
+        self.assertEqual(self.load().get_file("u1", "a.txt"), None)
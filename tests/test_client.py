@@ -0,0 +1,39 @@
+import time
+import unittest
+
+from tornado.stack_context import ExceptionStackContext
+
+from cache import DictCache
+from mixin import DropboxOperations
+from tests.fake_dropbox import FakeDropbox, FakeClient, DropboxTestCase
+
+class DropboxOperationsTest(unittest.TestCase):
+    def test_subclasses_must_provide_user_and_folder(self):
+        class Incomplete(DropboxOperations):
+            def _get_uid(self):
+                return "u1"
+        self.assertRaises(TypeError, Incomplete)
+
+class GetDataManyTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.dropbox.put("a.txt", "a")
+        self.dropbox.put("b.txt", "b")
+        self.client = FakeClient(self.dropbox, cache=DictCache(""))
+
+    def test_results_in_order(self):
+        self.client.get_data_many(["b.txt", "a.txt", "b.txt", "c.txt"], blank_on_404=True, callback=self.stop)
+        self.assertEqual(self.wait(), ["b", "a", "b", ""])
+
+    def test_first_error_is_raised(self):
+        errors = []
+        def handle_exception(typ, value, tb):
+            errors.append(value)
+            return True
+        with ExceptionStackContext(handle_exception):
+            self.client.get_data_many(["a.txt", "c.txt", "d.txt"], callback=self.stop)
+        # the other failure and the successful result are dropped rather than calling back
+        self.io_loop.add_timeout(time.time() + 0.05, self.stop)
+        self.assertEqual(self.wait(), None)
+        self.assertEqual([error.code for error in errors], [404])
@@ -0,0 +1,125 @@
+import time
+import datetime
+import unittest
+
+from cache import DictCache
+from compression import GzipCodec
+from mixin import DropboxUserHandler, DropboxHTTPCacheMixin, _parse_range
+from tracing import Tracer, MemorySink
+from tests.fake_dropbox import FakeDropbox, FakeClient, DropboxTestCase, make_handler
+
+class Handler(DropboxUserHandler, DropboxHTTPCacheMixin):
+    pass
+
+class FileCacheHeadersTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache("", compression=GzipCodec(), compression_threshold=4)
+        self.cache.add_file("u1", "a.txt", datetime.datetime.now(), dict(rev="abc", modified="Sat, 21 Aug 2010 22:31:20 +0000"), "hello world")
+
+    def handler(self, **headers):
+        return make_handler(Handler, FakeDropbox(), headers, dropbox_cache=self.cache)
+
+    def test_compressed_response_etag(self):
+        handler = self.handler(**{"Accept-Encoding": "gzip"})
+        handler.set_file_cache_headers("a.txt")
+        self.assertEqual(handler._headers["Etag"], '"abc-gzip"')
+        self.assertEqual(handler._headers["Vary"], "Accept-Encoding")
+
+    def test_identity_response_etag(self):
+        handler = self.handler()
+        handler.set_file_cache_headers("a.txt")
+        self.assertEqual(handler._headers["Etag"], '"abc"')
+        self.assertEqual(handler._headers["Vary"], "Accept-Encoding")
+
+    def test_range_response_etag(self):
+        handler = self.handler(**{"Accept-Encoding": "gzip", "Range": "bytes=0-3"})
+        handler.set_file_cache_headers("a.txt")
+        self.assertEqual(handler._headers["Etag"], '"abc"')
+
+    def test_not_modified_accepts_either_form(self):
+        for tag in ('"abc"', '"abc-gzip"', 'W/"abc-gzip"'):
+            self.assertTrue(self.handler(**{"If-None-Match": tag})._request_not_modified("abc", None))
+        self.assertFalse(self.handler(**{"If-None-Match": '"abcd"'})._request_not_modified("abc", None))
+
+class FileNotModifiedTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.cache = DictCache("")
+        self.sink = MemorySink()
+        self.cache.add_file("u1", "a.txt", datetime.datetime.now() - datetime.timedelta(days=1), dict(rev="r1"), "a")
+
+    def check(self, **headers):
+        handler = make_handler(Handler, self.dropbox, headers, dropbox_cache=self.cache, dropbox_tracer=Tracer(self.sink))
+        handler._file_not_modified("a.txt", self.stop)
+        return self.wait()
+
+    def test_revalidation_is_traced(self):
+        self.dropbox.put("a.txt", "a")
+        self.assertTrue(self.check(**{"If-None-Match": '"r1"'}))
+        trace = self.sink.traces[-1]
+        self.assertEqual(trace.name, "file_not_modified")
+        self.assertTrue("dropbox.metadata" in trace.breakdown())
+
+    def test_deleted_file_is_remembered_as_missing(self):
+        self.assertFalse(self.check(**{"If-None-Match": '"r1"'}))
+        self.assertEqual(self.cache.get_file_metadata("u1", "a.txt"), None)
+        self.assertTrue(self.cache.get_missing("u1", "a.txt") is not None)
+
+class ParseRangeTest(unittest.TestCase):
+    def test_single_ranges(self):
+        self.assertEqual(_parse_range("bytes=0-3"), (0, 4))
+        self.assertEqual(_parse_range("bytes=5-"), (5, None))
+        self.assertEqual(_parse_range("bytes=-3"), (-3, None))
+        self.assertEqual(_parse_range("bytes= 2 - 2 "), (2, 3))
+
+    def test_ranges_served_as_whole_file(self):
+        for header in (None, "", "items=0-3", "bytes=0-1,3-4", "bytes=3-1", "bytes=-0", "bytes=a-b", "bytes=5"):
+            self.assertEqual(_parse_range(header), None, header)
+
+class RangeHandler(Handler):
+    def _detached(self):
+        # the background fill goes to the same fake Dropbox
+        return FakeClient(self.dropbox, cache=self.settings["dropbox_cache"])
+
+class WriteDataRangeTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.dropbox.put("a.txt", "hello world")
+        self.cache = DictCache("")
+
+    def cache_file(self):
+        self.cache.add_file("u1", "a.txt", datetime.datetime.now(), dict(rev="r1"), "hello world")
+
+    def write_data(self, **headers):
+        handler = make_handler(RangeHandler, self.dropbox, headers, dropbox_cache=self.cache)
+        handler.dropbox = self.dropbox
+        handler._transforms = []
+        handler.write_data("a.txt", self.stop)
+        self.wait()
+        return handler.get_status(), handler._headers.get("Content-Range"), "".join(handler._write_buffer)
+
+    def test_range_of_cached_file(self):
+        self.cache_file()
+        self.assertEqual(self.write_data(Range="bytes=0-4"), (206, "bytes 0-4/11", "hello"))
+        self.assertEqual(self.write_data(Range="bytes=-5"), (206, "bytes 6-10/11", "world"))
+        self.assertEqual(self.dropbox.calls, [])
+
+    def test_unsatisfiable_range(self):
+        self.cache_file()
+        self.assertEqual(self.write_data(Range="bytes=20-"), (416, "bytes */11", ""))
+
+    def test_if_range(self):
+        self.cache_file()
+        self.assertEqual(self.write_data(**{"Range": "bytes=0-4", "If-Range": '"r1"'}), (206, "bytes 0-4/11", "hello"))
+        self.assertEqual(self.write_data(**{"Range": "bytes=0-4", "If-Range": '"r0"'}), (200, None, "hello world"))
+
+    def test_range_of_uncached_file_is_filled_in_background(self):
+        self.assertEqual(self.write_data(Range="bytes=6-"), (206, "bytes 6-10/11", "world"))
+        self.assertEqual(self.dropbox.calls[0][0], "files")
+        self.assertEqual(self.cache.get_file("u1", "a.txt"), None)
+
+        self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+        self.wait()
+        self.assertEqual(self.cache.get_file("u1", "a.txt")["file_data"], "hello world")
@@ -0,0 +1,61 @@
+import datetime
+import unittest
+
+from listing import build_listing, query_listing, PathTree, LISTING_VERSION
+
+def metadata(*names):
+    return dict(path="/app", contents=[dict(path="/app/" + name, bytes=len(name), modified=None, rev="r1", is_dir=False) for name in names])
+
+class ListingTest(unittest.TestCase):
+    def setUp(self):
+        self.listing = build_listing("/app", metadata("beta.txt", "Alpha.txt", "alpha2.txt", "Beta.txt", "gamma.txt"))
+
+    def names(self, **query):
+        return [entry["name"] for entry in query_listing(self.listing, **query)]
+
+    def test_sorted_ignoring_case(self):
+        self.assertEqual(self.listing["version"], LISTING_VERSION)
+        self.assertEqual(self.names(), ["Alpha.txt", "alpha2.txt", "Beta.txt", "beta.txt", "gamma.txt"])
+        self.assertEqual(self.names(reverse=True, limit=2), ["gamma.txt", "beta.txt"])
+
+    def test_prefix_ignores_case(self):
+        self.assertEqual(self.names(prefix="ALPHA"), ["Alpha.txt", "alpha2.txt"])
+        self.assertEqual(self.names(prefix="b", offset=1), ["beta.txt"])
+        self.assertEqual(self.names(prefix="Beta", sort="size"), ["Beta.txt", "beta.txt"])
+        self.assertEqual(self.names(prefix="delta"), [])
+
+    def test_unknown_sort(self):
+        self.assertRaises(ValueError, query_listing, self.listing, sort="owner")
+
+def folder(*names):
+    return dict(path="", contents=[dict(path="/" + name, bytes=0, modified=None, rev="r1", is_dir=True) for name in names])
+
+class PathTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = PathTree()
+        self.now = datetime.datetime.now()
+        self.tree.update("", build_listing("", folder("a")), self.now)
+        self.tree.update("a", build_listing("", folder("b")), self.now)
+        self.tree.update("a/b", build_listing("", folder()), self.now)
+
+    def fresh(self, path):
+        return self.tree.is_fresh(self.tree.find(path), self.tree.ancestor_invalidation(path), self.now, datetime.timedelta(seconds=60))
+
+    def test_subtree_invalidation_applies_below(self):
+        self.assertTrue(self.fresh("a/b"))
+        self.tree.invalidate("a", subtree=True)
+        self.assertTrue(self.fresh(""))
+        self.assertFalse(self.fresh("a"))
+        self.assertFalse(self.fresh("a/b"))
+
+        self.tree.update("a/b", build_listing("", folder()), self.now)
+        self.assertTrue(self.fresh("a/b"))
+
+    def test_ancestor_invalidation(self):
+        self.assertEqual(self.tree.ancestor_invalidation("a/b"), 0)
+        self.tree.invalidate("", subtree=True)
+        root = self.tree.root.invalidated
+        self.tree.invalidate("a/b", subtree=True)
+        self.assertEqual(self.tree.ancestor_invalidation(""), 0)
+        self.assertEqual(self.tree.ancestor_invalidation("a/b"), root)
+        self.assertEqual(self.tree.ancestor_invalidation("a/b/c/d"), self.tree.find("a/b").invalidated)
@@ -0,0 +1,40 @@
+import unittest
+
+from mixin import DropboxLoginHandler
+from tests.fake_dropbox import FakeDropbox, make_handler
+
+class LoginHandler(DropboxLoginHandler):
+    def set_application_cookies(self):
+        self.set_folder_path("notes")
+
+    def warm_cache(self, user, folder_path):
+        self.warmed = (user["uid"], folder_path)
+
+class DefaultLoginHandler(LoginHandler):
+    def set_application_cookies(self):
+        pass
+
+class CookieLoginHandler(LoginHandler):
+    def set_application_cookies(self):
+        self.set_secure_cookie("dropbox_folder_path", "notes")
+
+class LoginTest(unittest.TestCase):
+    def login(self, cls):
+        handler = make_handler(cls, FakeDropbox())
+        handler._transforms = []
+        # use the real signed cookies
+        del handler.get_secure_cookie
+        handler.request.arguments["oauth_token"] = ["t"]
+        handler.get_authenticated_user = lambda callback: callback(dict(uid="u1", access_token=dict(key="a", secret="b")))
+        handler.get()
+        self.assertEqual(handler._headers["Location"], "/")
+        return handler
+
+    def test_warm_cache_gets_folder_set_at_login(self):
+        self.assertEqual(self.login(LoginHandler).warmed, ("u1", "notes"))
+
+    def test_warm_cache_gets_folder_cookie_set_at_login(self):
+        self.assertEqual(self.login(CookieLoginHandler).warmed, ("u1", "notes"))
+
+    def test_warm_cache_defaults_to_whole_dropbox(self):
+        self.assertEqual(self.login(DefaultLoginHandler).warmed, ("u1", ""))
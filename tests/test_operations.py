@@ -0,0 +1,112 @@
+import datetime
+
+import tornado.httpclient
+
+from cache import DictCache
+from tracing import Tracer, MemorySink
+from tests.fake_dropbox import FakeDropbox, FakeClient, DropboxTestCase
+
+class OperationsTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.cache = DictCache("")
+        self.client = FakeClient(self.dropbox, cache=self.cache)
+
+    def requests(self, api):
+        return [call for call in self.dropbox.calls if call[0] == api]
+
+    def test_listing_from_older_version_is_rebuilt(self):
+        self.dropbox.put("b.txt", "b")
+        self.dropbox.put("A.txt", "a")
+        self.client.get_files(callback=self.stop)
+        self.assertEqual(self.wait(), ["A.txt", "b.txt"])
+
+        user = self.cache.get_user("u1")
+        user["folder_listing"] = dict(entries=[], names=[])
+        self.client.get_files(callback=self.stop)
+        self.assertEqual(self.wait(), ["A.txt", "b.txt"])
+
+    def test_missing_file_listed_in_other_case(self):
+        self.client.get_data("NOTES.txt", blank_on_404=True, callback=self.stop)
+        self.assertEqual(self.wait(), "")
+        self.dropbox.put("Notes.txt", "hello")
+        self.cache.update_folder_metadata_timestamp("u1", datetime.datetime.min)
+        self.client.get_files(callback=self.stop)
+        self.assertEqual(self.wait(), ["Notes.txt"])
+
+        self.dropbox.files["NOTES.txt"] = self.dropbox.files["Notes.txt"]
+        self.client.get_data("NOTES.txt", blank_on_404=True, callback=self.stop)
+        self.assertEqual(self.wait(), "hello")
+
+    def test_missing_file_lookup_does_not_create_folder_entry(self):
+        self.client.get_data("a/b.txt", blank_on_404=True, callback=self.stop)
+        self.wait()
+        self.client.get_data("a/b.txt", blank_on_404=True, callback=self.stop)
+        self.assertEqual(self.wait(), "")
+        self.assertEqual(len(self.requests("files")), 1)
+        self.assertEqual(self.cache._user_dict, dict())
+
+    def list_recursive(self, path=""):
+        self.client.get_files_recursive(path, callback=self.stop)
+        return self.wait()
+
+    def test_recursive_listing_of_subfolder_after_subtree_invalidation(self):
+        self.dropbox.put("a/b/c.txt", "c")
+        self.assertEqual(self.list_recursive(), ["a", "a/b", "a/b/c.txt"])
+
+        self.dropbox.put("a/b/d.txt", "d")
+        self.client.invalidate_folder("a", subtree=True)
+        self.dropbox.calls = []
+        self.assertEqual(self.list_recursive("a/b"), ["a/b/c.txt", "a/b/d.txt"])
+        self.assertEqual([call[1] for call in self.requests("metadata")], ["a/b"])
+
+    def test_recursive_listing_concurrency(self):
+        for i in range(6):
+            self.dropbox.put("d%d/e/f.txt" % i, "f")
+        self.client.settings["dropbox_tree_concurrency"] = 2
+        self.dropbox.hold = []
+        self.client.get_files_recursive(callback=self.stop)
+        most = 0
+        while self.dropbox.hold:
+            most = max(most, len(self.dropbox.hold))
+            self.dropbox.hold.pop(0)()
+        self.assertEqual(len(self.wait()), 6 * 3)
+        self.assertEqual(most, 2)
+        self.assertEqual(len(self.requests("metadata")), 1 + 6 * 2)
+
+    def test_recursive_listing_with_tracer(self):
+        sink = MemorySink()
+        self.client = FakeClient(self.dropbox, cache=self.cache, tracer=Tracer(sink))
+        for name in ("a", "b", "c"):
+            self.dropbox.put("%s/f.txt" % name, "f")
+        self.assertEqual(len(self.list_recursive()), 6)
+
+        trace = sink.traces[-1]
+        self.assertEqual(trace.name, "get_files_recursive")
+        self.assertFalse("error" in trace.tags)
+        branches = [span for span in trace.root.children if span.name == "refresh_folder"]
+        self.assertEqual(len(branches), 4)
+        for span in branches:
+            self.assertTrue(span.end is not None)
+            self.assertEqual(span.children[0].name, "dropbox.metadata")
+
+    def test_recursive_listing_skips_deleted_subfolder(self):
+        self.dropbox.put("a/f.txt", "f")
+        self.dropbox.put("b/g.txt", "g")
+        self.assertEqual(self.list_recursive(), ["a", "b", "a/f.txt", "b/g.txt"])
+
+        del self.dropbox.files["a/f.txt"]
+        self.dropbox.folder_hash += "x"
+        self.client.invalidate_folder("a")
+        self.assertEqual(self.list_recursive(), ["a", "b", "b/g.txt"])
+        # the root listing was invalidated, so the next listing drops the folder
+        self.assertEqual(self.list_recursive(), ["b", "b/g.txt"])
+
+    def test_recursive_listing_of_deleted_folder_fails(self):
+        self.dropbox.put("a/f.txt", "f")
+        self.list_recursive()
+        del self.dropbox.files["a/f.txt"]
+        self.client.invalidate_folder("a")
+        self.client.get_files_recursive("a", callback=self.stop)
+        self.assertRaises(tornado.httpclient.HTTPError, self.wait)
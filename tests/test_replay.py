@@ -0,0 +1,75 @@
+import io
+import time
+import datetime
+import unittest
+
+import replay
+from cache import DictCache
+from compression import GzipCodec
+from replay import TraceRecorder, TraceEvent, read_trace, OPERATION, REQUEST
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.trace = io.BytesIO()
+        self.recorder = TraceRecorder(self.trace)
+
+    def events(self):
+        return list(read_trace(io.BytesIO(self.trace.getvalue())))
+
+    def test_long_running_recorder_writes_epoch(self):
+        # the header keeps the real start, so records come out 50 days after it
+        self.recorder.start -= 50 * 86400
+        self.recorder.record_operation("get_data", "u1", "a.txt")
+        self.recorder.record_operation("get_data", "u1", "b.txt")
+        events = self.events()
+        self.assertEqual([event.name for event in events], ["get_data", "get_data"])
+        for event in events:
+            self.assertTrue(abs(event.time - time.time() - 50 * 86400) < 5)
+
+    def test_write_errors_are_counted(self):
+        self.trace.close()
+        self.recorder.record_operation("get_data", "u1", "a.txt")
+        self.recorder.record_operation("get_data", "u1", "a.txt")
+        self.assertEqual(self.recorder.errors, 2)
+
+    def test_cache_is_wrapped_once(self):
+        cache = DictCache("")
+        self.assertTrue(self.recorder.wrap_cache(cache) is self.recorder.wrap_cache(cache))
+
+    def test_get_file_records_stored_size(self):
+        cache = DictCache("", compression=GzipCodec(), compression_threshold=4)
+        cache.add_file("u1", "a.txt", datetime.datetime.now(), dict(rev="r1"), "a" * 1000)
+        stored = cache.get_stored_data("u1", "a.txt")[1]
+        self.recorder.wrap_cache(cache).get_file("u1", "a.txt")
+        self.assertEqual(self.events()[-1].size, len(stored))
+
+    def test_version_1_trace_is_read(self):
+        trace = io.BytesIO(replay.HEADER.pack(replay.MAGIC, 1, 1000.0) + replay.RECORD.pack(1500, replay.OPERATION, 2, 0, 1, 2, 0, 0))
+        events = list(read_trace(trace))
+        self.assertEqual([(event.time, event.name) for event in events], [(1001.5, "get_data")])
+
+class ReplayTest(unittest.TestCase):
+    def replay(self, *events):
+        return replay.replay([TraceEvent(t, kind, name, status, 1, 2, 10, version) for (t, kind, name, status, version) in events],
+                DictCache("", timeout=datetime.timedelta(seconds=60)))
+
+    def test_file_not_modified_revalidates_cached_file(self):
+        result = self.replay(
+                (1000.0, OPERATION, "get_data", 0, 0),
+                (1000.1, REQUEST, "files", 200, 7),
+                (1030.0, OPERATION, "file_not_modified", 0, 0),
+                (1100.0, OPERATION, "file_not_modified", 0, 0))
+        self.assertEqual((result.reads, result.hits, result.revalidations, result.misses), (3, 1, 1, 1))
+        self.assertEqual(result.api_calls, 2)
+
+    def test_write_behind_save_leaves_cache(self):
+        result = self.replay(
+                (1000.0, OPERATION, "get_data", 0, 0),
+                (1000.1, REQUEST, "files", 200, 7),
+                (1100.0, OPERATION, "write_behind_save", 0, 0),
+                (1100.1, OPERATION, "get_data", 0, 0),
+                (1105.0, REQUEST, "files_put", 200, 8),
+                (1110.0, OPERATION, "get_data", 0, 0))
+        # the save changes nothing, so the stale cached file is revalidated and found changed
+        self.assertEqual((result.reads, result.hits, result.misses), (3, 1, 2))
+        self.assertEqual(result.api_calls, 3)
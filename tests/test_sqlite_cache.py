@@ -0,0 +1,134 @@
+import os
+import shutil
+import sqlite3
+import datetime
+import tempfile
+import unittest
+
+from listing import build_listing
+from sqlite_cache import SqliteCache
+from tests.fake_dropbox import FakeDropbox, FakeClient
+
+NOW = datetime.datetime(2012, 6, 1, 12, 0, 0)
+
+METADATA = dict(hash="h1", path="/app", contents=[dict(path="/app/a.txt", bytes=1, modified=None, rev="r1", is_dir=False)])
+
+class SqliteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "cache.db")
+        self.cache = self.open()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        return SqliteCache("", cache_file_name=self.file_name, **kwargs)
+
+    def test_listing_is_loaded_lazily_and_remembered(self):
+        self.assertEqual(self.cache.get_user("u1")["folder_listing"], None)
+        listing = build_listing("/app", METADATA)
+        self.cache.update_folder_metadata("u1", NOW, METADATA, listing)
+
+        other = self.open()
+        user = other.get_user("u1")
+        self.assertEqual(user["folder_metadata_ts"], NOW)
+        self.assertEqual(len(other._listings), 0)
+        self.assertEqual(user["folder_listing"]["names"], ["a.txt"])
+        self.assertEqual(len(other._listings), 1)
+        self.assertTrue(other.get_user("u1")["folder_listing"] is other._listings.values()[0])
+
+        # a new listing gets a new version, so the remembered one is not used
+        self.cache.update_folder_metadata("u1", NOW, METADATA, build_listing("/app", dict(METADATA, contents=[])))
+        self.assertEqual(other.get_user("u1")["folder_listing"]["names"], [])
+
+    def test_listing_removed_before_it_is_loaded(self):
+        self.cache.get_user("u1")
+        self.cache.update_folder_metadata("u1", NOW, METADATA, build_listing("/app", METADATA))
+        other = self.open()
+        user = other.get_user("u1")
+        self.cache.remove_user("u1")
+        self.assertEqual(user["folder_listing"].get("version"), None)
+        # rebuilt from the metadata read by get_user
+        listing = FakeClient(FakeDropbox())._listing_from_user(user, "app")
+        self.assertEqual(listing["names"], ["a.txt"])
+
+    def test_sweep_keeps_invalidated_folders_that_are_in_use(self):
+        cache = self.open(max_age=datetime.timedelta(days=1))
+        cache.get_user("u1")
+        cache.update_folder_metadata("u1", NOW, METADATA, build_listing("/app", METADATA))
+        cache.get_user("u1", folder_name="old")
+        # invalidating a folder sets its timestamp to datetime.min
+        cache.update_folder_metadata_timestamp("u1", datetime.datetime.min)
+        with cache._conn:
+            cache._conn.execute("UPDATE user_cache SET accessed_ts = ? WHERE folder_name = 'old'", (datetime.datetime.now() - datetime.timedelta(days=2),))
+
+        cache.get_path_tree("u1")
+        cache.get_path_tree("u1", folder_name="old")
+
+        self.assertEqual(cache.sweep(), 1)
+        folders = [r["folder_name"] for r in cache._conn.execute("SELECT folder_name FROM user_cache")]
+        self.assertEqual(folders, [""])
+        # only the swept folder's path tree is dropped
+        self.assertEqual(cache._path_trees.keys(), [("u1", "")])
+
+    def test_reads_count_as_access(self):
+        cache = self.open(max_age=datetime.timedelta(days=1))
+        cache.get_user("u1")
+        with cache._conn:
+            cache._conn.execute("UPDATE user_cache SET accessed_ts = ?", (datetime.datetime.now() - datetime.timedelta(days=2),))
+        cache.get_user("u1")
+        self.assertEqual(cache.sweep(), 0)
+
+    def test_reads_are_only_tracked_when_bounded(self):
+        self.cache.add_file("u1", "a.txt", NOW, dict(rev="r1"), "a")
+        self.cache.get_file("u1", "a.txt")
+        self.cache.get_user("u1")
+        self.assertEqual((self.cache._accessed, self.cache._users_accessed), (dict(), dict()))
+
+        self.cache.max_age = datetime.timedelta(days=1)
+        self.cache.get_file("u1", "a.txt")
+        self.cache.get_user("u1")
+        self.assertEqual(self.cache._accessed.keys(), [("u1", "", "a.txt")])
+        self.assertEqual(self.cache._users_accessed.keys(), [("u1", "")])
+
+    def test_vacuum_converts_to_incremental(self):
+        self.cache._conn.close()
+        os.remove(self.file_name)
+        conn = sqlite3.connect(self.file_name)
+        conn.execute("CREATE TABLE user_cache (uid text, folder_name text, folder_metadata_ts timestamp, folder_metadata json)")
+        conn.close()
+
+        cache = self.open(max_age=datetime.timedelta(days=1))
+        self.assertEqual(cache._conn.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+        cache.vacuum()
+        self.assertEqual(cache._conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+    def test_folder_timestamp_is_read_only(self):
+        self.assertEqual(self.cache.get_folder_timestamp("u1"), None)
+        self.assertEqual(self.cache._conn.execute("SELECT count(*) FROM user_cache").fetchone()[0], 0)
+        self.cache.get_user("u1")
+        self.cache.update_folder_metadata_timestamp("u1", NOW)
+        self.assertEqual(self.cache.get_folder_timestamp("u1"), NOW)
+
+    def file_rows(self, cache):
+        return cache._conn.execute("SELECT count(*) FROM user_data_cache").fetchone()[0]
+
+    def test_adding_a_file_twice_keeps_one_row(self):
+        self.cache.add_file("u1", "a.txt", NOW, dict(rev="r1"), "one")
+        self.cache.add_file("u1", "a.txt", NOW, dict(rev="r2"), "two")
+        self.assertEqual(self.file_rows(self.cache), 1)
+        self.assertEqual(self.cache.get_file("u1", "a.txt")["file_data"], "two")
+
+    def test_duplicate_files_are_removed_on_open(self):
+        self.cache._conn.execute("DROP INDEX user_data_cache_key")
+        self.cache._conn.execute("CREATE INDEX user_data_cache_key ON user_data_cache (uid, folder_name, file_name)")
+        for data in ("one", "two"):
+            self.cache._conn.execute("INSERT INTO user_data_cache (uid, folder_name, file_name, file_metadata, file_metadata_ts, file_data) VALUES ('u1', '', 'a.txt', '{}', ?, ?)", (NOW, data))
+        self.cache._conn.commit()
+
+        cache = self.open()
+        self.assertEqual(self.file_rows(cache), 1)
+        self.assertEqual(cache.get_file("u1", "a.txt")["file_data"], "two")
+        cache.add_file("u1", "a.txt", NOW, dict(rev="r3"), "three")
+        self.assertEqual(self.file_rows(cache), 1)
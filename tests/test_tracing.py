@@ -0,0 +1,47 @@
+import unittest
+
+from tornado.httpclient import HTTPError
+
+from cache import DictCache
+from tracing import Tracer, MemorySink, NULL_TRACE
+from tests.fake_dropbox import FakeDropbox, FakeClient, DropboxTestCase
+
+class TraceTest(unittest.TestCase):
+    def test_fail_tags_and_finishes_once(self):
+        sink = MemorySink()
+        trace = Tracer(sink).start_trace("get_data", uid="u1")
+        trace.fail(ValueError("boom"))
+        trace.fail(ValueError("again"))
+        trace.finish()
+        self.assertEqual(len(sink.traces), 1)
+        self.assertEqual(trace.tags["error"], repr(ValueError("boom")))
+
+    def test_null_trace_fail(self):
+        NULL_TRACE.fail(ValueError("boom"))
+
+class OperationTraceTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.sink = MemorySink()
+        self.client = FakeClient(self.dropbox, cache=DictCache(""), tracer=Tracer(self.sink))
+
+    def test_success_has_no_error(self):
+        self.dropbox.put("a.txt", "hello")
+        self.client.get_data("a.txt", callback=self.stop)
+        self.assertEqual(self.wait(), "hello")
+        self.assertEqual(len(self.sink.traces), 1)
+        self.assertNotIn("error", self.sink.traces[0].tags)
+
+    def test_error_in_callback_finishes_trace(self):
+        self.client.get_data("missing.txt", callback=self.stop)
+        self.assertRaises(HTTPError, self.wait)
+        self.assertEqual(len(self.sink.traces), 1)
+        self.assertEqual(self.sink.traces[0].name, "get_data")
+        self.assertIn("404", self.sink.traces[0].tags["error"])
+
+    def test_synchronous_error_finishes_trace(self):
+        self.dropbox.fail = IOError("connection refused")
+        self.assertRaises(IOError, self.client.get_files, callback=self.stop)
+        self.assertEqual(len(self.sink.traces), 1)
+        self.assertIn("connection refused", self.sink.traces[0].tags["error"])
@@ -0,0 +1,89 @@
+import datetime
+import unittest
+
+from cache import DictCache
+from ttl_policy import FixedTTLPolicy, AdaptiveTTLPolicy
+from tests.fake_dropbox import FakeDropbox, FakeClient, DropboxTestCase
+
+def seconds(n):
+    return datetime.timedelta(seconds=n)
+
+class AdaptiveTTLPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = AdaptiveTTLPolicy(min_ttl=seconds(10), max_ttl=seconds(100), initial_ttl=seconds(40), max_entries=2)
+
+    def test_grows_up_to_max_ttl(self):
+        self.policy.observe("a", False)
+        self.assertEqual(self.policy.ttl("a"), seconds(80))
+        self.policy.observe("a", False)
+        self.assertEqual(self.policy.ttl("a"), seconds(100))
+        self.assertEqual(self.policy.ttl("b"), seconds(40))
+
+    def test_shrinks_down_to_min_ttl(self):
+        self.policy.observe("a", True)
+        self.assertEqual(self.policy.ttl("a"), seconds(10))
+        self.policy.observe("a", True)
+        self.assertEqual(self.policy.ttl("a"), seconds(10))
+
+    def test_drops_least_recently_observed_entries(self):
+        for key in ("a", "b", "c"):
+            self.policy.observe(key, False)
+        self.assertEqual(self.policy.ttl("a"), seconds(40))
+        self.assertEqual(self.policy.ttl("b"), seconds(80))
+        self.assertEqual(self.policy.ttl("c"), seconds(80))
+
+    def test_initial_ttl_is_clamped(self):
+        self.assertEqual(AdaptiveTTLPolicy(min_ttl=seconds(10), max_ttl=seconds(20), initial_ttl=seconds(60)).ttl("a"), seconds(20))
+        self.assertRaises(ValueError, AdaptiveTTLPolicy, min_ttl=seconds(20), max_ttl=seconds(10))
+
+    def test_fixed_policy(self):
+        policy = FixedTTLPolicy(seconds(5))
+        policy.observe("a", True)
+        self.assertEqual(policy.ttl("a"), seconds(5))
+
+class OperationTTLTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.dropbox.put("a.txt", "a")
+        self.policy = AdaptiveTTLPolicy(initial_ttl=seconds(60))
+        self.cache = DictCache("", ttl_policy=self.policy)
+        self.client = FakeClient(self.dropbox, cache=self.cache)
+
+    def requests(self, api):
+        return [call for call in self.dropbox.calls if call[0] == api]
+
+    def get_data(self):
+        self.client.get_data("a.txt", callback=self.stop)
+        return self.wait()
+
+    def age_file(self, n):
+        self.cache.update_file_timestamp("u1", "a.txt", datetime.datetime.now() - seconds(n))
+
+    def test_unchanged_file_is_revalidated_less_often(self):
+        self.get_data()
+        self.age_file(90)
+        self.get_data()
+        self.assertEqual(len(self.requests("metadata")), 1)
+        self.assertEqual(self.cache.ttl("u1", "a.txt"), seconds(120))
+
+        # fresh for longer than the initial TTL now
+        self.age_file(90)
+        self.get_data()
+        self.assertEqual(len(self.requests("metadata")), 1)
+
+    def test_changed_file_is_revalidated_more_often(self):
+        self.get_data()
+        self.dropbox.put("a.txt", "b")
+        self.age_file(90)
+        self.assertEqual(self.get_data(), "b")
+        self.assertEqual(self.cache.ttl("u1", "a.txt"), seconds(15))
+
+    def test_unchanged_folder_ttl_grows(self):
+        self.client.get_files(callback=self.stop)
+        self.wait()
+        self.cache.update_folder_metadata_timestamp("u1", datetime.datetime.now() - seconds(90))
+        self.client.get_files(callback=self.stop)
+        self.assertEqual(self.wait(), ["a.txt"])
+        self.assertEqual(self.cache.ttl("u1"), seconds(120))
+        self.assertEqual(self.cache.ttl("u1", "a.txt"), seconds(60))
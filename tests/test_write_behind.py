@@ -0,0 +1,122 @@
+import time
+import datetime
+import unittest
+
+import tornado.httpclient
+
+from cache import DictCache
+from client import DropboxClient
+from mixin import DropboxUserHandler, DropboxAPIMixin
+from write_behind import WriteBehindQueue
+from tests.fake_dropbox import FakeDropbox, FakeClient, DropboxTestCase, make_handler
+
+KEY = ("u1", "", "a.txt")
+
+class WriteBehindTest(DropboxTestCase):
+    def setUp(self):
+        DropboxTestCase.setUp(self)
+        self.dropbox = FakeDropbox()
+        self.dropbox.put("a.txt", "old")
+        self.cache = DictCache("")
+        self.queue = WriteBehindQueue(delay=datetime.timedelta(hours=1), max_retries=0)
+        self.client = FakeClient(self.dropbox, cache=self.cache, write_behind=self.queue)
+        self.client.get_data("a.txt", callback=self.stop)
+        self.wait()
+
+    def spin(self):
+        self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+        self.wait()
+
+    def requests(self, api):
+        return [call for call in self.dropbox.calls if call[0] == api]
+
+    def test_saves_are_coalesced(self):
+        self.client.upload_data("a.txt", "new", callback=self.stop)
+        self.wait()
+        self.client.upload_data("a.txt", "newer", callback=self.stop)
+        self.wait()
+        self.queue.flush(self.stop)
+        self.wait()
+        self.assertEqual(len(self.requests("files_put")), 1)
+        self.assertEqual(self.dropbox.files["a.txt"][1], "newer")
+        self.assertEqual(self.cache.get_file("u1", "a.txt")["file_data"], "newer")
+
+    def test_cache_keeps_old_data_until_uploaded(self):
+        self.client.upload_data("a.txt", "new", callback=self.stop)
+        self.wait()
+        self.assertEqual(self.cache.get_file("u1", "a.txt")["file_data"], "old")
+        self.client.get_data("a.txt", callback=self.stop)
+        self.assertEqual(self.wait(), "new")
+
+    def test_failed_upload_leaves_old_data_cached(self):
+        self.client.upload_data("a.txt", "new", callback=self.stop)
+        self.wait()
+        self.dropbox.fail = tornado.httpclient.HTTPError(500)
+        self.queue.flush(self.stop)
+        self.wait()
+        self.assertEqual(self.queue.failures[KEY][0], "new")
+        self.assertEqual(self.cache.get_file("u1", "a.txt")["file_data"], "old")
+        self.dropbox.fail = None
+        self.client.get_data("a.txt", callback=self.stop)
+        self.assertEqual(self.wait(), "old")
+
+    def test_delete_waits_for_upload_in_flight(self):
+        self.client.upload_data("a.txt", "new", callback=self.stop)
+        self.wait()
+        self.dropbox.hold = []
+        self.queue.flush()
+        self.spin()
+        self.assertEqual(len(self.dropbox.hold), 1)
+
+        self.client.delete_file("a.txt", callback=self.stop)
+        self.spin()
+        self.assertTrue(self.queue.is_discarded(KEY))
+        self.assertEqual(self.requests("fileops"), [])
+
+        release, self.dropbox.hold = self.dropbox.hold, None
+        release[0]()
+        self.wait()
+        self.assertFalse(self.queue.is_discarded(KEY))
+        self.assertEqual(len(self.requests("fileops")), 1)
+        self.assertFalse("a.txt" in self.dropbox.files)
+        self.assertEqual(self.cache.get_file("u1", "a.txt"), None)
+
+class QueueTest(DropboxTestCase):
+    def test_discard_in_flight_leaves_tombstone(self):
+        uploads = []
+        queue = WriteBehindQueue()
+        queue.save(KEY, "new", lambda data, parent_rev, callback: uploads.append(callback))
+        queue.flush()
+        self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+        self.wait()
+        self.assertEqual(len(uploads), 1)
+
+        queue.discard(KEY)
+        self.assertEqual(queue.pending_data(KEY), None)
+        self.assertTrue(queue.is_discarded(KEY))
+        waited = []
+        queue.wait(KEY, lambda: waited.append(True))
+        self.assertEqual(waited, [])
+
+        uploads[0]("r2")
+        self.assertEqual(waited, [True])
+        self.assertFalse(queue.is_discarded(KEY))
+        self.assertEqual(queue.uploads, 0)
+
+    def test_wait_without_upload_in_flight(self):
+        queue = WriteBehindQueue()
+        waited = []
+        queue.wait(KEY, lambda: waited.append(True))
+        self.assertEqual(waited, [True])
+
+class Handler(DropboxUserHandler, DropboxAPIMixin):
+    pass
+
+class HandlerUploadTest(unittest.TestCase):
+    def test_upload_runs_on_client(self):
+        queue = WriteBehindQueue()
+        handler = make_handler(Handler, FakeDropbox(), folder="notes", dropbox_cache=DictCache("notes"), dropbox_write_behind=queue)
+        handler._upload_data("a.txt", "new", lambda name: None)
+        upload = queue._pending[("u1", "notes", "a.txt")].upload
+        self.assertTrue(isinstance(upload.func.im_self, DropboxClient))
+        self.assertEqual(upload.func.im_self.folder_path, "notes")
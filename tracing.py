@@ -0,0 +1,340 @@
+"""
+==========
+tracing.py
+==========
+
+Optional per-request tracing for DropboxAPIMixin operations.
+
+Dependencies
+============
+
+Python (tested on 2.7.1).
+
+Usage
+=====
+
+Put a Tracer into the application settings as dropbox_tracer; every DropboxAPIMixin operation
+will then record a trace of nested spans (cache calls, JSON parsing, request building and
+signing, waiting on Dropbox, body transfer) and hand it to each of the tracer's sinks when the
+operation completes. Operations that raise are recorded too, with the error in an 'error' tag.
+Without a tracer, a no-op trace is used and nothing is recorded.
+
+::
+
+    sink = MemorySink()
+    tracer = Tracer(sink, SlowRequestLogger(datetime.timedelta(milliseconds=500)))
+
+    settings = {
+        ...
+        "dropbox_tracer": tracer,
+    }
+
+Classes
+=======
+
+Tracer
+    Creates traces and passes finished traces to its sinks.
+
+Trace
+    A tree of timed spans for a single operation.
+
+Span
+    A single timed section of a trace.
+
+MemorySink
+    A sink that keeps the most recent traces in memory.
+
+SlowRequestLogger
+    A sink that logs the span breakdown of any trace over a threshold.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+import logging
+import datetime
+import contextlib
+import collections
+
+logger = logging.getLogger(__name__)
+
+class Span(object):
+    """A single timed section of a trace; times are in seconds from time.time()."""
+
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        """Duration of the span in seconds; spans that are still open are measured up to now."""
+        end = time.time() if self.end is None else self.end
+        return end - self.start
+
+    def walk(self, depth=0):
+        """Yield (depth, span) for this span and all of its descendants, depth first."""
+        yield depth, self
+        for child in self.children:
+            for item in child.walk(depth + 1):
+                yield item
+
+class Trace(object):
+    """A tree of timed spans for a single operation.
+
+    Spans are opened and closed in strict nesting order, which holds for each operation since
+    the steps of an operation run one after another even when they wait on the IOLoop. Steps
+    that run concurrently each record into their own branch.
+
+    """
+
+    def __init__(self, tracer, name, tags):
+        self._tracer = tracer
+        self.tags = tags
+        self.root = Span(name)
+        self._stack = [self.root]
+
+    @property
+    def name(self):
+        return self.root.name
+
+    @property
+    def duration(self):
+        return self.root.duration
+
+    def start_span(self, name):
+        """Open a new span nested in the current one, and return it."""
+        span = Span(name)
+        self._stack[-1].children.append(span)
+        self._stack.append(span)
+        return span
+
+    def end_span(self, span):
+        """Close the given span, and any spans left open inside it."""
+        span.end = time.time()
+        while self._stack[-1] is not span:
+            self._stack.pop().end = span.end
+        self._stack.pop()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Context manager recording the enclosed block as a span."""
+        span = self.start_span(name)
+        try:
+            yield span
+        finally:
+            self.end_span(span)
+
+    def add_span(self, name, start, end):
+        """Record an already completed span as a child of the current span."""
+        span = Span(name, start)
+        span.end = end
+        self._stack[-1].children.append(span)
+        return span
+
+    def branch(self, name):
+        """Open a span in the current one for a concurrent step, and return a trace for that step.
+
+        The branch's spans nest inside that span without affecting this trace's open spans;
+        call the branch's finish to close it.
+
+        """
+        span = Span(name)
+        self._stack[-1].children.append(span)
+        return _TraceBranch(self, span)
+
+    def wrap_cache(self, cache):
+        """Return a proxy for cache that records each method call as a span."""
+        return TracedCache(cache, self)
+
+    def wrap_callback(self, callback):
+        """Return a callback that finishes this trace before calling the original."""
+        def wrapper(*args, **kwargs):
+            self.finish()
+            callback(*args, **kwargs)
+        return wrapper
+
+    def finish(self):
+        """Close the trace and pass it to the tracer's sinks."""
+        if self.root.end is not None:
+            return
+        self.end_span(self.root)
+        self._tracer.record(self)
+
+    def fail(self, error):
+        """Close the trace of an operation that raised, with the error in an 'error' tag; does nothing if already closed."""
+        if self.root.end is not None:
+            return
+        self.tags["error"] = repr(error)
+        self.finish()
+
+    def breakdown(self):
+        """Return a dict of span name to total seconds spent in spans of that name."""
+        totals = collections.defaultdict(float)
+        for depth, span in self.root.walk():
+            if depth:
+                totals[span.name] += span.duration
+        return dict(totals)
+
+    def format(self):
+        """Return a multi-line string showing the span tree with durations in milliseconds."""
+        lines = []
+        for depth, span in self.root.walk():
+            lines.append("%s%s %.1fms" % ("  " * depth, span.name, span.duration * 1000))
+        return "\n".join(lines)
+
+class _TraceBranch(Trace):
+    """The spans of one concurrent step of a trace; see Trace.branch."""
+
+    def __init__(self, trace, span):
+        self._tracer = trace._tracer
+        self.tags = trace.tags
+        self.root = span
+        self._stack = [span]
+
+    def finish(self):
+        """Close the branch's span; the trace it belongs to is recorded when that finishes."""
+        if self.root.end is None:
+            self.end_span(self.root)
+
+class _NullTrace(object):
+    """Trace used when no tracer is configured; records nothing."""
+
+    tags = {}
+
+    def start_span(self, name):
+        return None
+
+    def end_span(self, span):
+        return
+
+    @contextlib.contextmanager
+    def span(self, name):
+        yield None
+
+    def add_span(self, name, start, end):
+        return None
+
+    def branch(self, name):
+        return self
+
+    def wrap_cache(self, cache):
+        return cache
+
+    def wrap_callback(self, callback):
+        return callback
+
+    def finish(self):
+        return
+
+    def fail(self, error):
+        return
+
+NULL_TRACE = _NullTrace()
+
+class TracedCache(object):
+    """Proxy for a Cache that records every method call as a 'cache.<method>' span."""
+
+    def __init__(self, cache, trace):
+        self._cache = cache
+        self._trace = trace
+
+    def __getattr__(self, name):
+        attr = getattr(self._cache, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        trace = self._trace
+        span_name = "cache.%s" % name
+        def traced(*args, **kwargs):
+            with trace.span(span_name):
+                return attr(*args, **kwargs)
+        return traced
+
+class Tracer(object):
+    """Creates traces and passes finished traces to its sinks.
+
+    A sink is any object with a record(trace) method.
+
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = list(sinks)
+
+    def start_trace(self, name, **tags):
+        """Start a new trace for an operation called name; tags are kept on the trace."""
+        return Trace(self, name, tags)
+
+    def record(self, trace):
+        for sink in self.sinks:
+            try:
+                sink.record(trace)
+            except Exception:
+                logger.exception("trace sink %r failed", sink)
+
+class MemorySink(object):
+    """A sink that keeps the most recent traces in memory."""
+
+    def __init__(self, max_traces=1000):
+        """Construct a MemorySink keeping at most max_traces traces; default 1000."""
+        self.traces = collections.deque(maxlen=max_traces)
+
+    def record(self, trace):
+        self.traces.append(trace)
+
+    def clear(self):
+        self.traces.clear()
+
+    def breakdown(self):
+        """Return a dict of span name to total seconds over all kept traces."""
+        totals = collections.defaultdict(float)
+        for trace in self.traces:
+            for name, seconds in trace.breakdown().iteritems():
+                totals[name] += seconds
+        return dict(totals)
+
+class SlowRequestLogger(object):
+    """A sink that logs the span breakdown of any trace over a threshold."""
+
+    def __init__(self, threshold=datetime.timedelta(seconds=1), log=logger, level=logging.WARNING):
+        """Construct a SlowRequestLogger.
+
+        threshold - traces longer than this are logged, a timedelta; default 1 second
+        log - the logger to write to; default this module's logger
+        level - the logging level to use; default WARNING
+
+        """
+        self.threshold = threshold
+        self._log = log
+        self._level = level
+
+    def record(self, trace):
+        threshold = self.threshold.days * 86400 + self.threshold.seconds + self.threshold.microseconds / 1e6
+        if trace.duration > threshold:
+            self._log.log(self._level, "slow dropbox operation %s %s (%.1fms)\n%s",
+                    trace.name, trace.tags, trace.duration * 1000, trace.format())
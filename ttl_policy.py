@@ -0,0 +1,131 @@
+"""
+=============
+ttl_policy.py
+=============
+
+Policies deciding how long each cached folder listing and file stays fresh before it is
+revalidated with Dropbox.
+
+Dependencies
+============
+
+Python (tested on 2.7.1).
+
+Usage
+=====
+
+Pass a policy as the ttl_policy argument of a Cache implementation (or set its ttl_policy
+property); without one, every entry uses the cache's timeout. DropboxAPIMixin asks the policy for
+an entry's TTL whenever it reads the entry from the cache, and tells it whether each revalidation
+found the entry changed (a new rev or folder hash) or unchanged (the same rev, or a 304 response).
+
+::
+
+    policy = AdaptiveTTLPolicy(min_ttl=datetime.timedelta(seconds=10), max_ttl=datetime.timedelta(hours=1))
+    cache = DictCache("<folder path>", ttl_policy=policy)
+
+Entries are identified by a key tuple of (uid, folder name, file name); the file name is None
+for a folder listing.
+
+A policy is any object with these two methods:
+
+ttl(key)
+    Return how long the entry stays fresh, a timedelta.
+
+observe(key, changed)
+    Record the result of a revalidation of the entry.
+
+Classes
+=======
+
+FixedTTLPolicy
+    Every entry stays fresh for the same time.
+
+AdaptiveTTLPolicy
+    Lengthens the TTL of entries found unchanged, and shortens it for entries found changed.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import datetime
+import collections
+
+class FixedTTLPolicy(object):
+    """Every entry stays fresh for the same time."""
+
+    def __init__(self, timeout=datetime.timedelta(seconds=60)):
+        """Construct a FixedTTLPolicy; timeout is the TTL of every entry, default 60 seconds."""
+        self.timeout = timeout
+
+    def ttl(self, key):
+        return self.timeout
+
+    def observe(self, key, changed):
+        return
+
+class AdaptiveTTLPolicy(object):
+    """Lengthens the TTL of entries found unchanged, and shortens it for entries found changed.
+
+    Each entry's TTL starts at initial_ttl, is multiplied by grow after every revalidation that
+    found it unchanged and by shrink after every one that found it changed, and is kept between
+    min_ttl and max_ttl. Only the max_entries most recently revalidated entries are tracked; the
+    others fall back to initial_ttl.
+
+    """
+
+    def __init__(self, min_ttl=datetime.timedelta(seconds=10), max_ttl=datetime.timedelta(hours=1), grow=2.0, shrink=0.25, initial_ttl=datetime.timedelta(seconds=60), max_entries=100000):
+        """Construct an AdaptiveTTLPolicy.
+
+        min_ttl - shortest TTL of any entry, a timedelta; default 10 seconds
+        max_ttl - longest TTL of any entry, a timedelta; default 1 hour
+        grow - factor applied to the TTL of an entry found unchanged; default 2.0
+        shrink - factor applied to the TTL of an entry found changed; default 0.25
+        initial_ttl - TTL of entries not revalidated yet, a timedelta; default 60 seconds
+        max_entries - number of entries to track; default 100000
+
+        """
+        if min_ttl > max_ttl:
+            raise ValueError("min_ttl is greater than max_ttl")
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.grow = grow
+        self.shrink = shrink
+        self.initial_ttl = self._clamp(initial_ttl)
+        self.max_entries = max_entries
+        self._ttls = collections.OrderedDict()
+
+    def _clamp(self, ttl):
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    def ttl(self, key):
+        return self._ttls.get(key, self.initial_ttl)
+
+    def observe(self, key, changed):
+        ttl = self._ttls.pop(key, self.initial_ttl)
+        factor = self.shrink if changed else self.grow
+        seconds = ttl.days * 86400 + ttl.seconds + ttl.microseconds / 1e6
+        self._ttls[key] = self._clamp(datetime.timedelta(seconds=seconds * factor))
+        while len(self._ttls) > self.max_entries:
+            self._ttls.popitem(last=False)
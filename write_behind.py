@@ -0,0 +1,315 @@
+"""
+===============
+write_behind.py
+===============
+
+Debounced write-behind uploads for DropboxAPIMixin.upload_data, so that rapid saves of the same
+file (such as an editor's autosave) are coalesced into a few uploads of the latest content.
+
+Dependencies
+============
+
+Python (tested on 2.7.1), tornado.
+
+Usage
+=====
+
+Put a WriteBehindQueue into the application settings as dropbox_write_behind (or pass it to a
+client.DropboxClient). upload_data then queues the data and returns straight away, and the
+file is uploaded once no new save has arrived for delay, or at the latest max_delay after the
+first unsaved change. Reads of a file with a pending upload return the pending content; the
+cache only gets the data once Dropbox has accepted it.
+
+Only one upload per file is in flight at a time, and each upload's parent_rev is the rev returned
+by the previous one, so saves never race each other. Failed uploads are retried with
+exponential backoff; after max_retries, or if Dropbox saved the upload as a conflicted copy,
+the unsaved content is kept in failures and passed to on_error.
+
+An upload already in flight when its file is deleted can't be recalled, so discard keeps it as a
+tombstone until it completes; delete_file waits for it, so that the upload can't re-create the
+file after it is deleted.
+
+::
+
+    def on_error(key, data, error):
+        logging.error("could not save %s: %s", key, error)
+
+    settings = {
+        ...
+        "dropbox_write_behind": WriteBehindQueue(delay=datetime.timedelta(seconds=10), on_error=on_error),
+    }
+
+Call flush before stopping the IOLoop, so that pending saves are not lost.
+
+Classes
+=======
+
+WriteBehindQueue
+    Per-file debounced uploads with retries.
+
+WriteConflictError
+    Raised when Dropbox saved an upload under another name because the file changed remotely.
+
+Contributing
+============
+
+If you use and like this, please let me know! Patches, pull requests, suggestions etc. are all
+gratefully accepted.
+
+License
+=======
+
+Copyright 2012 Benedict Singer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+import time
+import logging
+import datetime
+
+from tornado.ioloop import IOLoop
+from tornado.stack_context import NullContext, ExceptionStackContext
+
+logger = logging.getLogger(__name__)
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+class WriteConflictError(Exception):
+    """Raised when Dropbox saved an upload under another name because the file changed remotely."""
+
+    def __init__(self, path):
+        Exception.__init__(self, "saved as %s after a conflicting change" % path)
+        self.path = path
+
+class _PendingWrite(object):
+    __slots__ = ("data", "version", "upload", "parent_rev", "first_saved", "timeout", "in_flight", "attempts", "waiters", "upload_waiters", "discarded")
+
+    def __init__(self, parent_rev, now):
+        self.data = None
+        # incremented on every save, to tell whether the uploaded data is still the latest
+        self.version = 0
+        self.upload = None
+        self.parent_rev = parent_rev
+        self.first_saved = now
+        self.timeout = None
+        self.in_flight = False
+        self.attempts = 0
+        # called once the entry is no longer pending, and once the upload in flight completes
+        self.waiters = []
+        self.upload_waiters = []
+        self.discarded = False
+
+class WriteBehindQueue(object):
+    """Per-file debounced uploads with retries.
+
+    Files are identified by a key tuple of (uid, folder name, file name).
+
+    """
+
+    def __init__(self, delay=datetime.timedelta(seconds=5), max_delay=datetime.timedelta(seconds=30), max_retries=5, retry_delay=datetime.timedelta(seconds=2), on_error=None, io_loop=None):
+        """Construct a WriteBehindQueue.
+
+        delay - upload once a file has had no new save for this long, a timedelta; default 5 seconds
+        max_delay - upload at the latest this long after the first unsaved change, a timedelta; default 30 seconds
+        max_retries - give up on an upload after this many failed retries; default 5
+        retry_delay - wait before the first retry, doubled for each further retry, a timedelta; default 2 seconds
+        on_error - called with the key, the unsaved data and the error when an upload is given up on; default None
+        io_loop - the Tornado IOLoop to schedule uploads on; default IOLoop.instance()
+
+        """
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.on_error = on_error
+        self._io_loop = io_loop
+        self._pending = dict()
+        # key -> entry discarded while its upload was in flight, until the upload completes
+        self._tombstones = dict()
+        # key -> (data, error) for uploads that were given up on
+        self.failures = dict()
+        self.saves = 0
+        self.uploads = 0
+
+    @property
+    def io_loop(self):
+        return self._io_loop or IOLoop.instance()
+
+    def pending_data(self, key):
+        """Return the latest data saved for key that is not uploaded yet, or None."""
+        entry = self._pending.get(key)
+        if entry is None:
+            return None
+        return entry.data
+
+    def save(self, key, data, upload, parent_rev=None):
+        """Queue data to be uploaded for key, replacing any data not uploaded yet.
+
+        upload - function taking the data, the parent rev and a callback, which uploads the data and calls the callback with the new rev
+        parent_rev - the rev the data was edited from, used if no upload for key is pending; default None
+
+        """
+        self.saves += 1
+        self.failures.pop(key, None)
+
+        now = time.time()
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = _PendingWrite(parent_rev, now)
+        entry.data = data
+        entry.version += 1
+        entry.upload = upload
+        entry.attempts = 0
+
+        if not entry.in_flight:
+            self._schedule(key, entry, min(now + _seconds(self.delay), entry.first_saved + _seconds(self.max_delay)))
+
+    def discard(self, key):
+        """Drop any data not uploaded yet for key.
+
+        An upload already in flight still completes; until it does, is_discarded returns True,
+        and wait can be used to wait for it.
+
+        """
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        if entry.timeout is not None:
+            self.io_loop.remove_timeout(entry.timeout)
+            entry.timeout = None
+        if entry.in_flight:
+            entry.discarded = True
+            self._tombstones[key] = entry
+        else:
+            self._notify(entry)
+
+    def is_discarded(self, key):
+        """Return True if key was discarded while its upload was in flight, and the upload has not completed yet."""
+        return key in self._tombstones
+
+    def wait(self, key, callback):
+        """Call callback once no upload for key is in flight; straight away if there is none."""
+        entries = [entry for entry in (self._pending.get(key), self._tombstones.get(key)) if entry is not None and entry.in_flight]
+        if not entries:
+            callback()
+            return
+        remaining = [len(entries)]
+        def on_done():
+            remaining[0] -= 1
+            if not remaining[0]:
+                callback()
+        for entry in entries:
+            entry.upload_waiters.append(on_done)
+
+    def flush(self, callback=None, keys=None):
+        """Upload pending data now, and call callback once none of it is pending any more.
+
+        keys - the keys to flush; default None, every key
+
+        """
+        if keys is None:
+            keys = self._pending.keys()
+        entries = [(key, self._pending[key]) for key in keys if key in self._pending]
+
+        if callback is not None:
+            remaining = [len(entries)]
+            def on_done():
+                remaining[0] -= 1
+                if not remaining[0]:
+                    callback()
+            if not entries:
+                callback()
+            for key, entry in entries:
+                entry.waiters.append(on_done)
+
+        for key, entry in entries:
+            if not entry.in_flight:
+                self._schedule(key, entry, time.time())
+
+    def _schedule(self, key, entry, deadline):
+        if entry.timeout is not None:
+            self.io_loop.remove_timeout(entry.timeout)
+        # keep the uploads out of the stack context of the request that saved
+        with NullContext():
+            entry.timeout = self.io_loop.add_timeout(deadline, lambda: self._upload(key, entry))
+
+    def _notify(self, entry):
+        waiters, entry.waiters = entry.waiters, []
+        for waiter in waiters:
+            waiter()
+
+    def _upload(self, key, entry):
+        entry.timeout = None
+        if self._pending.get(key) is not entry:
+            return
+        entry.in_flight = True
+        version, data = entry.version, entry.data
+
+        def on_uploaded(rev):
+            self._uploaded(key, entry, version, rev, None)
+
+        def on_error(typ, value, tb):
+            self._uploaded(key, entry, version, None, value)
+            return True
+
+        with NullContext():
+            with ExceptionStackContext(on_error):
+                entry.upload(data, entry.parent_rev, on_uploaded)
+
+    def _uploaded(self, key, entry, version, rev, error):
+        entry.in_flight = False
+        try:
+            self._handle_upload(key, entry, version, rev, error)
+        finally:
+            upload_waiters, entry.upload_waiters = entry.upload_waiters, []
+            for waiter in upload_waiters:
+                waiter()
+
+    def _handle_upload(self, key, entry, version, rev, error):
+        now = time.time()
+        if entry.discarded:
+            if self._tombstones.get(key) is entry:
+                del self._tombstones[key]
+            self._notify(entry)
+            return
+        if self._pending.get(key) is not entry:
+            return
+
+        if error is None:
+            self.uploads += 1
+            entry.parent_rev = rev
+            if entry.version == version:
+                del self._pending[key]
+                self._notify(entry)
+            else:
+                # saved again during the upload; start a new debounce window for the newer data
+                entry.first_saved = now
+                self._schedule(key, entry, now + (0 if entry.waiters else _seconds(self.delay)))
+            return
+
+        entry.attempts += 1
+        if isinstance(error, WriteConflictError) or entry.attempts > self.max_retries:
+            logger.error("giving up on upload of %s: %s", key, error)
+            del self._pending[key]
+            self.failures[key] = (entry.data, error)
+            self._notify(entry)
+            if self.on_error is not None:
+                self.on_error(key, entry.data, error)
+            return
+
+        wait = _seconds(self.retry_delay) * 2 ** (entry.attempts - 1)
+        logger.warning("upload of %s failed (%s), retrying in %.1fs", key, error, wait)
+        self._schedule(key, entry, now + wait)